@@ -0,0 +1,124 @@
+"""
+Benchmarks CRL generation for CA databases with many revoked entries,
+comparing `invocare.pki.crl.CRLBuilder` with `openssl ca -gencrl`.
+
+Each measurement runs in a fresh process so peak RSS is per-run:
+
+    python benchmarks/crl.py 100000 1000000 10000000 --openssl
+"""
+import argparse
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+
+CA_CONFIG = """\
+[ ca ]
+default_ca = bench
+
+[ bench ]
+dir = %(dir)s
+database = $dir/index.txt
+crlnumber = $dir/crl.srl
+certificate = $dir/ca.crt
+private_key = $dir/ca.key
+default_md = sha256
+default_crl_days = 7
+crl_extensions = crl_ext
+
+[ crl_ext ]
+authorityKeyIdentifier = keyid:always
+"""
+
+
+def setup(work_dir, count):
+    subprocess.run(
+        'openssl req -x509 -newkey rsa:2048 -nodes -days 30 -subj /CN=Bench '
+        '-keyout %(dir)s/ca.key -out %(dir)s/ca.crt' % {'dir': work_dir},
+        shell=True, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    with open(os.path.join(work_dir, 'openssl.cnf'), 'w') as fh:
+        fh.write(CA_CONFIG % {'dir': work_dir})
+    with open(os.path.join(work_dir, 'crl.srl'), 'w') as fh:
+        fh.write('01\n')
+    with open(os.path.join(work_dir, 'index.txt'), 'w') as fh:
+        for serial in range(1, count + 1):
+            # OpenSSL insists on an even number of hex digits.
+            serial_hex = '%X' % serial
+            serial_hex = serial_hex.zfill(len(serial_hex) + len(serial_hex) % 2)
+            fh.write(
+                'R\t300101000000Z\t240101000000Z,keyCompromise\t%s\tunknown\t/CN=host-%d\n'
+                % (serial_hex, serial)
+            )
+
+
+def run_stream(work_dir):
+    from invocare.pki.crl import CACertificate, CRLBuilder, FileKeySigner
+
+    builder = CRLBuilder(
+        CACertificate.from_file(os.path.join(work_dir, 'ca.crt')),
+        os.path.join(work_dir, 'index.txt'),
+        FileKeySigner(os.path.join(work_dir, 'ca.key')),
+        crl_number=1,
+        spool_dir=work_dir,
+    )
+    builder.build(os.path.join(work_dir, 'stream.crl'))
+
+
+def run_openssl(work_dir):
+    subprocess.run(
+        'openssl ca -gencrl -batch -config %(dir)s/openssl.cnf -out %(dir)s/openssl.crl'
+        % {'dir': work_dir},
+        shell=True, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+
+
+def child(builder, work_dir):
+    start = time.perf_counter()
+    if builder == 'stream':
+        run_stream(work_dir)
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+    else:
+        run_openssl(work_dir)
+        usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    # ru_maxrss is in kilobytes on Linux.
+    print('%f %d' % (time.perf_counter() - start, usage.ru_maxrss))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('counts', nargs='*', type=int, default=[10 ** 5, 10 ** 6, 10 ** 7])
+    parser.add_argument('--openssl', action='store_true', help='Also benchmark `openssl ca -gencrl`.')
+    parser.add_argument('--child', nargs=2, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        child(*args.child)
+        return
+
+    builders = ['stream'] + (['openssl'] if args.openssl else [])
+    print('%-10s %12s %10s %12s %12s' % ('builder', 'revoked', 'wall (s)', 'peak RSS', 'CRL size'))
+    for count in args.counts:
+        work_dir = tempfile.mkdtemp(prefix='crl-bench-')
+        try:
+            setup(work_dir, count)
+            for builder in builders:
+                output = subprocess.run(
+                    [sys.executable, __file__, '--child', builder, work_dir],
+                    check=True, stdout=subprocess.PIPE,
+                ).stdout.decode('ascii').split()
+                crl_size = os.stat(os.path.join(work_dir, '%s.crl' % builder)).st_size
+                print('%-10s %12d %10.2f %9.1f MB %9.1f MB' % (
+                    builder, count, float(output[0]), int(output[1]) / 1024.0,
+                    crl_size / 1048576.0,
+                ))
+        finally:
+            shutil.rmtree(work_dir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,132 @@
+"""
+Benchmarks the cold-start cost of the `invocare.pki` tasks under invoke,
+comparing source trees, e.g., a checkout from before a change with this one.
+
+Each tree is measured in fresh interpreters: the time spent importing
+`invocare.pki` and collecting its tasks the way invoke does (after invoke
+itself is imported, which every invocation pays for anyway), and the wall
+time of running `invoke --list` and `invoke show` end to end.  Run it with
+a Python that has invoke and invocare-openssl installed:
+
+    git archive <commit> invocare | tar -x -C /tmp/before
+    python benchmarks/import_time.py /tmp/before . --runs 20
+"""
+import argparse
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+
+MARKER = '-- pki import --'
+
+COLLECT = (
+    'from invoke import Collection; import invocare.pki; '
+    'ns = Collection.from_module(invocare.pki)'
+)
+
+TASKS_PY = """\
+from invoke import Collection
+import invocare.pki
+
+ns = Collection.from_module(invocare.pki)
+"""
+
+
+def environ(tree):
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(
+        [os.path.abspath(tree)] + [p for p in env.get('PYTHONPATH', '').split(os.pathsep) if p]
+    )
+    return env
+
+
+def collect(tree, work_dir):
+    """
+    Returns the milliseconds spent importing modules to collect the tasks,
+    and the number of modules imported and tasks found.
+    """
+    code = (
+        'import sys, invoke; sys.stderr.write(%r); m = set(sys.modules); %s; '
+        'print(len(set(sys.modules) - m), len(ns.task_names))'
+    ) % (MARKER + '\n', COLLECT)
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', code], cwd=work_dir, env=environ(tree),
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True, check=True,
+    )
+
+    # Sum the self times of everything imported after the marker.
+    imports = 0
+    for line in result.stderr.split(MARKER + '\n', 1)[1].splitlines():
+        if line.startswith('import time:') and not line.endswith('package'):
+            imports += int(line.split('|')[0].split(':')[1])
+    modules, tasks = result.stdout.split()
+    return imports / 1000.0, int(modules), int(tasks)
+
+
+def run_invoke(tree, work_dir, *args):
+    """
+    Returns the wall time of an invoke command, in milliseconds.
+    """
+    start = time.perf_counter()
+    subprocess.run(
+        [sys.executable, '-m', 'invoke'] + list(args), cwd=work_dir, env=environ(tree),
+        stdout=subprocess.DEVNULL, check=True,
+    )
+    return (time.perf_counter() - start) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('trees', nargs='*', default=['.'])
+    parser.add_argument('--runs', type=int, default=10)
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix='pki-bench-')
+    try:
+        with open(os.path.join(work_dir, 'tasks.py'), 'w') as fh:
+            fh.write(TASKS_PY)
+        subprocess.run(
+            'openssl req -x509 -newkey rsa:2048 -nodes -keyout key.pem -out cert.crt '
+            '-subj /CN=bench -days 1',
+            shell=True, cwd=work_dir, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+            check=True,
+        )
+
+        print('%-24s %8s %8s %12s %12s %12s' % (
+            'tree', 'tasks', 'modules', 'import (ms)', 'list (ms)', 'show (ms)'
+        ))
+        # Byte-compile the trees first, as an installed package would be.
+        for tree in args.trees:
+            subprocess.run(
+                [sys.executable, '-m', 'compileall', '-q', os.path.join(tree, 'invocare')],
+                check=True,
+            )
+
+        # Trees take turns, so drift in the machine's load affects them alike.
+        results = dict((tree, ([], [], [], [])) for tree in args.trees)
+        for _ in range(args.runs):
+            for tree in args.trees:
+                imports, lists, shows, counts = results[tree]
+                import_time, modules, tasks = collect(tree, work_dir)
+                imports.append(import_time)
+                counts.append((tasks, modules))
+                lists.append(run_invoke(tree, work_dir, '--list'))
+                shows.append(run_invoke(tree, work_dir, 'show', 'cert.crt'))
+
+        for tree in args.trees:
+            imports, lists, shows, counts = results[tree]
+            print('%-24s %8d %8d %12.1f %12.1f %12.1f' % (
+                (tree,) + counts[-1] + (
+                    statistics.median(imports), statistics.median(lists), statistics.median(shows),
+                )
+            ))
+    finally:
+        shutil.rmtree(work_dir)
+
+
+if __name__ == '__main__':
+    main()
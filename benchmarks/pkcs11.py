@@ -0,0 +1,177 @@
+"""
+Benchmarks CA signing throughput with a PKCS#11 key on a SoftHSM token,
+compared with the file-key path.
+
+Signatures are timed for the file-key signer (openssl pkeyutl), one token
+session per signature and pooled sessions; certificates for `openssl x509
+-req` and `invocare.pki.cert.CertificateBuilder` with each signer.  The
+token rows need `softhsm2-util` and the `python-pkcs11` package, and are
+skipped without `--module`:
+
+    python benchmarks/pkcs11.py --module /usr/lib/softhsm/libsofthsm2.so
+"""
+import argparse
+import datetime
+import hashlib
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+from invocare.pki.cert import CertificateBuilder, CertificateRequest, certificate_extensions
+from invocare.pki.config import OpenSSLConfig
+from invocare.pki.crl import CACertificate, FileKeySigner
+from invocare.pki.hsm import SessionPool
+
+
+TOKEN = 'bench'
+PIN = '1234'
+LABEL = 'bench-ca'
+
+EXT_CONFIG = """\
+[ leaf ]
+keyUsage = critical,digitalSignature,keyEncipherment
+basicConstraints = critical,CA:FALSE
+subjectKeyIdentifier = hash
+authorityKeyIdentifier = keyid:always
+extendedKeyUsage = serverAuth,clientAuth
+"""
+
+
+class ExtensionProfile:
+    """
+    Stands in for a `PKIProfile` holding just the extension section.
+    """
+
+    def __init__(self):
+        self.cfg = OpenSSLConfig()
+        self.cfg.read_string(EXT_CONFIG)
+
+
+def init_token(work_dir, module):
+    conf = os.path.join(work_dir, 'softhsm2.conf')
+    tokens = os.path.join(work_dir, 'tokens')
+    os.makedirs(tokens)
+    with open(conf, 'w') as fh:
+        fh.write('directories.tokendir = %s\nobjectstore.backend = file\n' % tokens)
+    os.environ['SOFTHSM2_CONF'] = conf
+    subprocess.run(
+        ['softhsm2-util', '--init-token', '--free', '--label', TOKEN,
+         '--pin', PIN, '--so-pin', PIN],
+        check=True, stdout=subprocess.DEVNULL,
+    )
+
+
+def setup_ca(work_dir, bits):
+    """
+    Creates a CA key and certificate, an extension config for `openssl`
+    and a CSR to sign, returning the paths of the CA key and certificate.
+    """
+    subprocess.run(
+        'openssl req -x509 -newkey rsa:%(bits)d -nodes -days 1 -subj /CN=Bench '
+        '-keyout ca.key -out ca.crt && '
+        'openssl req -new -newkey rsa:2048 -nodes -keyout leaf.key -subj /CN=leaf '
+        '-addext subjectAltName=DNS:leaf.test -out leaf.csr' % {'bits': bits},
+        shell=True, cwd=work_dir, check=True,
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    with open(os.path.join(work_dir, 'ext.cnf'), 'w') as fh:
+        fh.write(EXT_CONFIG)
+    return os.path.join(work_dir, 'ca.key'), os.path.join(work_dir, 'ca.crt')
+
+
+def measure(func, count, threads):
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        list(executor.map(func, range(count)))
+    return count / (time.perf_counter() - start)
+
+
+def signature_rows(signers, count, threads):
+    digests = [hashlib.sha256(b'%d' % i).digest() for i in range(count)]
+    for name, sign in signers:
+        rate = measure(lambda i: sign(digests[i], 'sha256'), count, threads)
+        print('%-50s %8d %12.1f' % ('signature, %s' % name, threads, rate))
+
+
+def certificate_rows(work_dir, ca_file, signers, count, threads):
+    def openssl_x509(i):
+        subprocess.run(
+            ['openssl', 'x509', '-req', '-in', 'leaf.csr', '-CA', 'ca.crt', '-CAkey', 'ca.key',
+             '-set_serial', str(i + 1), '-extfile', 'ext.cnf', '-extensions', 'leaf',
+             '-copy_extensions', 'copy', '-sha256', '-days', '1', '-outform', 'DER'],
+            cwd=work_dir, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+        )
+
+    rate = measure(openssl_x509, count, threads)
+    print('%-50s %8d %12.1f' % ('certificate, openssl x509 -req', threads, rate))
+
+    with open(os.path.join(work_dir, 'leaf.csr'), 'r') as fh:
+        csr = fh.read()
+    ca_cert = CACertificate.from_file(ca_file)
+    extensions = certificate_extensions(ExtensionProfile(), 'leaf')
+    not_before = datetime.datetime.utcnow().replace(microsecond=0)
+    not_after = not_before + datetime.timedelta(days=1)
+
+    for name, sign in signers:
+        # The certificates aren't verified, so a token key of the same size
+        # can stand in for the CA certificate's key.
+        builder = CertificateBuilder(ca_cert, extensions, sign)
+
+        def build(i):
+            request = CertificateRequest.from_pem(csr)
+            request.verify()
+            builder.build(request, i + 1, not_before, not_after)
+
+        rate = measure(build, count, threads)
+        print('%-50s %8d %12.1f' % ('certificate, builder, %s' % name, threads, rate))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--module', help='Path to the SoftHSM PKCS#11 module.')
+    parser.add_argument('--bits', type=int, default=2048)
+    parser.add_argument('--count', type=int, default=500)
+    parser.add_argument('--threads', type=int, nargs='*', default=[1, 4, 8])
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix='pkcs11-bench-')
+    try:
+        key_file, ca_file = setup_ca(work_dir, args.bits)
+        if args.module:
+            init_token(work_dir, args.module)
+            setup_pool = SessionPool(args.module, TOKEN, PIN, size=1)
+            setup_pool.generate_key(LABEL, bits=args.bits)
+            setup_pool.close()
+
+        def unpooled(digest, md):
+            # Open a session and log in for every signature.
+            pool = SessionPool(args.module, TOKEN, PIN, size=1)
+            try:
+                return pool.sign_digest(LABEL, digest, md)
+            finally:
+                pool.close()
+
+        print('%-50s %8s %12s' % ('operation', 'threads', 'per sec'))
+        for threads in args.threads:
+            signers = [('file key (openssl pkeyutl)', FileKeySigner(key_file))]
+            pool = None
+            if args.module:
+                pool = SessionPool(args.module, TOKEN, PIN, size=threads)
+                signers.extend((
+                    ('pkcs11, session per sign', unpooled),
+                    ('pkcs11, pooled sessions', lambda digest, md: pool.sign_digest(LABEL, digest, md)),
+                ))
+            signature_rows(signers, args.count, threads)
+            certificate_rows(work_dir, ca_file, signers, args.count, threads)
+            if pool:
+                pool.close()
+    finally:
+        shutil.rmtree(work_dir)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,3 +1,234 @@
-from .ca import inter_ca, root_ca, certificate, revoke
-from .init import initialize
-from .show import show
+"""
+The PKI tasks.  Each task is declared here with its arguments and help, so
+invoke can collect and list them without importing the modules that
+implement them; a module is only imported when one of its tasks runs.
+"""
+import sys
+
+from importlib import import_module
+from types import ModuleType
+
+from invoke import Task, task
+
+
+class TaskPackage(ModuleType):
+    """
+    Importing a submodule binds its name in the package, which would hide
+    the task of the same name (e.g., `backup`), so the task is kept.
+    """
+
+    def __setattr__(self, name, value):
+        if isinstance(value, ModuleType) and isinstance(self.__dict__.get(name), Task):
+            return
+        super().__setattr__(name, value)
+
+
+sys.modules[__name__].__class__ = TaskPackage
+
+
+def load(module, name):
+    """
+    Returns the task implemented in the module, importing it on first use.
+    """
+    return getattr(import_module('.' + module, __name__), name)
+
+
+@task(
+    help={
+        'profile': 'The PKI profile to back up.',
+        'store': 'The directory of the snapshot store.',
+        'pass_file': 'The passphrase file used to encrypt private material.',
+    }
+)
+def backup(
+        ctx,
+        profile=None,
+        store=None,
+        pass_file=None,
+):
+    """
+    Snapshots a PKI profile into a content-addressed store.
+    """
+    return load('backup', 'backup')(ctx, profile=profile, store=store, pass_file=pass_file)
+
+
+@task(
+    help={
+        'profile': 'The PKI profile to restore.',
+        'store': 'The directory of the snapshot store.',
+        'snapshot': 'The snapshot to restore, defaults to the latest.',
+        'pass_file': 'The passphrase file used to decrypt private material.',
+        'force': 'Overwrite files that already exist.',
+    }
+)
+def restore(
+        ctx,
+        profile=None,
+        store=None,
+        snapshot=None,
+        pass_file=None,
+        force=False,
+):
+    """
+    Restores a PKI profile from a snapshot.
+    """
+    return load('backup', 'restore')(
+        ctx, profile=profile, store=store, snapshot=snapshot, pass_file=pass_file, force=force,
+    )
+
+
+@task(
+    help={
+        'profile': 'The profile to create the intermediate CA under.',
+        'ca_name': 'The name of the CA to create.',
+        'days': 'The number of days the CA certificate is valid for.',
+    }
+)
+def inter_ca(
+        ctx,
+        profile=None,
+        ca_name=None,
+        batch=False,
+        bits=None,
+        days=None
+):
+    """
+    Initializes an intermediate CA in the profile.
+    """
+    return load('ca', 'inter_ca')(
+        ctx, profile=profile, ca_name=ca_name, batch=batch, bits=bits, days=days,
+    )
+
+
+@task
+def root_ca(
+        ctx,
+        profile=None,
+        batch=False,
+        bits=None,
+        days=3652,
+):
+    """
+    Initializes the root CA for the profile.
+    """
+    return load('ca', 'root_ca')(ctx, profile=profile, batch=batch, bits=bits, days=days)
+
+
+@task
+def certificate(
+        ctx,
+        profile=None,
+        ca_name=None,
+        common_name=None,
+        batch=False,
+        days=None,
+        bits=None,
+        san=None,
+):
+    return load('ca', 'certificate')(
+        ctx, profile=profile, ca_name=ca_name, common_name=common_name, batch=batch,
+        days=days, bits=bits, san=san,
+    )
+
+
+@task(
+    positional=('profile', 'ca_name'),
+)
+def revoke(
+        ctx,
+        cert_file,
+        profile=None,
+        ca_name=None,
+        batch=False,
+        reason='unspecified',
+):
+    return load('ca', 'revoke')(
+        ctx, cert_file, profile=profile, ca_name=ca_name, batch=batch, reason=reason,
+    )
+
+
+@task(
+    help={
+        'profile': 'The PKI profile of the CA.',
+        'ca_name': 'The name of the CA that issued the certificates.',
+        'common_name': 'The certificate to export, defaults to all of the CA\'s certificates.',
+        'formats': 'Comma-separated formats to export: fullchain, der and p12.',
+        'pass_file': 'The password file used to encrypt PKCS#12 files.',
+        'workers': 'The number of certificates to export in parallel.',
+    }
+)
+def export(
+        ctx,
+        profile=None,
+        ca_name=None,
+        common_name=None,
+        formats='fullchain,der,p12',
+        pass_file=None,
+        workers=None,
+):
+    """
+    Exports issued certificates as full chain PEM, DER and PKCS#12 files.
+    """
+    return load('export', 'export')(
+        ctx, profile=profile, ca_name=ca_name, common_name=common_name, formats=formats,
+        pass_file=pass_file, workers=workers,
+    )
+
+
+@task(
+    help={
+        'profile': 'The PKI profile to initialize.',
+    },
+    positional=('profile',),
+)
+def initialize(
+        ctx,
+        profile=None,
+):
+    """
+    Initializes directory structure
+    """
+    return load('init', 'initialize')(ctx, profile=profile)
+
+
+@task(
+    help={
+        'certificate': 'The path to the certificate file to show information.',
+    }
+)
+def show(
+        ctx,
+        certificate
+):
+    """
+    Shows information about a certificate, CSR, or a CRL.
+    """
+    return load('show', 'show')(ctx, certificate)
+
+
+@task(
+    help={
+        'profile': 'The PKI profile to issue certificates from.',
+        'host': 'The address to listen on, defaults to 127.0.0.1.',
+        'port': 'The port to listen on, defaults to 8080.',
+        'workers': 'The number of threads for key generation and signing.',
+        'batch_size': 'The maximum number of requests signed at once, defaults to 64.',
+        'batch_wait': 'Seconds to wait for a signing batch to fill, defaults to 0.05.',
+    }
+)
+def serve(
+        ctx,
+        profile=None,
+        host='127.0.0.1',
+        port=8080,
+        workers=None,
+        batch_size=64,
+        batch_wait=0.05,
+):
+    """
+    Runs an HTTP service that issues and revokes certificates in batches.
+    """
+    return load('service', 'serve')(
+        ctx, profile=profile, host=host, port=port, workers=workers,
+        batch_size=batch_size, batch_wait=batch_wait,
+    )
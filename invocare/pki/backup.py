@@ -0,0 +1,529 @@
+import datetime
+import hashlib
+import hmac
+import json
+import os
+import shlex
+import sys
+import tempfile
+
+from invoke import task
+
+from .metrics import get_metrics
+from .profile import PKIProfile
+
+
+# Files that normally only grow, and so are stored as a chain of the
+# bytes appended since the previous snapshot.
+APPEND_ONLY = (
+    os.path.join('db', 'index.txt'),
+    os.path.join('db', 'ephemeral.log'),
+)
+
+# Rebase an append-only file on a full copy after this many deltas.
+MAX_CHUNKS = 64
+
+BUFFER_SIZE = 1048576
+
+
+class SnapshotStore:
+    """
+    Content-addressed store of PKI profile snapshots.
+
+    Public files are stored under `objects/` by their SHA-256 hash, and
+    each directory as a tree object listing its files and subdirectories,
+    so a directory that hasn't changed since the last snapshot is the same
+    object again.  A snapshot in `snapshots/` just names the root trees.
+    Private material is kept under `private/`: objects, including its
+    trees, are encrypted with `openssl enc` and addressed by an HMAC of
+    their contents keyed with the passphrase.
+    """
+
+    def __init__(self, ctx, path, pass_file=None):
+        self.ctx = ctx
+        self.path = path
+        self.pass_file = pass_file
+        self.hmac_key = None
+        if pass_file:
+            with open(pass_file, 'rb') as fh:
+                self.hmac_key = fh.read().strip()
+
+        for d in ('objects', 'snapshots', os.path.join('private', 'objects')):
+            d = os.path.join(self.path, d)
+            if not os.path.isdir(d):
+                os.makedirs(d, 0o700)
+
+    def object_path(self, digest, private=False):
+        parts = [self.path]
+        if private:
+            parts.append('private')
+        parts.extend(['objects', digest[:2], digest])
+        return os.path.join(*parts)
+
+    def snapshots(self):
+        return sorted(
+            name[:-len('.json')]
+            for name in os.listdir(os.path.join(self.path, 'snapshots'))
+            if name.endswith('.json')
+        )
+
+    def _mkstemp(self):
+        fd, tmp_file = tempfile.mkstemp(dir=self.path, prefix='.tmp-')
+        os.close(fd)
+        return tmp_file
+
+    def _install(self, tmp_file, dest):
+        if os.path.isfile(dest):
+            os.unlink(tmp_file)
+            return
+        dest_dir = os.path.dirname(dest)
+        if not os.path.isdir(dest_dir):
+            os.makedirs(dest_dir, 0o700)
+        os.rename(tmp_file, dest)
+
+    def put(self, data):
+        """
+        Stores bytes as a public object, returning its hash.
+        """
+        digest = hashlib.sha256(data).hexdigest()
+        dest = self.object_path(digest)
+        if not os.path.isfile(dest):
+            tmp_file = self._mkstemp()
+            with open(tmp_file, 'wb') as fh:
+                fh.write(data)
+            self._install(tmp_file, dest)
+        return digest
+
+    def put_file(self, path):
+        """
+        Stores a file as a public object, returning its hash.
+        """
+        tmp_file = self._mkstemp()
+        digest = hashlib.sha256()
+        with open(path, 'rb') as src, open(tmp_file, 'wb') as dst:
+            while True:
+                data = src.read(BUFFER_SIZE)
+                if not data:
+                    break
+                digest.update(data)
+                dst.write(data)
+        digest = digest.hexdigest()
+        self._install(tmp_file, self.object_path(digest))
+        return digest
+
+    def encrypt(self, in_file, out_file):
+        self.ctx.run(
+            'openssl enc -aes-256-cbc -pbkdf2 -salt -pass file:%s -in %s -out %s' % (
+                shlex.quote(self.pass_file), shlex.quote(in_file), shlex.quote(out_file)
+            ),
+            hide=True,
+        )
+
+    def decrypt(self, in_file, out_file):
+        self.ctx.run(
+            'openssl enc -d -aes-256-cbc -pbkdf2 -pass file:%s -in %s -out %s' % (
+                shlex.quote(self.pass_file), shlex.quote(in_file), shlex.quote(out_file)
+            ),
+            hide=True,
+        )
+
+    def private_digest(self, path):
+        mac = hmac.new(self.hmac_key, digestmod=hashlib.sha256)
+        with open(path, 'rb') as fh:
+            while True:
+                data = fh.read(BUFFER_SIZE)
+                if not data:
+                    break
+                mac.update(data)
+        return mac.hexdigest()
+
+    def put_private(self, path):
+        """
+        Encrypts a file into the private store, returning its HMAC.
+        """
+        digest = self.private_digest(path)
+        dest = self.object_path(digest, private=True)
+        if not os.path.isfile(dest):
+            tmp_file = self._mkstemp()
+            self.encrypt(path, tmp_file)
+            self._install(tmp_file, dest)
+        return digest
+
+    def put_data(self, data, private=False):
+        """
+        Stores bytes as a public or private object, returning its address.
+        """
+        if not private:
+            return self.put(data)
+        digest = hmac.new(self.hmac_key, data, hashlib.sha256).hexdigest()
+        dest = self.object_path(digest, private=True)
+        if not os.path.isfile(dest):
+            plain_file, tmp_file = self._mkstemp(), self._mkstemp()
+            try:
+                with open(plain_file, 'wb') as fh:
+                    fh.write(data)
+                self.encrypt(plain_file, tmp_file)
+            finally:
+                os.unlink(plain_file)
+            self._install(tmp_file, dest)
+        return digest
+
+    def get_data(self, digest, private=False):
+        """
+        Returns the bytes of a public or private object, checking them
+        against its address.
+        """
+        path = self.object_path(digest, private=private)
+        if private:
+            tmp_file = self._mkstemp()
+            try:
+                self.decrypt(path, tmp_file)
+                with open(tmp_file, 'rb') as fh:
+                    data = fh.read()
+            finally:
+                os.unlink(tmp_file)
+            valid = hmac.new(self.hmac_key, data, hashlib.sha256).hexdigest() == digest
+        else:
+            with open(path, 'rb') as fh:
+                data = fh.read()
+            valid = hashlib.sha256(data).hexdigest() == digest
+        if not valid:
+            raise Exception('Snapshot object %s is corrupt.' % digest)
+        return data
+
+    def put_tree(self, dirs, files, private=False):
+        """
+        Stores a tree object for every directory, given the modes of the
+        directories and the entries of the files keyed by their relative
+        paths, returning the address of the root's tree.
+        """
+        root = {'dirs': {}, 'files': {}}
+        nodes = {'': root}
+        for path in sorted(dirs, key=lambda path: path.count(os.sep)):
+            parent, name = os.path.split(path)
+            nodes[path] = {'mode': dirs[path], 'dirs': {}, 'files': {}}
+            nodes[parent]['dirs'][name] = nodes[path]
+        for path, entry in files.items():
+            parent, name = os.path.split(path)
+            nodes[parent]['files'][name] = entry
+
+        def put(node):
+            tree = {
+                'dirs': dict(
+                    (name, {'mode': child['mode'], 'tree': put(child)})
+                    for name, child in node['dirs'].items()
+                ),
+                'files': node['files'],
+            }
+            data = json.dumps(tree, sort_keys=True, separators=(',', ':'))
+            return self.put_data(data.encode('utf-8'), private=private)
+
+        return put(root)
+
+    def read_tree(self, digest, private=False, prefix=''):
+        """
+        Returns the modes of the directories, and the entries of the files,
+        under a tree keyed by their relative paths.
+        """
+        tree = json.loads(self.get_data(digest, private=private).decode('utf-8'))
+        dirs = {}
+        files = dict(
+            (os.path.join(prefix, name), entry) for name, entry in tree['files'].items()
+        )
+        for name, child in tree['dirs'].items():
+            path = os.path.join(prefix, name)
+            dirs[path] = child['mode']
+            child_dirs, child_files = self.read_tree(child['tree'], private, path)
+            dirs.update(child_dirs)
+            files.update(child_files)
+        return dirs, files
+
+    def read_manifest(self, snapshot):
+        """
+        Returns the snapshot's directories and files.  The private ones are
+        None when there's private material but no passphrase to read it.
+        """
+        with open(os.path.join(self.path, 'snapshots', snapshot + '.json'), 'r') as fh:
+            snapshot_file = json.load(fh)
+
+        manifest = {'profile': snapshot_file['profile']}
+        manifest['dirs'], manifest['files'] = self.read_tree(snapshot_file['tree'])
+        manifest['private_dirs'], manifest['private'] = {}, {}
+        private_tree = snapshot_file.get('private_tree', None)
+        if private_tree and self.pass_file:
+            manifest['private_dirs'], manifest['private'] = self.read_tree(
+                private_tree, private=True
+            )
+        elif private_tree:
+            manifest['private_dirs'], manifest['private'] = None, None
+        return manifest
+
+    def write_manifest(self, snapshot, manifest):
+        snapshot_file = {
+            'profile': manifest['profile'],
+            'tree': self.put_tree(manifest['dirs'], manifest['files']),
+        }
+        if manifest['private_dirs'] or manifest['private']:
+            snapshot_file['private_tree'] = self.put_tree(
+                manifest['private_dirs'], manifest['private'], private=True
+            )
+
+        tmp_file = self._mkstemp()
+        with open(tmp_file, 'w') as fh:
+            json.dump(snapshot_file, fh, sort_keys=True)
+        os.rename(tmp_file, os.path.join(self.path, 'snapshots', snapshot + '.json'))
+
+
+def walk_files(root):
+    """
+    Yields the path relative to the root, and the `os.stat` result, of every
+    regular file under the root.
+    """
+    for dir_path, dir_names, file_names in os.walk(root):
+        dir_names.sort()
+        for name in sorted(file_names):
+            path = os.path.join(dir_path, name)
+            if os.path.islink(path):
+                continue
+            yield os.path.relpath(path, root), os.stat(path)
+
+
+def walk_dirs(root):
+    """
+    Returns the mode of every directory under the root, keyed by its path
+    relative to the root, so empty directories survive a restore.
+    """
+    dirs = {}
+    for dir_path, dir_names, _ in os.walk(root):
+        for name in dir_names:
+            path = os.path.join(dir_path, name)
+            dirs[os.path.relpath(path, root)] = os.stat(path).st_mode & 0o7777
+    return dirs
+
+
+def file_entry(stat, **kwargs):
+    entry = {
+        'mode': stat.st_mode & 0o7777,
+        'mtime_ns': stat.st_mtime_ns,
+        'size': stat.st_size,
+    }
+    entry.update(kwargs)
+    return entry
+
+
+def unchanged(stat, entry):
+    return (
+        entry is not None and
+        entry['size'] == stat.st_size and
+        entry['mtime_ns'] == stat.st_mtime_ns
+    )
+
+
+def snapshot_public(store, root, path, stat, previous):
+    """
+    Stores a public file, as a delta on the previous snapshot when it's an
+    append-only file that has only been appended to.
+    """
+    is_append_only = any(path.endswith(suffix) for suffix in APPEND_ONLY)
+    if not (
+        is_append_only and previous and
+        stat.st_size >= previous['size'] and
+        len(previous['chunks']) < MAX_CHUNKS
+    ):
+        digest = store.put_file(os.path.join(root, path))
+        return file_entry(stat, sha256=digest, chunks=[digest])
+
+    # Check that the previous contents are a prefix of the file, and hash
+    # the whole file in the same pass.
+    digest = hashlib.sha256()
+    with open(os.path.join(root, path), 'rb') as fh:
+        remaining = previous['size']
+        while remaining:
+            data = fh.read(min(remaining, BUFFER_SIZE))
+            if not data:
+                break
+            digest.update(data)
+            remaining -= len(data)
+
+        if remaining or digest.hexdigest() != previous['sha256']:
+            digest = store.put_file(os.path.join(root, path))
+            return file_entry(stat, sha256=digest, chunks=[digest])
+
+        appended = fh.read()
+    digest.update(appended)
+    chunks = list(previous['chunks'])
+    if appended:
+        chunks.append(store.put(appended))
+    return file_entry(stat, sha256=digest.hexdigest(), chunks=chunks)
+
+
+@task(
+    help={
+        'profile': 'The PKI profile to back up.',
+        'store': 'The directory of the snapshot store.',
+        'pass_file': 'The passphrase file used to encrypt private material.',
+    }
+)
+def backup(
+        ctx,
+        profile=None,
+        store=None,
+        pass_file=None,
+):
+    """
+    Snapshots a PKI profile into a content-addressed store.
+    """
+    profile = PKIProfile.from_context(profile, ctx)
+    config = ctx.config.get('pki', {})
+    store = store or config.get('backup_store', None)
+    pass_file = pass_file or config.get('backup_pass_file', None)
+    metrics = get_metrics(ctx)
+
+    if not store:
+        sys.stderr.write('Must provide a snapshot store directory.\n')
+        sys.exit(os.EX_USAGE)
+
+    with profile.workspace() as profile:
+        if os.path.isdir(profile.private) and not pass_file:
+            sys.stderr.write('Must provide a passphrase file to back up private material.\n')
+            sys.exit(os.EX_USAGE)
+
+        store = SnapshotStore(ctx, store, pass_file=pass_file)
+        snapshots = store.snapshots()
+        previous = {'files': {}, 'private': {}}
+        if snapshots:
+            previous = store.read_manifest(snapshots[-1])
+
+        manifest = {
+            'profile': profile.name,
+            'dirs': walk_dirs(profile.dir),
+            'private_dirs': {},
+            'files': {},
+            'private': {},
+        }
+
+        with metrics.span('backup', 'public', profile=profile.name):
+            for path, stat in walk_files(profile.dir):
+                entry = previous['files'].get(path, None)
+                if not unchanged(stat, entry):
+                    entry = snapshot_public(store, profile.dir, path, stat, entry)
+                    metrics.incr('backup_bytes', stat.st_size, profile=profile.name)
+                manifest['files'][path] = entry
+
+        if os.path.isdir(profile.private):
+            manifest['private_dirs'] = walk_dirs(profile.private)
+            with metrics.span('backup', 'private', profile=profile.name):
+                for path, stat in walk_files(profile.private):
+                    entry = previous['private'].get(path, None)
+                    if not unchanged(stat, entry):
+                        digest = store.put_private(os.path.join(profile.private, path))
+                        entry = file_entry(stat, hmac=digest)
+                    manifest['private'][path] = entry
+
+        snapshot = datetime.datetime.utcnow().strftime('%Y%m%dT%H%M%S%fZ')
+        store.write_manifest(snapshot, manifest)
+        print(snapshot)
+
+
+@task(
+    help={
+        'profile': 'The PKI profile to restore.',
+        'store': 'The directory of the snapshot store.',
+        'snapshot': 'The snapshot to restore, defaults to the latest.',
+        'pass_file': 'The passphrase file used to decrypt private material.',
+        'force': 'Overwrite files that already exist.',
+    }
+)
+def restore(
+        ctx,
+        profile=None,
+        store=None,
+        snapshot=None,
+        pass_file=None,
+        force=False,
+):
+    """
+    Restores a PKI profile from a snapshot.
+    """
+    profile = PKIProfile.from_context(profile, ctx)
+    config = ctx.config.get('pki', {})
+    store = store or config.get('backup_store', None)
+    pass_file = pass_file or config.get('backup_pass_file', None)
+
+    if not store:
+        sys.stderr.write('Must provide a snapshot store directory.\n')
+        sys.exit(os.EX_USAGE)
+
+    store = SnapshotStore(ctx, store, pass_file=pass_file)
+    snapshots = store.snapshots()
+    snapshot = snapshot or (snapshots and snapshots[-1])
+    if snapshot not in snapshots:
+        sys.stderr.write('No snapshot "%s" in the store.\n' % snapshot)
+        sys.exit(os.EX_DATAERR)
+
+    manifest = store.read_manifest(snapshot)
+    if manifest['profile'] != profile.name:
+        sys.stderr.write('Snapshot is of the "%s" profile.\n' % manifest['profile'])
+        sys.exit(os.EX_DATAERR)
+
+    if manifest['private'] is None:
+        sys.stderr.write('Must provide a passphrase file to restore private material.\n')
+        sys.exit(os.EX_USAGE)
+
+    with profile.workspace() as profile:
+        for root, dirs in (
+                (profile.dir, manifest['dirs']),
+                (profile.private, manifest['private_dirs'])):
+            for path, mode in sorted(dirs.items()):
+                path = os.path.join(root, path)
+                if not os.path.isdir(path):
+                    os.makedirs(path, mode)
+
+        restored = []
+        for root, files, private in (
+                (profile.dir, manifest['files'], False),
+                (profile.private, manifest['private'], True)):
+            for path, entry in sorted(files.items()):
+                dest = os.path.join(root, path)
+                if os.path.exists(dest) and not force:
+                    sys.stderr.write('Not overwriting existing file: %s\n' % dest)
+                    continue
+
+                dest_dir = os.path.dirname(dest)
+                if not os.path.isdir(dest_dir):
+                    os.makedirs(dest_dir, 0o700 if private else 0o755)
+
+                # Created 0600 so private material is never readable by others,
+                # even before its mode is restored.
+                fd, tmp_file = tempfile.mkstemp(dir=dest_dir, prefix='.restore-')
+                os.close(fd)
+                try:
+                    if private:
+                        store.decrypt(store.object_path(entry['hmac'], private=True), tmp_file)
+                        valid = store.private_digest(tmp_file) == entry['hmac']
+                    else:
+                        digest = hashlib.sha256()
+                        with open(tmp_file, 'wb') as dst:
+                            for chunk in entry['chunks']:
+                                with open(store.object_path(chunk), 'rb') as src:
+                                    while True:
+                                        data = src.read(BUFFER_SIZE)
+                                        if not data:
+                                            break
+                                        digest.update(data)
+                                        dst.write(data)
+                        valid = digest.hexdigest() == entry['sha256']
+
+                    if not valid:
+                        sys.stderr.write('Snapshot object for %s is corrupt.\n' % dest)
+                        sys.exit(os.EX_DATAERR)
+
+                    os.chmod(tmp_file, entry['mode'])
+                    os.utime(tmp_file, ns=(entry['mtime_ns'], entry['mtime_ns']))
+                    os.rename(tmp_file, dest)
+                finally:
+                    if os.path.exists(tmp_file):
+                        os.unlink(tmp_file)
+                restored.append(dest)
+
+        print('Restored %d files from snapshot %s.' % (len(restored), snapshot))
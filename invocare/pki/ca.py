@@ -1,4 +1,5 @@
 import os
+import shlex
 import sys
 
 from collections import OrderedDict
@@ -6,9 +7,58 @@ from collections import OrderedDict
 from invocare.openssl import openssl_ca, openssl_req
 from invoke import task
 
+from .cert import CertificateRequest, issue_certificates, revoke_certificate
 from .config import OpenSSLConfig
+from .crl import build_crl
+from .ephemeral import ephemeral_hours, ephemeral_request, is_ephemeral, issue_ephemeral
+from .hsm import ca_key, get_pool, hsm_key_label, hsm_signer
 from .keyfile import generate_keyfile, generate_passfile
+from .metrics import get_metrics
 from .profile import PKIProfile
+from .validate import request_subject, validate_requests
+
+
+def ca_keygen(
+        ctx,
+        profile,
+        ca_name,
+        bits=None,
+        task_name='root_ca',
+):
+    """
+    Generates the private key for a CA unless it already exists, returning
+    the key as given to OpenSSL: a key file path, or a PKCS#11 URI (quoted
+    for the shell) when the CA's key is kept on a token.
+    """
+    metrics = get_metrics(ctx)
+    key_file = ca_key(profile, ca_name)
+    key_label = hsm_key_label(profile, ca_name)
+    pass_file = os.path.join(profile.private, ca_name, 'ca.pass')
+
+    if key_label:
+        # The passphrase file holds the token's PIN, which can't be generated.
+        if not os.path.isfile(pass_file):
+            sys.stderr.write('No PKCS#11 PIN file for the "%s" CA: %s\n' % (ca_name, pass_file))
+            sys.exit(os.EX_CONFIG)
+        exists = get_pool(profile, ca_name).has_key(key_label)
+    else:
+        exists = os.path.isfile(key_file)
+
+    if not exists:
+        if not bits:
+            # Use CA's bit setting, or the policy default.
+            bits = profile.cfg[ca_name]['default_bits']
+            if bits.startswith('$'):
+                bits = profile.cfg['default']['bits']
+        with metrics.span(task_name, 'keygen', ca=ca_name):
+            if key_label:
+                get_pool(profile, ca_name).generate_key(key_label, bits=int(bits))
+                metrics.incr('keys_generated', bits=bits)
+            else:
+                generate_passfile(ctx, pass_file)
+                generate_keyfile(ctx, key_file, pass_file, bits=int(bits))
+
+    return shlex.quote(key_file)
 
 
 @task(
@@ -32,108 +82,116 @@ def inter_ca(
     profile = PKIProfile.from_context(profile, ctx)
     config = ctx.config.get('pki', {})
     ca_name = ca_name or config.get('ca_name', None)
+    metrics = get_metrics(ctx)
 
     if not ca_name in profile.intermediates:
         sys.stderr.write('No configuration for "%s" intermediate CA.\n' % ca_name)
         sys.exit(os.EX_CONFIG)
 
-    if not os.path.isfile(profile.config_file):
+    if not profile.initialized():
         sys.stderr.write('PKI profile "%s" has not been initialized.\n' % profile.name)
         sys.exit(os.EX_CONFIG)
 
-    if not os.path.isfile(os.path.join(profile.dir, 'root', 'ca.crt')):
-        sys.stderr.write('Root CA for PKI profile "%s" does not exist.\n' % profile.name)
-        sys.exit(os.EX_CONFIG)
-
-    ca_dir = os.path.join(profile.dir, ca_name)
-    cert_file = os.path.join(ca_dir, 'ca.crt')
-    crl_file = os.path.join(ca_dir, 'ca.crl')
-    ca_bundle = os.path.join(ca_dir, 'ca-bundle.crt')
-    req_dir = os.path.join(profile.dir, 'root', 'reqs')
-    req_file = os.path.join(req_dir, ca_name + '.csr')
-    key_file = os.path.join(profile.private, ca_name, 'ca.key')
-    pass_file = os.path.join(profile.private, ca_name, 'ca.pass')
-
-    if not os.path.isfile(key_file):
-        if not bits:
-            # Use CA's bit setting, or the policy default.
-            bits = profile.cfg[ca_name]['default_bits']
-            if bits.startswith('$'):
-                bits = profile.cfg['default']['bits']
-        generate_passfile(ctx, pass_file)
-        generate_keyfile(ctx, key_file, pass_file, bits=int(bits))
+    with profile.workspace() as profile:
+        if not os.path.isfile(os.path.join(profile.dir, 'root', 'ca.crt')):
+            sys.stderr.write('Root CA for PKI profile "%s" does not exist.\n' % profile.name)
+            sys.exit(os.EX_CONFIG)
+
+        ca_dir = os.path.join(profile.dir, ca_name)
+        cert_file = os.path.join(ca_dir, 'ca.crt')
+        crl_file = os.path.join(ca_dir, 'ca.crl')
+        ca_bundle = os.path.join(ca_dir, 'ca-bundle.crt')
+        req_dir = os.path.join(profile.dir, 'root', 'reqs')
+        req_file = os.path.join(req_dir, ca_name + '.csr')
+        pass_file = os.path.join(profile.private, ca_name, 'ca.pass')
+
+        # Check the root's policy before spending time on the key.
+        if not os.path.isfile(cert_file):
+            subject = request_subject(profile, ca_name, profile.cfg[ca_name]['common_name'])
+            error = validate_requests(profile, 'root', [(subject, None)])[0]
+            if error:
+                sys.stderr.write('%s\n' % error)
+                sys.exit(os.EX_DATAERR)
+
+        key_file = ca_keygen(ctx, profile, ca_name, bits=bits, task_name='inter_ca')
+
+        if not os.path.isfile(req_file):
+            ca_subject = '/'.join([
+                profile.base_subject(),
+                'OU=%s' % profile.cfg[ca_name]['org_unit'],
+                'CN=%s' % profile.cfg[ca_name]['common_name'],
+            ])
+
+            with metrics.span('inter_ca', 'csr', ca=ca_name):
+                openssl_req(
+                    ctx,
+                    key_file,
+                    req_file,
+                    config_file=profile.config_file,
+                    extensions='intermediate_cert',
+                    passin=pass_file,
+                    subj=ca_subject
+                )
 
-    if not os.path.isfile(req_file):
-        ca_subject = '/'.join([
-            profile.base_subject(),
-            'OU=%s' % profile.cfg[ca_name]['org_unit'],
-            'CN=%s' % profile.cfg[ca_name]['common_name'],
-        ])
-
-        openssl_req(
-            ctx,
-            key_file,
-            req_file,
-            config_file=profile.config_file,
-            extensions='intermediate_cert',
-            passin=pass_file,
-            subj=ca_subject
-        )
-
-    if not os.path.isfile(cert_file):
-        # Sign intermediate with the Root CA settings.
-        root_pass = os.path.join(profile.private, 'root', 'ca.pass')
-
-        openssl_ca(
-            ctx,
-            'sign',
-            config_file=profile.config_file,
-            config_name='root',
-            batch=batch,
-            days=days or int(profile.cfg['root']['default_days']),
-            extensions='intermediate_cert',
-            in_file=req_file,
-            out_file=cert_file,
-            passin=root_pass,
-        )
-
-        if os.stat(cert_file).st_size:
-            os.chmod(cert_file, 0o444)
-            root_cert_file = os.path.join(
-                profile.dir, 'root', 'certs', '%s.crt' % ca_name
-            )
-            if not os.path.isfile(root_cert_file):
-                ctx.run('cp -p %s %s' % (cert_file, root_cert_file))
+        if not os.path.isfile(cert_file):
+            # Sign intermediate with the Root CA settings.
+            root_pass = os.path.join(profile.private, 'root', 'ca.pass')
+
+            with metrics.span('inter_ca', 'sign', ca=ca_name):
+                if hsm_key_label(profile, 'root'):
+                    hsm_sign_request(
+                        profile, 'root', req_file, cert_file,
+                        days or int(profile.cfg['root']['default_days']),
+                        extensions='intermediate_cert',
+                    )
+                else:
+                    openssl_ca(
+                        ctx,
+                        'sign',
+                        config_file=profile.config_file,
+                        config_name='root',
+                        batch=batch,
+                        days=days or int(profile.cfg['root']['default_days']),
+                        extensions='intermediate_cert',
+                        in_file=req_file,
+                        out_file=cert_file,
+                        passin=root_pass,
+                    )
+
+            if os.path.isfile(cert_file) and os.stat(cert_file).st_size:
+                metrics.incr('certs_signed', ca='root')
+                os.chmod(cert_file, 0o444)
+                root_cert_file = os.path.join(
+                    profile.dir, 'root', 'certs', '%s.crt' % ca_name
+                )
+                if not os.path.isfile(root_cert_file):
+                    with metrics.span('inter_ca', 'copy', ca=ca_name):
+                        ctx.run('cp -p %s %s' % (cert_file, root_cert_file))
+            else:
+                # Clean up if not signed.
+                if os.path.isfile(cert_file):
+                    os.unlink(cert_file)
+                return
+
+            # Generate a bundle that includes the Root CA.
+            if not os.path.isfile(ca_bundle):
+                with metrics.span('inter_ca', 'bundle', ca=ca_name):
+                    ctx.run(
+                        'cat %s %s > %s' % (
+                            cert_file,
+                            os.path.join(profile.dir, 'root', 'ca.crt'),
+                            ca_bundle
+                        )
+                    )
+                    os.chmod(ca_bundle, 0o444)
+
+            # Generate the initial CRL.
+            if not os.path.isfile(crl_file):
+                gencrl(ctx, profile, ca_name, task_name='inter_ca')
         else:
-            # Clean up if not signed.
-            os.unlink(cert_file)
+            sys.stderr.write('Intermediate CA certificate already exists for "%s".\n' % ca_name)
             return
 
-        # Generate a bundle that includes the Root CA.
-        if not os.path.isfile(ca_bundle):
-            ctx.run(
-                'cat %s %s > %s' % (
-                    cert_file,
-                    os.path.join(profile.dir, 'root', 'ca.crt'),
-                    ca_bundle
-                )
-            )
-            os.chmod(ca_bundle, 0o444)
-
-        # Generate the initial CRL.
-        if not os.path.isfile(crl_file):
-            openssl_ca(
-                ctx,
-                'gencrl',
-                config_file=profile.config_file,
-                config_name=ca_name,
-                passin=pass_file,
-                out_file=crl_file,
-            )
-    else:
-        sys.stderr.write('Intermediate CA certificate already exists for "%s".\n' % ca_name)
-        return
-
 
 @task
 def root_ca(
@@ -147,78 +205,219 @@ def root_ca(
     Initializes the root CA for the profile.
     """
     profile = PKIProfile.from_context(profile, ctx)
+    metrics = get_metrics(ctx)
 
-    if not os.path.isfile(profile.config_file):
+    if not profile.initialized():
         sys.stderr.write('PKI profile "%s" has not been initialized.\n' % profile.name)
         sys.exit(os.EX_CONFIG)
 
-    ca_dir = os.path.join(profile.dir, 'root')
-    cert_file = os.path.join(ca_dir, 'ca.crt')
-    crl_file = os.path.join(ca_dir, 'ca.crl')
-    key_file = os.path.join(profile.private, 'root', 'ca.key')
-    pass_file = os.path.join(profile.private, 'root', 'ca.pass')
-    req_file = os.path.join(ca_dir, 'reqs', 'root.csr')
+    with profile.workspace() as profile:
+        ca_dir = os.path.join(profile.dir, 'root')
+        cert_file = os.path.join(ca_dir, 'ca.crt')
+        crl_file = os.path.join(ca_dir, 'ca.crl')
+        pass_file = os.path.join(profile.private, 'root', 'ca.pass')
+        req_file = os.path.join(ca_dir, 'reqs', 'root.csr')
+
+        # Generate the private key and password file for the root CA.
+        key_file = ca_keygen(ctx, profile, 'root', bits=bits, task_name='root_ca')
+
+        # Generate CSR for the Root CA.
+        if not os.path.isfile(req_file):
+            root_subject = '/'.join([
+                profile.base_subject(),
+                'CN=%s' % profile.cfg['root']['common_name']
+            ])
+
+            with metrics.span('root_ca', 'csr', ca='root'):
+                openssl_req(
+                    ctx,
+                    key_file,
+                    req_file,
+                    config_file=profile.config_file,
+                    extensions=profile.cfg['root']['x509_extensions'],
+                    passin=pass_file,
+                    subj=root_subject,
+                )
+                os.chmod(req_file, 0o444)
+
+        # Self-sign the Root CA.
+        if not os.path.isfile(cert_file):
+            with metrics.span('root_ca', 'selfsign', ca='root'):
+                openssl_ca(
+                    ctx,
+                    'selfsign',
+                    config_file=profile.config_file,
+                    config_name='root',
+                    batch=batch,
+                    days=days,
+                    in_file=req_file,
+                    out_file=cert_file,
+                    passin=pass_file,
+                )
 
-    # Generate the private key and password file for the root CA.
+            # Clean up if not signed.
+            if not os.stat(cert_file).st_size:
+                os.unlink(cert_file)
+                return
+            metrics.incr('certs_signed', ca='root')
+
+            # Generate the initial CRL.
+            if not os.path.isfile(crl_file):
+                gencrl(ctx, profile, 'root', task_name='root_ca')
+        else:
+            sys.stderr.write('Root CA certificate already exists for the %s profile.\n' % profile.name)
+            return
+
+
+def certificate_request(
+        ctx,
+        profile,
+        ca_name,
+        cert_name,
+        bits=None,
+        san=None,
+):
+    """
+    Generates the private key and CSR for a certificate to be issued by the
+    given CA, returning the path to the CSR.
+    """
+    metrics = get_metrics(ctx)
+    ca_dir = os.path.join(profile.dir, ca_name)
+    req_conf = os.path.join(ca_dir, 'reqs', '%s.cnf' % cert_name)
+    req_file = os.path.join(ca_dir, 'reqs', '%s.csr' % cert_name)
+    key_file = os.path.join(profile.private, ca_name, '%s.key' % cert_name)
+
+    # Generate unencrypted private key.
     if not os.path.isfile(key_file):
         if not bits:
             # Use CA's bit setting, or the policy default.
-            bits = profile.cfg['root']['default_bits']
+            bits = profile.cfg[ca_name]['default_bits']
             if bits.startswith('$'):
                 bits = profile.cfg['default']['bits']
-        generate_passfile(ctx, pass_file)
-        generate_keyfile(ctx, key_file, pass_file, bits=int(bits))
+        with metrics.span('certificate', 'keygen', ca=ca_name):
+            generate_keyfile(ctx, key_file, bits=int(bits))
 
-    # Generate CSR for the Root CA.
     if not os.path.isfile(req_file):
-        root_subject = '/'.join([
-            profile.base_subject(),
-            'CN=%s' % profile.cfg['root']['common_name']
-        ])
-
-        openssl_req(
-            ctx,
-            key_file,
-            req_file,
-            config_file=profile.config_file,
-            extensions=profile.cfg['root']['x509_extensions'],
-            passin=pass_file,
-            subj=root_subject,
-        )
-        os.chmod(req_file, 0o444)
-
-    # Self-sign the Root CA.
-    if not os.path.isfile(cert_file):
-        openssl_ca(
-            ctx,
-            'selfsign',
-            config_file=profile.config_file,
-            config_name='root',
-            batch=batch,
-            days=days,
-            in_file=req_file,
-            out_file=cert_file,
-            passin=pass_file,
-        )
+        # Generate config file for CSR request.
+        with metrics.span('certificate', 'req_config', ca=ca_name):
+            with open(req_conf, 'w') as fh:
+                profile.req_cfg(ca_name, cert_name, san).write(fh)
+
+        # Generate the CSR.
+        # The paths include the common name, so quote them for the shell.
+        with metrics.span('certificate', 'csr', ca=ca_name):
+            openssl_req(
+                ctx,
+                shlex.quote(key_file),
+                shlex.quote(req_file),
+                config_file=shlex.quote(req_conf),
+            )
+
+    return req_file
+
+
+def hsm_sign_request(profile, ca_name, req_file, cert_file, days, extensions=None):
+    """
+    Signs the CSR with a CA whose key is on a PKCS#11 token, writing the
+    certificate to `cert_file` unless the CA refuses it.  An `openssl ca`
+    process would log in to the token for every certificate, so it's
+    issued in this process with the pool's sessions instead, updating
+    the CA's database the same way.
+    """
+    with open(req_file, 'r') as fh:
+        try:
+            request = CertificateRequest.from_pem(fh.read())
+        except ValueError as exc:
+            sys.stderr.write('%s\n' % exc)
+            return
+    cert = issue_certificates(profile, ca_name, [request], days, extensions=extensions)[0]
+    if isinstance(cert, ValueError):
+        sys.stderr.write('%s\n' % cert)
+        return
+    with open(cert_file, 'w') as fh:
+        fh.write(cert)
+
 
+def sign_request(
+        ctx,
+        profile,
+        ca_name,
+        req_file,
+        cert_file,
+        batch=False,
+        days=None,
+):
+    """
+    Signs the CSR with the given CA, returning whether the certificate
+    was issued.
+    """
+    metrics = get_metrics(ctx)
+    pass_file = os.path.join(profile.private, ca_name, 'ca.pass')
+    days = days or int(profile.cfg[ca_name]['default_days'])
+
+    with metrics.span('certificate', 'sign', ca=ca_name):
+        if hsm_key_label(profile, ca_name):
+            hsm_sign_request(profile, ca_name, req_file, cert_file, days)
+        else:
+            openssl_ca(
+                ctx,
+                'sign',
+                config_file=profile.config_file,
+                config_name=ca_name,
+                batch=batch,
+                days=days,
+                extensions=profile.cfg[ca_name]['x509_extensions'],
+                in_file=shlex.quote(req_file),
+                out_file=shlex.quote(cert_file),
+                passin=pass_file,
+            )
+
+    if os.path.isfile(cert_file) and os.stat(cert_file).st_size:
+        metrics.incr('certs_signed', ca=ca_name)
+        os.chmod(cert_file, 0o444)
+        return True
+    else:
         # Clean up if not signed.
-        if not os.stat(cert_file).st_size:
+        if os.path.isfile(cert_file):
             os.unlink(cert_file)
-            return
+        return False
+
+
+def gencrl(
+        ctx,
+        profile,
+        ca_name,
+        batch=False,
+        task_name='revoke',
+):
+    """
+    Regenerates the CRL for the given CA.  When the `pki.crl_builder`
+    setting is "stream", the CRL is built with `build_crl` in a single
+    pass over the CA database instead of with `openssl ca -gencrl`.  CAs
+    with keys on a PKCS#11 token always use `build_crl`, signing with a
+    pooled session.
+    """
+    config = ctx.config.get('pki', {})
+    metrics = get_metrics(ctx)
+    crl_file = os.path.join(profile.dir, ca_name, 'ca.crl')
+    pass_file = os.path.join(profile.private, ca_name, 'ca.pass')
 
-        # Generate the initial CRL.
-        if not os.path.isfile(crl_file):
+    with metrics.span(task_name, 'gencrl', ca=ca_name):
+        if hsm_key_label(profile, ca_name):
+            build_crl(profile, ca_name, out_file=crl_file, signer=hsm_signer(profile, ca_name))
+        elif config.get('crl_builder', 'openssl') == 'stream':
+            build_crl(profile, ca_name, out_file=crl_file)
+        else:
             openssl_ca(
                 ctx,
                 'gencrl',
                 config_file=profile.config_file,
-                config_name='root',
+                config_name=ca_name,
+                batch=batch,
                 passin=pass_file,
                 out_file=crl_file,
             )
-    else:
-        sys.stderr.write('Root CA certificate already exists for the %s profile.\n' % profile.name)
-        return
+    metrics.incr('crl_bytes', os.stat(crl_file).st_size, ca=ca_name)
 
 
 @task
@@ -237,55 +436,45 @@ def certificate(
     ca_name = ca_name or config.get('ca_name', None)
     cert_name = common_name or config.get('common_name', None)
 
-    ca_dir = os.path.join(profile.dir, ca_name)
-    cert_file = os.path.join(ca_dir, 'certs', '%s.crt' % cert_name)
-    req_conf = os.path.join(ca_dir, 'reqs', '%s.cnf' % cert_name)
-    req_file = os.path.join(ca_dir, 'reqs', '%s.csr' % cert_name)
-    key_file = os.path.join(profile.private, ca_name, '%s.key' % cert_name)
-    pass_file = os.path.join(profile.private, ca_name, 'ca.pass')
+    if is_ephemeral(profile, ca_name):
+        # Ephemeral certificates are reissued every time, and skip the CSR,
+        # request config and CA database entirely, so they're read and
+        # written through the profile's storage.
+        try:
+            ephemeral_hours(profile, ca_name)
+        except ValueError as exc:
+            sys.stderr.write('%s\n' % exc)
+            sys.exit(os.EX_CONFIG)
+
+        subject = request_subject(profile, ca_name, cert_name)
+        error = validate_requests(profile, ca_name, [(subject, san)])[0]
+        if error:
+            sys.stderr.write('%s\n' % error)
+            sys.exit(os.EX_DATAERR)
+
+        key, csr = ephemeral_request(ctx, profile, ca_name, cert_name, bits=bits, san=san)
+        cert = issue_ephemeral(ctx, profile, ca_name, csr)
+        cert_file = os.path.join(profile.dir, ca_name, 'certs', '%s.crt' % cert_name)
+        key_file = os.path.join(profile.private, ca_name, '%s.key' % cert_name)
+        for path, data, mode in ((key_file, key, 0o400), (cert_file, cert, 0o444)):
+            profile.storage.write(profile.relpath(path), data.encode('ascii'), mode=mode)
+        return
 
-    # Generate unencrypted private key.
-    if not os.path.isfile(key_file):
-        if not bits:
-            # Use CA's bit setting, or the policy default.
-            bits = profile.cfg[ca_name]['default_bits']
-            if bits.startswith('$'):
-                bits = profile.cfg['default']['bits']
-        generate_keyfile(ctx, key_file, bits=int(bits))
+    with profile.workspace() as profile:
+        cert_file = os.path.join(profile.dir, ca_name, 'certs', '%s.crt' % cert_name)
 
-    if not os.path.isfile(req_file):
-        # Generate config file for CSR request.
-        with open(req_conf, 'w') as fh:
-            profile.req_cfg(ca_name, common_name, san).write(fh)
+        # Reject requests `openssl ca` would refuse before generating the key.
+        if not os.path.isfile(cert_file):
+            subject = request_subject(profile, ca_name, cert_name)
+            error = validate_requests(profile, ca_name, [(subject, san)])[0]
+            if error:
+                sys.stderr.write('%s\n' % error)
+                sys.exit(os.EX_DATAERR)
 
-        # Generate the CSR.
-        openssl_req(
-            ctx,
-            key_file,
-            req_file,
-            config_file=req_conf,
-        )
-
-    if not os.path.isfile(cert_file):
-        openssl_ca(
-            ctx,
-            'sign',
-            config_file=profile.config_file,
-            config_name=ca_name,
-            batch=batch,
-            days=days or int(profile.cfg[ca_name]['default_days']),
-            extensions=profile.cfg[ca_name]['x509_extensions'],
-            in_file=req_file,
-            out_file=cert_file,
-            passin=pass_file,
-        )
-
-        if os.stat(cert_file).st_size:
-            os.chmod(cert_file, 0o444)
-        else:
-            # Clean up if not signed.
-            os.unlink(cert_file)
-            return
+        req_file = certificate_request(ctx, profile, ca_name, cert_name, bits=bits, san=san)
+
+        if not os.path.isfile(cert_file):
+            sign_request(ctx, profile, ca_name, req_file, cert_file, batch=batch, days=days)
 
 
 @task(
@@ -303,25 +492,37 @@ def revoke(
     config = ctx.config.get('pki', {})
     ca_name = ca_name or config.get('ca_name', None)
 
-    crl_file = os.path.join(profile.dir, ca_name, 'ca.crl')
-    pass_file = os.path.join(profile.private, ca_name, 'ca.pass')
+    # A certificate in the profile is found by its usual path in the copy
+    # `workspace` makes for other storage.
+    name = profile.relpath(cert_file)
+
+    with profile.workspace() as profile:
+        if name.split('/')[0] != os.pardir:
+            cert_file = os.path.join(profile.base_dir, *name.split('/'))
+
+        pass_file = os.path.join(profile.private, ca_name, 'ca.pass')
+        metrics = get_metrics(ctx)
+
+        with metrics.span('revoke', 'revoke', ca=ca_name):
+            if hsm_key_label(profile, ca_name):
+                # `openssl ca -revoke` loads the CA's key too, logging in to
+                # the token, though it signs nothing.
+                with open(cert_file, 'r') as fh:
+                    try:
+                        revoke_certificate(profile, ca_name, fh.read())
+                    except ValueError as exc:
+                        sys.stderr.write('%s\n' % exc)
+                        sys.exit(os.EX_DATAERR)
+            else:
+                openssl_ca(
+                    ctx,
+                    'revoke',
+                    config_file=profile.config_file,
+                    config_name=ca_name,
+                    batch=batch,
+                    in_file=shlex.quote(cert_file),
+                    passin=pass_file,
+                )
+        metrics.incr('certs_revoked', ca=ca_name)
 
-    openssl_ca(
-        ctx,
-        'revoke',
-        config_file=profile.config_file,
-        config_name=ca_name,
-        batch=batch,
-        in_file=cert_file,
-        passin=pass_file,
-    )
-
-    openssl_ca(
-        ctx,
-        'gencrl',
-        config_file=profile.config_file,
-        config_name=ca_name,
-        batch=batch,
-        passin=pass_file,
-        out_file=crl_file,
-    )
+        gencrl(ctx, profile, ca_name, batch=batch)
@@ -0,0 +1,546 @@
+import base64
+import datetime
+import hashlib
+import os
+import subprocess
+
+from .config import expand
+from .crl import (
+    CACertificate, FileKeySigner, OID_AIA, OID_AKI, OID_CA_ISSUERS, OID_SKI,
+    PEM_RE, RSA_SIGNATURE_OIDS, der_children, der_extension, der_integer,
+    der_oid, der_read, der_sequence, der_time, der_tlv,
+)
+from .hsm import DIGEST_INFO_PREFIXES, hsm_key_label, hsm_signer
+from .validate import (
+    CSR_PEM_RE, NAME_OIDS, OID_EXTENSION_REQUEST, SHORT_NAMES, ca_subject,
+    check_subject, check_unique, csr_request, database_subject, decode_oid,
+    subject_index,
+)
+
+
+# Object identifiers used when building a certificate.
+OID_BASIC_CONSTRAINTS = '2.5.29.19'
+OID_CRL_DISTRIBUTION_POINTS = '2.5.29.31'
+OID_EXT_KEY_USAGE = '2.5.29.37'
+OID_KEY_USAGE = '2.5.29.15'
+OID_NS_CERT_TYPE = '2.16.840.1.113730.1.1'
+OID_RSA_ENCRYPTION = '1.2.840.113549.1.1.1'
+RSA_SIGNATURE_MDS = dict((oid, md) for md, oid in RSA_SIGNATURE_OIDS.items())
+
+# Named bits and key purposes, by the names used in OpenSSL configs.
+KEY_USAGE_BITS = [
+    'digitalSignature', 'nonRepudiation', 'keyEncipherment', 'dataEncipherment',
+    'keyAgreement', 'keyCertSign', 'cRLSign', 'encipherOnly', 'decipherOnly',
+]
+NS_CERT_TYPE_BITS = [
+    'client', 'server', 'email', 'objsign', 'reserved', 'sslCA', 'emailCA', 'objCA',
+]
+EXT_KEY_USAGE_OIDS = {
+    'serverAuth': '1.3.6.1.5.5.7.3.1',
+    'clientAuth': '1.3.6.1.5.5.7.3.2',
+    'codeSigning': '1.3.6.1.5.5.7.3.3',
+    'emailProtection': '1.3.6.1.5.5.7.3.4',
+    'timeStamping': '1.3.6.1.5.5.7.3.8',
+    'OCSPSigning': '1.3.6.1.5.5.7.3.9',
+    'anyExtendedKeyUsage': '2.5.29.37.0',
+}
+
+
+def der_named_bits(names, bits):
+    """
+    Encodes a named BIT STRING, dropping trailing zero bits as DER requires.
+    """
+    positions = []
+    for name in names:
+        if name not in bits:
+            raise Exception('Unsupported bit name: %s.' % name)
+        positions.append(bits.index(name))
+    length = max(positions) + 1
+    encoded = bytearray((length + 7) // 8)
+    for position in positions:
+        encoded[position // 8] |= 0x80 >> (position % 8)
+    return der_tlv(0x03, bytes((len(encoded) * 8 - length,)) + bytes(encoded))
+
+
+def pem_encode(der, label):
+    body = base64.b64encode(der).decode('ascii')
+    return '-----BEGIN %s-----\n%s\n-----END %s-----\n' % (
+        label, '\n'.join(body[i:i + 64] for i in range(0, len(body), 64)), label
+    )
+
+
+def openssl_time(value):
+    """
+    Formats a time the way `openssl x509 -enddate` prints it.
+    """
+    return '%s %2d %s' % (value.strftime('%b'), value.day, value.strftime('%H:%M:%S %Y GMT'))
+
+
+class CertificateRequest:
+    """
+    The fields of a PKCS#10 request that go into a certificate, kept in
+    their DER encoding so they are copied exactly.
+    """
+
+    def __init__(self, der):
+        self.der = der
+        try:
+            _, req_start, req_end = der_read(der)
+            info, algorithm, signature = list(der_children(der, req_start, req_end))[:3]
+            self.info = der[info[1]:info[3]]
+            self.signature_algorithm = self._oid(der, algorithm)
+            self.signature = der[signature[2] + 1:signature[3]]
+
+            # version, subject, subjectPKInfo, attributes.
+            fields = list(der_children(der, info[2], info[3]))
+            self.subject = der[fields[1][1]:fields[1][3]]
+            self.public_key_info = der[fields[2][1]:fields[2][3]]
+            key_algorithm, key = list(der_children(der, fields[2][2], fields[2][3]))[:2]
+            self.key_algorithm = self._oid(der, key_algorithm)
+            # The key's BIT STRING, without its unused bits count.
+            self.public_key = der[key[2] + 1:key[3]]
+
+            self.extensions = []
+            for _, _, attrs_start, attrs_end in [f for f in fields[3:] if f[0] == 0xa0]:
+                for _, _, attr_start, attr_end in der_children(der, attrs_start, attrs_end):
+                    oid, values = list(der_children(der, attr_start, attr_end))[:2]
+                    if decode_oid(der[oid[2]:oid[3]]) != OID_EXTENSION_REQUEST:
+                        continue
+                    for _, _, exts_start, exts_end in der_children(der, values[2], values[3]):
+                        for _, ext_offset, ext_start, ext_end in der_children(der, exts_start, exts_end):
+                            ext_oid = next(der_children(der, ext_start, ext_end))
+                            self.extensions.append(
+                                (decode_oid(der[ext_oid[2]:ext_oid[3]]), der[ext_offset:ext_end])
+                            )
+        except (IndexError, StopIteration, ValueError):
+            raise ValueError('Malformed DER encoding.')
+
+    @staticmethod
+    def _oid(der, algorithm):
+        _, _, start, end = algorithm
+        _, oid_start, oid_end = der_read(der, start)
+        return decode_oid(der[oid_start:oid_end])
+
+    @classmethod
+    def from_pem(cls, pem):
+        match = CSR_PEM_RE.search(pem)
+        if not match:
+            raise ValueError('No certificate request found.')
+        return cls(base64.b64decode(match.group('body')))
+
+    def subject_line(self):
+        """
+        Returns the subject the way `openssl x509 -nameopt compat` prints it.
+        """
+        subject, _ = csr_request(pem_encode(self.der, 'CERTIFICATE REQUEST'))
+        return ''.join('/%s=%s' % (SHORT_NAMES.get(attr, attr), value) for attr, value in subject.items())
+
+    def verify(self):
+        """
+        Checks the request's self-signature, as `openssl x509 -req` does.
+        RSA signatures are checked here and other kinds with `openssl req`.
+        Raises ValueError if the signature doesn't verify.
+        """
+        md = RSA_SIGNATURE_MDS.get(self.signature_algorithm, None)
+        if self.key_algorithm == OID_RSA_ENCRYPTION and md:
+            try:
+                _, rsa_start, rsa_end = der_read(self.public_key)
+                modulus, exponent = [
+                    int.from_bytes(self.public_key[start:end], 'big')
+                    for _, _, start, end in list(der_children(self.public_key, rsa_start, rsa_end))[:2]
+                ]
+            except (IndexError, ValueError):
+                raise ValueError('Malformed DER encoding.')
+            size = (modulus.bit_length() + 7) // 8
+            digest_info = DIGEST_INFO_PREFIXES[md] + hashlib.new(md, self.info).digest()
+            expected = b'\x00\x01' + b'\xff' * (size - len(digest_info) - 3) + b'\x00' + digest_info
+            signature = int.from_bytes(self.signature, 'big')
+            valid = (
+                len(self.signature) == size and signature < modulus and
+                pow(signature, exponent, modulus).to_bytes(size, 'big') == expected
+            )
+        else:
+            # OpenSSL 3.0 exits successfully whether or not it verifies.
+            result = subprocess.run(
+                ['openssl', 'req', '-verify', '-noout', '-inform', 'DER'],
+                input=self.der, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+            )
+            valid = result.returncode == 0 and b'verify OK' in result.stdout
+        if not valid:
+            raise ValueError('The certificate request signature does not verify.')
+
+
+def certificate_extensions(profile, section):
+    """
+    Returns the extensions of one of the profile's x509 extension sections
+    as (oid, critical, value) tuples, in the section's order.  The values
+    of the key identifiers are None, as they depend on the keys, except
+    for an authorityKeyIdentifier that always names the CA's issuer and
+    serial, whose value is 'issuer'.
+
+    Only the extensions and values the profile writes are supported.
+    """
+    exts = []
+    for name, value in profile.cfg[section].items():
+        options = [option.strip() for option in value.split(',')]
+        critical = options[0] == 'critical'
+        if critical:
+            options = options[1:]
+
+        if name == 'keyUsage':
+            exts.append((OID_KEY_USAGE, critical, der_named_bits(options, KEY_USAGE_BITS)))
+        elif name == 'nsCertType':
+            exts.append((OID_NS_CERT_TYPE, critical, der_named_bits(options, NS_CERT_TYPE_BITS)))
+        elif name == 'extendedKeyUsage':
+            if not set(options) <= set(EXT_KEY_USAGE_OIDS):
+                raise Exception('Unsupported extendedKeyUsage: %s.' % value)
+            exts.append((OID_EXT_KEY_USAGE, critical, der_sequence(*[
+                der_oid(EXT_KEY_USAGE_OIDS[option]) for option in options
+            ])))
+        elif name == 'basicConstraints' and options[0] in ('CA:TRUE', 'CA:FALSE'):
+            # CA:FALSE is the default, so DER leaves it out.
+            content = der_tlv(0x01, b'\xff') if options[0] == 'CA:TRUE' else b''
+            for option in options[1:]:
+                if not option.startswith('pathlen:'):
+                    raise Exception('Unsupported basicConstraints: %s.' % value)
+                content += der_integer(int(option.partition(':')[2]))
+            exts.append((OID_BASIC_CONSTRAINTS, critical, der_tlv(0x30, content)))
+        elif name == 'subjectKeyIdentifier' and options == ['hash']:
+            exts.append((OID_SKI, critical, None))
+        elif name == 'authorityKeyIdentifier' and options[0] in ('keyid', 'keyid:always'):
+            # Otherwise, the issuer is only added when the CA has no key
+            # id, which `CertificateBuilder` refuses.
+            exts.append((OID_AKI, critical, 'issuer' if 'issuer:always' in options else None))
+        elif name == 'authorityInfoAccess' and value.startswith('@'):
+            uris = []
+            for key, uri in profile.cfg[value[1:]].items():
+                if not key.startswith('caIssuers;URI'):
+                    raise Exception('Unsupported authorityInfoAccess: %s.' % key)
+                uris.append(expand(profile, uri))
+            exts.append((OID_AIA, critical, der_sequence(*[
+                der_sequence(der_oid(OID_CA_ISSUERS), der_tlv(0x86, uri.encode('ascii')))
+                for uri in uris
+            ])))
+        elif name == 'crlDistributionPoints' and value.startswith('@'):
+            # Each URI in the section is a distribution point of its own.
+            points = []
+            for key, uri in profile.cfg[value[1:]].items():
+                if not key.startswith('URI'):
+                    raise Exception('Unsupported crlDistributionPoints: %s.' % key)
+                name_der = der_tlv(0x86, expand(profile, uri).encode('ascii'))
+                points.append(der_sequence(der_tlv(0xa0, der_tlv(0xa0, name_der))))
+            exts.append((OID_CRL_DISTRIBUTION_POINTS, critical, der_sequence(*points)))
+        else:
+            raise Exception('Unsupported certificate extension: %s = %s.' % (name, value))
+    return exts
+
+
+class CertificateBuilder:
+    """
+    Builds and signs certificates for a CA in-process, so that a key on a
+    PKCS#11 token signs through the pooled sessions of an `HSMSigner`
+    rather than a new `openssl` process logging in every time.
+
+    The result matches `openssl x509 -req -copy_extensions copy`: the
+    request's subject and key are used as they are, and its extensions
+    are copied unless the CA's extension section sets them, ahead of the
+    section's own.  With `requested_last`, the copied extensions follow
+    the section's, as `openssl ca` orders them.  Nothing is recorded in a
+    CA database, see `issue_certificates` for that.
+    """
+
+    def __init__(self, ca_cert, extensions, signer, md='sha256', requested_last=False):
+        self.ca_cert = ca_cert
+        self.extensions = extensions
+        self.signer = signer
+        self.md = md
+        self.requested_last = requested_last
+
+        if md not in RSA_SIGNATURE_OIDS:
+            raise Exception('Unsupported certificate message digest: %s.' % md)
+        if ca_cert.key_id is None and any(oid == OID_AKI for oid, _, _ in extensions):
+            raise Exception('The CA certificate has no subject key identifier.')
+        self.signature_algorithm = der_sequence(
+            der_oid(RSA_SIGNATURE_OIDS[md]), der_tlv(0x05, b'')
+        )
+
+    def encode_extensions(self, request):
+        configured = set(oid for oid, _, _ in self.extensions)
+        requested = [ext for oid, ext in request.extensions if oid not in configured]
+        exts = []
+        for oid, critical, value in self.extensions:
+            if oid == OID_SKI:
+                value = der_tlv(0x04, hashlib.sha1(request.public_key).digest())
+            elif oid == OID_AKI:
+                key_id = der_tlv(0x80, self.ca_cert.key_id)
+                if value == 'issuer':
+                    # The CA's issuer as a directoryName, and its serial.
+                    value = der_sequence(
+                        key_id,
+                        der_tlv(0xa1, der_tlv(0xa4, self.ca_cert.issuer)),
+                        der_tlv(0x82, self.ca_cert.serial),
+                    )
+                else:
+                    value = der_sequence(key_id)
+            exts.append(der_extension(oid, value, critical))
+        if self.requested_last:
+            exts = exts + requested
+        else:
+            exts = requested + exts
+        return der_tlv(0xa3, der_sequence(*exts))
+
+    def build(self, request, serial, not_before, not_after, subject=None):
+        """
+        Returns the DER encoded certificate for a request whose signature
+        has already been verified, with the request's subject unless
+        another DER encoded `subject` is given.
+        """
+        tbs = der_sequence(
+            der_tlv(0xa0, der_integer(2)),
+            der_integer(serial),
+            self.signature_algorithm,
+            self.ca_cert.subject,
+            der_sequence(der_time(not_before), der_time(not_after)),
+            subject or request.subject,
+            request.public_key_info,
+            self.encode_extensions(request),
+        )
+        signature = self.signer(hashlib.new(self.md, tbs).digest(), self.md)
+        if len(signature) != self.ca_cert.signature_size:
+            raise Exception('Unexpected certificate signature length.')
+        return der_sequence(tbs, self.signature_algorithm, der_tlv(0x03, b'\x00' + signature))
+
+
+def build_certificate(profile, ca_name, request, serial, not_before, not_after, signer=None):
+    """
+    Issues a certificate from the CA in the profile with
+    `CertificateBuilder`, signing with the CA's key on its PKCS#11 token
+    or in its key file.  The CA certificate is read through the profile's
+    storage.  Returns the PEM-encoded certificate.
+    """
+    settings = profile.cfg[ca_name]
+    ca_pem = profile.storage.read(profile.relpath(os.path.join(profile.dir, ca_name, 'ca.crt')))
+    builder = CertificateBuilder(
+        CACertificate.from_pem(ca_pem.decode('ascii'), '%s CA certificate' % ca_name),
+        certificate_extensions(profile, settings['x509_extensions']),
+        signer or ca_signer(profile, ca_name),
+        md=expand(profile, settings['default_md']),
+    )
+    der = builder.build(request, serial, not_before, not_after)
+    return pem_encode(der, 'CERTIFICATE')
+
+
+def hex_serial(value):
+    """
+    Formats a serial number the way `openssl ca` writes it to the CA
+    database and serial file: upper case hex, in whole bytes.
+    """
+    serial = '%X' % value
+    return serial.zfill(len(serial) + len(serial) % 2)
+
+
+def database_time(value):
+    """
+    Formats a time as the CA database stores it, the same string its DER
+    encoding holds.
+    """
+    if value.year < 2050:
+        return value.strftime('%y%m%d%H%M%SZ')
+    return value.strftime('%Y%m%d%H%M%SZ')
+
+
+def certificate_serial(pem):
+    """
+    Returns the serial number of a PEM-encoded certificate, formatted like
+    `hex_serial`.
+    """
+    match = PEM_RE.search(pem)
+    if not match:
+        raise ValueError('No certificate found.')
+    der = base64.b64decode(match.group('body'))
+    try:
+        _, cert_start, _ = der_read(der)
+        _, tbs_start, tbs_end = der_read(der, cert_start)
+        fields = list(der_children(der, tbs_start, tbs_end))
+        if fields[0][0] == 0xa0:
+            fields = fields[1:]
+        _, _, start, end = fields[0]
+    except IndexError:
+        raise ValueError('Malformed DER encoding.')
+    return hex_serial(int.from_bytes(der[start:end], 'big'))
+
+
+def policy_subject(request, policy):
+    """
+    Returns the DER encoded subject `openssl ca` gives the certificate for
+    a request when it doesn't preserve the requested one: the request's
+    attributes the policy names, in the policy's order and each in an RDN
+    of its own.  Other attributes are dropped.
+    """
+    der = request.subject
+    attributes = []
+    _, name_start, name_end = der_read(der)
+    for _, _, rdn_start, rdn_end in der_children(der, name_start, name_end):
+        for _, atv_offset, atv_start, atv_end in der_children(der, rdn_start, rdn_end):
+            _, oid_start, oid_end = der_read(der, atv_start)
+            attr = decode_oid(der[oid_start:oid_end])
+            attributes.append((NAME_OIDS.get(attr, attr), der[atv_offset:atv_end]))
+    return der_sequence(*[
+        der_tlv(0x31, atv) for name in policy for attr, atv in attributes if attr == name
+    ])
+
+
+class CADatabase:
+    """
+    The serial file, database and archive of a CA, updated the same way
+    `openssl ca` updates them so the two can take turns issuing from the
+    CA.  Like `openssl ca`, it's not safe for concurrent updates.
+    """
+
+    def __init__(self, profile, ca_name):
+        settings = profile.cfg[ca_name]
+        self.serial_file = expand(profile, settings['serial'])
+        self.database = expand(profile, settings['database'])
+        self.archive = expand(profile, settings['new_certs_dir'])
+
+    @staticmethod
+    def replace(path, data):
+        """
+        Replaces the file's contents, keeping the previous ones in `.old`.
+        """
+        with open(path + '.new', 'w') as fh:
+            fh.write(data)
+        if os.path.isfile(path):
+            os.rename(path, path + '.old')
+        os.rename(path + '.new', path)
+
+    def serial(self):
+        with open(self.serial_file, 'r') as fh:
+            return int(fh.read().strip(), 16)
+
+    def read(self):
+        with open(self.database, 'r') as fh:
+            return fh.read()
+
+    def add(self, certificates, next_serial, unique=True):
+        """
+        Archives the certificates, given as (serial, not_after, subject,
+        pem) tuples, and records them in the database before moving on to
+        the next serial.
+        """
+        rows = []
+        for serial, not_after, subject, pem in certificates:
+            serial = hex_serial(serial)
+            with open(os.path.join(self.archive, '%s.pem' % serial), 'w') as fh:
+                fh.write(pem)
+            rows.append('V\t%s\t\t%s\tunknown\t%s\n' % (database_time(not_after), serial, subject))
+
+        self.replace(self.database, self.read() + ''.join(rows))
+        self.replace(self.database + '.attr', 'unique_subject = %s\n' % ('yes' if unique else 'no'))
+        self.replace(self.serial_file, hex_serial(next_serial) + '\n')
+
+    def revoke(self, serial, reason=None, now=None):
+        """
+        Marks the certificate with the serial as revoked now, recording the
+        reason like `openssl ca -crl_reason` does.  Raises ValueError when
+        the certificate isn't in the database, or is already revoked.
+        """
+        now = now or datetime.datetime.utcnow().replace(microsecond=0)
+        revoked = database_time(now)
+        if reason:
+            revoked += ',' + reason
+
+        rows = self.read().splitlines(True)
+        for i, row in enumerate(rows):
+            fields = row.rstrip('\n').split('\t')
+            if fields[3] != serial:
+                continue
+            if fields[0] == 'R':
+                raise ValueError('Already revoked, serial number %s.' % serial)
+            fields[0], fields[2] = 'R', revoked
+            rows[i] = '\t'.join(fields) + '\n'
+            self.replace(self.database, ''.join(rows))
+            return
+        raise ValueError('No certificate with serial number %s in the CA database.' % serial)
+
+
+def ca_signer(profile, ca_name):
+    """
+    Returns the signer for the CA's key, on its PKCS#11 token or in its
+    key file.
+    """
+    if hsm_key_label(profile, ca_name):
+        return hsm_signer(profile, ca_name)
+    return FileKeySigner(
+        expand(profile, profile.cfg[ca_name]['private_key']),
+        os.path.join(profile.private, ca_name, 'ca.pass'),
+    )
+
+
+def issue_certificates(profile, ca_name, requests, days, extensions=None, signer=None, now=None):
+    """
+    Issues certificates for the `CertificateRequest`s from the CA in the
+    profile with `CertificateBuilder`, as one `openssl ca -infiles`
+    invocation would: the subjects follow the CA's policy, serials come
+    from its serial file and the certificates are archived and recorded
+    in its database.  The extensions are those of the CA's x509 extension
+    section unless another is named.  The CA's files are read and written
+    directly, so the profile must be on the file system (see
+    `PKIProfile.workspace`).
+
+    Returns a PEM-encoded certificate, without the text dump `openssl ca`
+    precedes it with, for each request, or a ValueError when the request
+    doesn't verify or the CA's policy refuses it.
+    """
+    settings = profile.cfg[ca_name]
+    policy = profile.cfg[settings['policy']]
+    issuer = ca_subject(profile, ca_name)
+    index = subject_index(profile, ca_name)
+    database = CADatabase(profile, ca_name)
+
+    builder = CertificateBuilder(
+        CACertificate.from_file(expand(profile, settings['certificate'])),
+        certificate_extensions(profile, extensions or settings['x509_extensions']),
+        signer or ca_signer(profile, ca_name),
+        md=expand(profile, settings['default_md']),
+        requested_last=True,
+    )
+    not_before = now or datetime.datetime.utcnow().replace(microsecond=0)
+    not_after = not_before + datetime.timedelta(days=days)
+
+    serial = database.serial()
+    issued = []
+    results = []
+    seen = set()
+    for request in requests:
+        try:
+            request.verify()
+            subject, _ = csr_request(pem_encode(request.der, 'CERTIFICATE REQUEST'))
+            error = check_subject(subject, policy, issuer) or check_unique(subject, policy, index, seen)
+            if error:
+                raise ValueError(error)
+        except ValueError as exc:
+            results.append(exc)
+            continue
+
+        der = builder.build(
+            request, serial, not_before, not_after, subject=policy_subject(request, policy)
+        )
+        pem = pem_encode(der, 'CERTIFICATE')
+        issued.append((serial, not_after, database_subject(subject, policy), pem))
+        results.append(pem)
+        serial += 1
+
+    if issued:
+        database.add(issued, serial, unique=index.unique)
+    return results
+
+
+def revoke_certificate(profile, ca_name, pem, reason=None, now=None):
+    """
+    Revokes the PEM-encoded certificate in the CA's database, as `openssl
+    ca -revoke` does; the CA's CRL has to be regenerated afterwards.
+    Unlike `openssl ca`, certificates missing from the database are
+    refused rather than added to it.
+    """
+    CADatabase(profile, ca_name).revoke(certificate_serial(pem), reason=reason, now=now)
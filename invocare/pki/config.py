@@ -19,9 +19,16 @@ class CAConfig:
             default_policy_name = 'default_policy'
         self.policy_name = options.get('policy_name', default_policy_name)
 
+        # Keys on a PKCS#11 token are referenced by URI rather than path.
+        self.pkcs11_key = options.get('pkcs11_key', None)
+        if self.pkcs11_key:
+            private_key = 'pkcs11:token=$pkcs11_token;object=%s;type=private' % self.pkcs11_key
+        else:
+            private_key = '$private/%s/ca.key' % self.name
+
         self.settings = OrderedDict((
             ('certificate', '$dir/%s/ca.crt' % self.name),
-            ('private_key', '$private/%s/ca.key' % self.name),
+            ('private_key', private_key),
             ('new_certs_dir', '$dir/%s/archive' % self.name),
             ('serial', '$dir/%s/db/crt.srl' % self.name),
             ('database', '$dir/%s/db/index.txt' % self.name),
@@ -44,7 +51,13 @@ class CAConfig:
             ('prompt', 'no'),
             ('policy', self.policy_name),
             ('x509_extensions', self.x509_ext_name),
+            ('ephemeral', options.get('ephemeral', 'no')),
+            ('ephemeral_hours', options.get('ephemeral_hours', 24)),
+            ('ephemeral_log_bytes', options.get('ephemeral_log_bytes', 16777216)),
+            ('ephemeral_log_count', options.get('ephemeral_log_count', 5)),
         ))
+        if self.pkcs11_key:
+            self.settings['pkcs11_key'] = self.pkcs11_key
 
         self.aia = OrderedDict((
             ('caIssuers;URI.0', '$base_url/%s.crt' % self.name),
@@ -114,8 +127,32 @@ CAPolicies = OrderedDict((
 ))
 
 
+VAR_RE = re.compile(r'\$(\w+)')
+
+
+def expand(profile, value):
+    """
+    Expands `$variable` references in a configuration value using the
+    profile's default section.
+    """
+    return VAR_RE.sub(lambda m: profile.cfg['default'][m.group(1)], value)
+
+
+def escape(value):
+    """
+    Escapes a value for an OpenSSL config file, so that it's taken
+    literally rather than expanding variables or starting a comment.
+    """
+    return re.sub(r'([\\$#"\'`])', r'\\\1', value)
+
+
 class OpenSSLConfig(ConfigParser):
     SECTCRE = re.compile(r'\[ *(?P<header>[^]]+?) *\]')
 
+    def __init__(self, *args, **kwargs):
+        # OpenSSL has its own `$var` syntax; `%` is just a character.
+        kwargs.setdefault('interpolation', None)
+        super().__init__(*args, **kwargs)
+
     def optionxform(self, value):
         return value
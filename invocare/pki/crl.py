@@ -0,0 +1,485 @@
+import base64
+import datetime
+import hashlib
+import os
+import re
+import subprocess
+import tempfile
+
+from .config import expand
+
+
+# Object identifiers used when building a CRL.
+OID_AKI = '2.5.29.35'
+OID_AIA = '1.3.6.1.5.5.7.1.1'
+OID_CA_ISSUERS = '1.3.6.1.5.5.7.48.2'
+OID_CRL_NUMBER = '2.5.29.20'
+OID_CRL_REASON = '2.5.29.21'
+OID_HOLD_INSTRUCTION = '2.5.29.23'
+OID_INVALIDITY_DATE = '2.5.29.24'
+OID_SKI = '2.5.29.14'
+RSA_SIGNATURE_OIDS = {
+    'sha1': '1.2.840.113549.1.1.5',
+    'sha256': '1.2.840.113549.1.1.11',
+    'sha384': '1.2.840.113549.1.1.12',
+    'sha512': '1.2.840.113549.1.1.13',
+}
+
+# CRL reason codes, keyed by the names OpenSSL records in its database.
+REASON_CODES = {
+    'unspecified': 0,
+    'keyCompromise': 1,
+    'keyTime': 1,
+    'CACompromise': 2,
+    'CAkeyTime': 2,
+    'affiliationChanged': 3,
+    'superseded': 4,
+    'cessationOfOperation': 5,
+    'certificateHold': 6,
+    'holdInstruction': 6,
+    'removeFromCRL': 8,
+}
+
+# Hold instructions `openssl ca -crl_hold` accepts by name.
+HOLD_INSTRUCTION_OIDS = {
+    'holdInstructionNone': '1.2.840.10040.2.1',
+    'holdInstructionCallIssuer': '1.2.840.10040.2.2',
+    'holdInstructionReject': '1.2.840.10040.2.3',
+}
+OID_RE = re.compile(r'^\d+(?:\.\d+)+$')
+
+PEM_RE = re.compile(
+    r'-----BEGIN CERTIFICATE-----(?P<body>.+?)-----END CERTIFICATE-----',
+    re.DOTALL
+)
+
+
+## DER encoding
+
+def der_length(length):
+    if length < 0x80:
+        return bytes((length,))
+    encoded = length.to_bytes((length.bit_length() + 7) // 8, 'big')
+    return bytes((0x80 | len(encoded),)) + encoded
+
+
+def der_tlv(tag, content):
+    return bytes((tag,)) + der_length(len(content)) + content
+
+
+def der_integer(value):
+    encoded = value.to_bytes(value.bit_length() // 8 + 1, 'big')
+    return der_tlv(0x02, encoded)
+
+
+def der_hex_integer(value):
+    """
+    Encodes a hexadecimal serial number, as stored in the CA database.
+    """
+    if len(value) % 2:
+        value = '0' + value
+    encoded = bytes.fromhex(value).lstrip(b'\x00') or b'\x00'
+    if encoded[0] & 0x80:
+        encoded = b'\x00' + encoded
+    return der_tlv(0x02, encoded)
+
+
+def der_oid(oid):
+    arcs = [int(arc) for arc in oid.split('.')]
+    encoded = bytearray((arcs[0] * 40 + arcs[1],))
+    for arc in arcs[2:]:
+        chunk = bytearray((arc & 0x7f,))
+        arc >>= 7
+        while arc:
+            chunk.insert(0, 0x80 | (arc & 0x7f))
+            arc >>= 7
+        encoded.extend(chunk)
+    return der_tlv(0x06, bytes(encoded))
+
+
+def der_sequence(*items):
+    return der_tlv(0x30, b''.join(items))
+
+
+def der_time(value):
+    """
+    Encodes a time as a UTCTime until 2050, and a GeneralizedTime after.
+    """
+    if value.year < 2050:
+        return der_tlv(0x17, value.strftime('%y%m%d%H%M%SZ').encode('ascii'))
+    return der_tlv(0x18, value.strftime('%Y%m%d%H%M%SZ').encode('ascii'))
+
+
+def der_db_time(value):
+    """
+    Encodes a time already formatted as it is in the CA database.
+    """
+    if len(value) == 13:
+        return der_tlv(0x17, value.encode('ascii'))
+    return der_tlv(0x18, value.encode('ascii'))
+
+
+def der_extension(oid, value, critical=False):
+    items = [der_oid(oid)]
+    if critical:
+        items.append(der_tlv(0x01, b'\xff'))
+    items.append(der_tlv(0x04, value))
+    return der_sequence(*items)
+
+
+## DER decoding
+
+def der_read(data, offset=0):
+    """
+    Reads the DER element at the offset, returning its tag, the offsets
+    where its content starts and ends.
+    """
+    tag = data[offset]
+    length = data[offset + 1]
+    offset += 2
+    if length & 0x80:
+        num = length & 0x7f
+        length = int.from_bytes(data[offset:offset + num], 'big')
+        offset += num
+    return tag, offset, offset + length
+
+
+def der_children(data, start, end):
+    offset = start
+    while offset < end:
+        tag, content, next_offset = der_read(data, offset)
+        yield tag, offset, content, next_offset
+        offset = next_offset
+
+
+class CACertificate:
+    """
+    The fields of a CA certificate needed to issue CRLs and certificates
+    on its behalf.
+    """
+
+    def __init__(self, der):
+        _, cert_start, cert_end = der_read(der)
+        _, tbs_start, tbs_end = der_read(der, cert_start)
+        fields = list(der_children(der, tbs_start, tbs_end))
+        if fields[0][0] == 0xa0:
+            fields = fields[1:]
+
+        # serialNumber, signature, issuer, validity, subject, subjectPublicKeyInfo.
+        self.serial = der[fields[0][2]:fields[0][3]]
+        self.issuer = der[fields[2][1]:fields[2][3]]
+        self.subject = der[fields[4][1]:fields[4][3]]
+        self.key_id = None
+        self.signature_size = self._signature_size(der, fields[5][2], fields[5][3])
+
+        for tag, _, content, end in fields[6:]:
+            if tag != 0xa3:
+                continue
+            _, exts_start, exts_end = der_read(der, content)
+            for _, _, ext_start, ext_end in der_children(der, exts_start, exts_end):
+                parts = list(der_children(der, ext_start, ext_end))
+                oid = der[parts[0][1]:parts[0][3]]
+                if oid == der_oid(OID_SKI):
+                    # The extension value wraps an OCTET STRING of the key id.
+                    _, key_start, key_end = der_read(der, parts[-1][2])
+                    self.key_id = der[key_start:key_end]
+
+    @staticmethod
+    def _signature_size(der, start, end):
+        # The RSA signature is as long as the modulus in the public key.
+        children = list(der_children(der, start, end))
+        _, _, bits_start, _ = children[1]
+        _, rsa_start, rsa_end = der_read(der, bits_start + 1)
+        _, modulus_start, modulus_end = der_read(der, rsa_start)
+        return len(der[modulus_start:modulus_end].lstrip(b'\x00'))
+
+    @classmethod
+    def from_pem(cls, pem, name='the PEM data'):
+        match = PEM_RE.search(pem)
+        if not match:
+            raise Exception('No certificate found in %s.' % name)
+        return cls(base64.b64decode(match.group('body')))
+
+    @classmethod
+    def from_file(cls, path):
+        with open(path, 'r') as fh:
+            return cls.from_pem(fh.read(), path)
+
+
+## Output
+
+class PEMWriter:
+    """
+    File-like object that PEM encodes the DER written to it as it goes.
+    """
+
+    def __init__(self, fh, label='X509 CRL'):
+        self.fh = fh
+        self.label = label
+        self.buffer = b''
+        self.fh.write(('-----BEGIN %s-----\n' % self.label).encode('ascii'))
+
+    def write(self, data):
+        self.buffer += data
+        # 48 bytes encode to exactly one 64 character line.
+        cut = len(self.buffer) - len(self.buffer) % 48
+        if cut:
+            chunk = base64.b64encode(self.buffer[:cut])
+            self.buffer = self.buffer[cut:]
+            self.fh.write(b'\n'.join(
+                chunk[i:i + 64] for i in range(0, len(chunk), 64)
+            ) + b'\n')
+
+    def close(self):
+        if self.buffer:
+            self.fh.write(base64.b64encode(self.buffer) + b'\n')
+        self.fh.write(('-----END %s-----\n' % self.label).encode('ascii'))
+
+
+class FileKeySigner:
+    """
+    Signs digests with a PEM private key file using `openssl pkeyutl`.
+    """
+
+    def __init__(self, key_file, pass_file=None):
+        self.key_file = key_file
+        self.pass_file = pass_file
+
+    def __call__(self, digest, md):
+        cmd = [
+            'openssl', 'pkeyutl', '-sign',
+            '-inkey', self.key_file,
+            '-pkeyopt', 'digest:%s' % md,
+        ]
+        if self.pass_file:
+            cmd.extend(['-passin', 'file:%s' % self.pass_file])
+        return subprocess.run(
+            cmd, input=digest, stdout=subprocess.PIPE, check=True
+        ).stdout
+
+
+class CRLBuilder:
+    """
+    Builds and signs a CRL from an OpenSSL CA database in a single
+    streaming pass.
+
+    Revoked entries are DER encoded as the database is read and spooled to
+    a temporary file, so memory use does not depend on the number of
+    entries.  The spool is then streamed into both the digest and the
+    output file, and the signature is appended once the digest is done.
+    """
+
+    def __init__(
+            self,
+            ca_cert,
+            database,
+            signer,
+            crl_days=7,
+            md='sha256',
+            crl_number=None,
+            aia_uris=(),
+            spool_dir=None,
+    ):
+        self.ca_cert = ca_cert
+        self.database = database
+        self.signer = signer
+        self.crl_days = crl_days
+        self.md = md
+        self.crl_number = crl_number
+        self.aia_uris = aia_uris
+        self.spool_dir = spool_dir
+        self.revoked = 0
+
+        if md not in RSA_SIGNATURE_OIDS:
+            raise Exception('Unsupported CRL message digest: %s.' % md)
+        self.signature_algorithm = der_sequence(
+            der_oid(RSA_SIGNATURE_OIDS[md]), der_tlv(0x05, b'')
+        )
+        self.reason_extensions = dict(
+            (name, der_extension(OID_CRL_REASON, der_tlv(0x0a, bytes((code,)))))
+            for name, code in REASON_CODES.items()
+        )
+
+    def entry(self, serial, revoked):
+        """
+        Returns the DER encoded revokedCertificates entry for a database row.
+
+        Like `openssl ca -gencrl`, the compromise time recorded with the
+        keyTime and CAkeyTime reasons becomes an invalidityDate extension,
+        and the instruction recorded with holdInstruction a
+        holdInstructionCode extension.
+        """
+        revoked_date, _, reason = revoked.partition(',')
+        content = der_hex_integer(serial) + der_db_time(revoked_date)
+        if reason:
+            reason, _, argument = reason.partition(',')
+            if reason not in self.reason_extensions:
+                raise Exception('Unsupported revocation reason for serial %s: %s.' % (serial, reason))
+            extensions = [self.reason_extensions[reason]]
+            if reason in ('keyTime', 'CAkeyTime'):
+                if not argument:
+                    raise Exception('No compromise time for serial %s.' % serial)
+                extensions.append(der_extension(
+                    OID_INVALIDITY_DATE, der_tlv(0x18, argument.encode('ascii'))
+                ))
+            elif reason == 'holdInstruction':
+                oid = HOLD_INSTRUCTION_OIDS.get(argument, argument)
+                if not OID_RE.match(oid):
+                    raise Exception('Unsupported hold instruction for serial %s: %s.' % (serial, argument))
+                extensions.append(der_extension(OID_HOLD_INSTRUCTION, der_oid(oid)))
+            content += der_sequence(*extensions)
+        return der_tlv(0x30, content)
+
+    def spool_entries(self, spool):
+        """
+        Streams revoked entries from the database into the spool file,
+        returning the total number of bytes written.
+        """
+        total = 0
+        chunk = []
+        with open(self.database, 'r') as fh:
+            for line in fh:
+                if line[0] != 'R':
+                    continue
+                fields = line.split('\t', 4)
+                encoded = self.entry(fields[3], fields[2])
+                chunk.append(encoded)
+                total += len(encoded)
+                self.revoked += 1
+                if len(chunk) >= 4096:
+                    spool.write(b''.join(chunk))
+                    chunk = []
+        spool.write(b''.join(chunk))
+        return total
+
+    def extensions(self):
+        exts = []
+        if self.ca_cert.key_id:
+            exts.append(der_extension(
+                OID_AKI, der_sequence(der_tlv(0x80, self.ca_cert.key_id))
+            ))
+        if self.aia_uris:
+            exts.append(der_extension(OID_AIA, der_sequence(*[
+                der_sequence(der_oid(OID_CA_ISSUERS), der_tlv(0x86, uri.encode('ascii')))
+                for uri in self.aia_uris
+            ])))
+        if self.crl_number is not None:
+            exts.append(der_extension(OID_CRL_NUMBER, der_integer(self.crl_number)))
+        if not exts:
+            return b''
+        return der_tlv(0xa0, der_sequence(*exts))
+
+    def build(self, out_file, der=False, now=None):
+        """
+        Writes the signed CRL to the output file, returning its size.
+        """
+        now = now or datetime.datetime.utcnow().replace(microsecond=0)
+        next_update = now + datetime.timedelta(days=self.crl_days)
+
+        with tempfile.TemporaryFile(dir=self.spool_dir) as spool:
+            revoked_len = self.spool_entries(spool)
+            spool.seek(0)
+
+            tbs_prefix = b''.join((
+                der_integer(1),
+                self.signature_algorithm,
+                self.ca_cert.subject,
+                der_time(now),
+                der_time(next_update),
+            ))
+            if self.revoked:
+                tbs_prefix += b'\x30' + der_length(revoked_len)
+            tbs_suffix = self.extensions()
+            tbs_len = len(tbs_prefix) + revoked_len + len(tbs_suffix)
+            tbs_header = b'\x30' + der_length(tbs_len)
+
+            signature_len = len(der_tlv(0x03, b'\x00' * (self.ca_cert.signature_size + 1)))
+            crl_len = (
+                len(tbs_header) + tbs_len +
+                len(self.signature_algorithm) + signature_len
+            )
+
+            tmp_file = '%s.%d.tmp' % (out_file, os.getpid())
+            with open(tmp_file, 'wb') as fh:
+                writer = fh if der else PEMWriter(fh)
+                digest = hashlib.new(self.md)
+
+                def emit(data):
+                    digest.update(data)
+                    writer.write(data)
+
+                writer.write(b'\x30' + der_length(crl_len))
+                emit(tbs_header)
+                emit(tbs_prefix)
+                while True:
+                    data = spool.read(65536)
+                    if not data:
+                        break
+                    emit(data)
+                emit(tbs_suffix)
+
+                signature = self.signer(digest.digest(), self.md)
+                if len(signature) != self.ca_cert.signature_size:
+                    raise Exception('Unexpected CRL signature length.')
+                writer.write(self.signature_algorithm)
+                writer.write(der_tlv(0x03, b'\x00' + signature))
+                if not der:
+                    writer.close()
+
+            os.rename(tmp_file, out_file)
+        return os.stat(out_file).st_size
+
+
+def build_crl(profile, ca_name, out_file=None, signer=None, der=False):
+    """
+    Generates the CRL for a CA in the profile with `CRLBuilder`, updating
+    the CRL number the same way `openssl ca -gencrl` does.  Returns the
+    size of the CRL in bytes.
+    """
+    settings = profile.cfg[ca_name]
+    md = expand(profile, settings['default_md'])
+    crlnumber_file = expand(profile, settings['crlnumber'])
+
+    if signer is None:
+        signer = FileKeySigner(
+            expand(profile, settings['private_key']),
+            os.path.join(profile.private, ca_name, 'ca.pass'),
+        )
+
+    crl_number = None
+    if os.path.isfile(crlnumber_file):
+        with open(crlnumber_file, 'r') as fh:
+            crl_number = int(fh.read().strip(), 16)
+
+    # Only the extensions in the profile's default CRL extension sections
+    # are supported.
+    aia_uris = []
+    crl_ext = profile.cfg[settings['crl_extensions']]
+    for name in crl_ext:
+        if name == 'authorityInfoAccess':
+            aia = profile.cfg[crl_ext[name].lstrip('@')]
+            aia_uris.extend(
+                expand(profile, uri) for key, uri in aia.items()
+                if key.startswith('caIssuers;URI')
+            )
+        elif name != 'authorityKeyIdentifier':
+            raise Exception('Unsupported CRL extension: %s.' % name)
+
+    builder = CRLBuilder(
+        CACertificate.from_file(expand(profile, settings['certificate'])),
+        expand(profile, settings['database']),
+        signer,
+        crl_days=int(settings['default_crl_days']),
+        md=md,
+        crl_number=crl_number,
+        aia_uris=aia_uris,
+        spool_dir=expand(profile, settings['crl_dir']),
+    )
+    size = builder.build(out_file or expand(profile, settings['crl']), der=der)
+
+    if crl_number is not None:
+        os.rename(crlnumber_file, crlnumber_file + '.old')
+        next_number = '%X' % (crl_number + 1)
+        with open(crlnumber_file, 'w') as fh:
+            fh.write(next_number.zfill(len(next_number) + len(next_number) % 2) + '\n')
+    return size
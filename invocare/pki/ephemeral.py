@@ -0,0 +1,234 @@
+import datetime
+import io
+import os
+import re
+import shlex
+import subprocess
+import time
+
+from contextlib import ExitStack
+from random import SystemRandom
+
+from .hsm import ca_key, hsm_key_label
+from .metrics import get_metrics
+
+
+class EphemeralLog:
+    """
+    Compact append-only log of certificates issued by an ephemeral CA,
+    rotated in the same manner as `logging.handlers.RotatingFileHandler`.
+    Each line holds the issuance time, serial, expiration and subject,
+    separated by tabs.
+    """
+
+    def __init__(self, storage, name, max_bytes=16777216, backup_count=5):
+        self.storage = storage
+        self.name = name
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+
+    def rotate(self):
+        for i in range(self.backup_count - 1, 0, -1):
+            src = '%s.%d' % (self.name, i)
+            if self.storage.exists(src):
+                self.storage.rename(src, '%s.%d' % (self.name, i + 1))
+        if self.backup_count:
+            self.storage.rename(self.name, '%s.1' % self.name)
+        else:
+            self.storage.delete(self.name)
+
+    def append(self, serial, not_after, subject):
+        line = '%d\t%s\t%s\t%s\n' % (int(time.time()), serial, not_after, subject)
+        line = line.encode('utf-8')
+        # Lock the log, as other processes may issue from the same CA.
+        with self.storage.lock(self.name):
+            if (
+                self.max_bytes and self.storage.exists(self.name) and
+                self.storage.size(self.name) + len(line) > self.max_bytes
+            ):
+                self.rotate()
+            self.storage.append(self.name, line)
+
+
+def is_ephemeral(profile, ca_name):
+    """
+    Returns whether the CA in the profile issues ephemeral certificates.
+    """
+    return profile.cfg[ca_name].getboolean('ephemeral', False)
+
+
+_openssl_version = None
+
+
+def openssl_version():
+    """
+    Returns the version of the `openssl` command as a tuple of integers.
+    """
+    global _openssl_version
+    if _openssl_version is None:
+        output = subprocess.run(
+            ['openssl', 'version'], stdout=subprocess.PIPE, universal_newlines=True, check=True
+        ).stdout
+        match = re.search(r'(\d+)\.(\d+)\.(\d+)', output)
+        _openssl_version = tuple(int(part) for part in match.groups()) if match else (0, 0, 0)
+    return _openssl_version
+
+
+def ephemeral_hours(profile, ca_name, hours=None):
+    """
+    Returns the lifetime in hours of certificates from the ephemeral CA,
+    the CA's `ephemeral_hours` unless given.  Raises ValueError when the
+    lifetime can't be issued with the installed OpenSSL, as lifetimes
+    that aren't whole days need `x509 -not_after` from OpenSSL 3.4.
+    CAs with PKCS#11 keys don't use `x509`, so any lifetime will do.
+    """
+    hours = int(hours or profile.cfg[ca_name].get('ephemeral_hours', 24))
+    if hours <= 0:
+        raise ValueError('Ephemeral certificates must be valid for at least an hour.')
+    if hours % 24 and not hsm_key_label(profile, ca_name) and openssl_version() < (3, 4, 0):
+        raise ValueError(
+            'A lifetime of %d hours for the "%s" CA needs OpenSSL 3.4 or later '
+            '(found %s); use a multiple of 24 hours.' % (
+                hours, ca_name, '.'.join(str(part) for part in openssl_version())
+            )
+        )
+    return hours
+
+
+def ephemeral_log(profile, ca_name):
+    """
+    Returns the issuance log for the ephemeral CA.
+    """
+    settings = profile.cfg[ca_name]
+    return EphemeralLog(
+        profile.storage,
+        profile.relpath(os.path.join(profile.dir, ca_name, 'db', 'ephemeral.log')),
+        max_bytes=int(settings.get('ephemeral_log_bytes', 16777216)),
+        backup_count=int(settings.get('ephemeral_log_count', 5)),
+    )
+
+
+def ephemeral_request(ctx, profile, ca_name, common_name, bits=None, san=None):
+    """
+    Generates a private key and CSR in memory for an ephemeral certificate,
+    returning them both as PEM-encoded strings.
+    """
+    if not bits:
+        # Use CA's bit setting, or the policy default.
+        bits = profile.cfg[ca_name]['default_bits']
+        if bits.startswith('$'):
+            bits = profile.cfg['default']['bits']
+
+    # A "/" in the common name would otherwise start another RDN.
+    subject = '/'.join([
+        profile.base_subject(),
+        'OU=%s' % profile.cfg[ca_name]['org_unit'],
+        'CN=%s' % common_name.replace('\\', '\\\\').replace('/', '\\/'),
+    ])
+    cmd = [
+        'openssl req -new -nodes',
+        '-newkey rsa:%d' % int(bits),
+        '-keyout -',
+        '-subj %s' % shlex.quote(subject),
+    ]
+    if san:
+        if isinstance(san, str):
+            san = san.split(',')
+        cmd.append('-addext %s' % shlex.quote('subjectAltName=%s' % ','.join(
+            'DNS:%s' % alt_name for alt_name in san
+        )))
+
+    with get_metrics(ctx).span('certificate', 'ephemeral_csr', ca=ca_name):
+        result = ctx.run(' '.join(cmd), hide=True)
+    key, _, csr = result.stdout.partition('-----BEGIN CERTIFICATE REQUEST-----')
+    return key, '-----BEGIN CERTIFICATE REQUEST-----' + csr
+
+
+def issue_ephemeral(ctx, profile, ca_name, csr, hours=None):
+    """
+    Signs a PEM-encoded CSR with an ephemeral CA and returns the certificate.
+
+    Unlike `openssl ca`, nothing is written to the CA database, archive
+    or request directories: the serial is random and issuance is only
+    recorded in the CA's ephemeral log.  The CA's files are read through
+    the profile's storage, so any storage backend can be used.
+    Certificates valid for a whole number of days work with any OpenSSL 3
+    release, other lifetimes require OpenSSL 3.4 or later (see
+    `ephemeral_hours`).
+
+    CAs with PKCS#11 keys sign in this process with `build_certificate`,
+    reusing the token's pooled sessions, and raise ValueError for CSRs
+    that are malformed or whose signature doesn't verify.
+    """
+    settings = profile.cfg[ca_name]
+    hours = ephemeral_hours(profile, ca_name, hours)
+    md = settings['default_md']
+    if md.startswith('$'):
+        md = profile.cfg['default']['md']
+
+    # Random positive 127-bit serial, as there's no serial file to consult.
+    serial = '%032X' % SystemRandom().getrandbits(127)
+
+    metrics = get_metrics(ctx)
+    if hsm_key_label(profile, ca_name):
+        # An `openssl` process would log in to the token for every
+        # certificate, so sign here with the pool's sessions instead.  The
+        # builder is imported here as it needs `validate`, which needs this
+        # module.
+        from .cert import CertificateRequest, build_certificate, openssl_time
+
+        not_before = datetime.datetime.utcnow().replace(microsecond=0)
+        not_after = not_before + datetime.timedelta(hours=hours)
+        with metrics.span('certificate', 'ephemeral_sign', ca=ca_name):
+            request = CertificateRequest.from_pem(csr)
+            request.verify()
+            cert = build_certificate(
+                profile, ca_name, request, int(serial, 16), not_before, not_after
+            )
+        metrics.incr('certs_signed', ca=ca_name)
+        ephemeral_log(profile, ca_name).append(
+            serial, openssl_time(not_after), request.subject_line()
+        )
+        return cert
+
+    with ExitStack() as stack:
+        def local_path(path):
+            return stack.enter_context(
+                profile.storage.local_path(profile.relpath(path))
+            )
+
+        key = local_path(ca_key(profile, ca_name))
+        config_file = local_path(profile.config_file)
+
+        cmd = [
+            'openssl x509 -req',
+            '-CA %s' % shlex.quote(local_path(os.path.join(profile.dir, ca_name, 'ca.crt'))),
+            '-CAkey %s' % shlex.quote(key),
+            '-passin %s' % shlex.quote(
+                'file:%s' % local_path(os.path.join(profile.private, ca_name, 'ca.pass'))
+            ),
+            '-set_serial 0x%s' % serial,
+            '-extfile %s' % shlex.quote(config_file),
+            '-extensions %s' % settings['x509_extensions'],
+            '-copy_extensions copy',
+            '-%s' % md,
+            '-subject -enddate -nameopt compat',
+        ]
+        if hours % 24:
+            not_after = datetime.datetime.utcnow() + datetime.timedelta(hours=hours)
+            cmd.append('-not_after %s' % not_after.strftime('%Y%m%d%H%M%SZ'))
+        else:
+            cmd.append('-days %d' % (hours // 24))
+
+        with metrics.span('certificate', 'ephemeral_sign', ca=ca_name):
+            result = ctx.run(' '.join(cmd), in_stream=io.StringIO(csr), hide=True)
+        metrics.incr('certs_signed', ca=ca_name)
+
+    fields, _, cert = result.stdout.partition('-----BEGIN CERTIFICATE-----')
+    info = dict(
+        m.groups() for m in re.finditer(r'^(\w+)=(.*)$', fields, re.MULTILINE)
+    )
+    ephemeral_log(profile, ca_name).append(
+        serial, info.get('notAfter', ''), info.get('subject', '')
+    )
+    return '-----BEGIN CERTIFICATE-----' + cert
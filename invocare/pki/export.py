@@ -0,0 +1,222 @@
+import base64
+import os
+import shlex
+import sys
+import tempfile
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+
+from invoke import task
+
+from .crl import PEM_RE
+from .metrics import get_metrics
+from .profile import PKIProfile
+
+
+FORMATS = ('fullchain', 'der', 'p12')
+
+
+class CAChain:
+    """
+    The parsed certificate chain of a CA, from the CA itself up to and
+    including the root.
+    """
+
+    def __init__(self, profile, ca_name):
+        self.ca_name = ca_name
+        self.files = [os.path.join(profile.dir, ca_name, 'ca.crt')]
+        if ca_name != 'root':
+            self.files.append(os.path.join(profile.dir, 'root', 'ca.crt'))
+
+        # Intermediates already have a bundle with the root in it.
+        self.bundle_file = os.path.join(profile.dir, ca_name, 'ca-bundle.crt')
+        if not os.path.isfile(self.bundle_file):
+            self.bundle_file = self.files[0]
+
+        self.mtime = max(os.stat(f).st_mtime for f in self.files)
+        self.pem = ''.join(read_pem(f) for f in self.files)
+
+
+_chains = {}
+_chains_lock = threading.Lock()
+
+
+def ca_chain(profile, ca_name):
+    """
+    Returns the chain for the CA, reusing the cached one unless any of the
+    CA certificates have changed.
+    """
+    mtime = max(
+        os.stat(os.path.join(profile.dir, name, 'ca.crt')).st_mtime
+        for name in set((ca_name, 'root'))
+    )
+    key = (profile.dir, ca_name)
+    with _chains_lock:
+        chain = _chains.get(key, None)
+        if chain is None or chain.mtime != mtime:
+            chain = _chains[key] = CAChain(profile, ca_name)
+        return chain
+
+
+def read_pem(cert_file):
+    """
+    Returns the PEM certificate in the file, without any text `openssl ca`
+    may have written before it.
+    """
+    with open(cert_file, 'r') as fh:
+        match = PEM_RE.search(fh.read())
+    if not match:
+        raise Exception('No certificate found in %s.' % cert_file)
+    return match.group(0) + '\n'
+
+
+def is_stale(out_file, source_mtime):
+    return not os.path.isfile(out_file) or os.stat(out_file).st_mtime < source_mtime
+
+
+def write_file(path, data, mode=0o444):
+    # A unique name, so concurrent exports never share a partial file.
+    fd, tmp_file = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.tmp-')
+    try:
+        with os.fdopen(fd, 'wb') as fh:
+            fh.write(data)
+        os.chmod(tmp_file, mode)
+        os.rename(tmp_file, path)
+    except BaseException:
+        os.unlink(tmp_file)
+        raise
+
+
+def export_certificate(
+        ctx,
+        profile,
+        ca_name,
+        cert_name,
+        formats=FORMATS,
+        pass_file=None,
+):
+    """
+    Exports an issued certificate in the given formats, skipping outputs
+    that are newer than the certificate.  Returns the files written.
+    """
+    metrics = get_metrics(ctx)
+    chain = ca_chain(profile, ca_name)
+    cert_file = os.path.join(profile.dir, ca_name, 'certs', '%s.crt' % cert_name)
+    key_file = os.path.join(profile.private, ca_name, '%s.key' % cert_name)
+    export_dir = os.path.join(profile.dir, ca_name, 'export')
+    source_mtime = max(os.stat(cert_file).st_mtime, chain.mtime)
+
+    outputs = {
+        'fullchain': os.path.join(export_dir, '%s.fullchain.pem' % cert_name),
+        'der': os.path.join(export_dir, '%s.der' % cert_name),
+        # Bundles the private key, so it's kept with the key.
+        'p12': os.path.join(profile.private, ca_name, '%s.p12' % cert_name),
+    }
+
+    written = []
+    pem = None
+    for fmt in formats:
+        out_file = outputs[fmt]
+        if not is_stale(out_file, source_mtime):
+            continue
+
+        with metrics.span('export', fmt, ca=ca_name):
+            if fmt == 'p12':
+                if not os.path.isfile(key_file):
+                    continue
+                # Created 0600, as the bundle holds the private key.
+                fd, tmp_file = tempfile.mkstemp(
+                    dir=os.path.dirname(out_file), prefix='.%s.' % cert_name, suffix='.tmp'
+                )
+                os.close(fd)
+                try:
+                    ctx.run(
+                        'openssl pkcs12 -export -in %s -inkey %s -certfile %s '
+                        '-name %s -passout %s -out %s' % (
+                            shlex.quote(cert_file),
+                            shlex.quote(key_file),
+                            shlex.quote(chain.bundle_file),
+                            shlex.quote(cert_name),
+                            shlex.quote('file:%s' % pass_file if pass_file else 'pass:'),
+                            shlex.quote(tmp_file),
+                        ),
+                        hide=True,
+                    )
+                    os.chmod(tmp_file, 0o400)
+                    os.rename(tmp_file, out_file)
+                finally:
+                    if os.path.exists(tmp_file):
+                        os.unlink(tmp_file)
+            else:
+                pem = pem or read_pem(cert_file)
+                if fmt == 'fullchain':
+                    write_file(out_file, (pem + chain.pem).encode('ascii'))
+                else:
+                    body = pem.split('-----')[2]
+                    write_file(out_file, base64.b64decode(body))
+        written.append(out_file)
+
+    metrics.incr('exports', len(written), ca=ca_name)
+    return written
+
+
+@task(
+    help={
+        'profile': 'The PKI profile of the CA.',
+        'ca_name': 'The name of the CA that issued the certificates.',
+        'common_name': 'The certificate to export, defaults to all of the CA\'s certificates.',
+        'formats': 'Comma-separated formats to export: fullchain, der and p12.',
+        'pass_file': 'The password file used to encrypt PKCS#12 files.',
+        'workers': 'The number of certificates to export in parallel.',
+    }
+)
+def export(
+        ctx,
+        profile=None,
+        ca_name=None,
+        common_name=None,
+        formats=','.join(FORMATS),
+        pass_file=None,
+        workers=None,
+):
+    """
+    Exports issued certificates as full chain PEM, DER and PKCS#12 files.
+    """
+    profile = PKIProfile.from_context(profile, ctx)
+    config = ctx.config.get('pki', {})
+    ca_name = ca_name or config.get('ca_name', None)
+    formats = formats.split(',')
+
+    for fmt in formats:
+        if fmt not in FORMATS:
+            sys.stderr.write('Unknown export format: %s\n' % fmt)
+            sys.exit(os.EX_USAGE)
+
+    with profile.workspace() as profile:
+        certs_dir = os.path.join(profile.dir, ca_name, 'certs')
+        if common_name:
+            cert_names = [common_name]
+        else:
+            cert_names = sorted(
+                name[:-len('.crt')] for name in os.listdir(certs_dir)
+                if name.endswith('.crt')
+            )
+
+        export_dir = os.path.join(profile.dir, ca_name, 'export')
+        if not os.path.isdir(export_dir):
+            os.makedirs(export_dir, 0o755)
+
+        # Parse the chain once up front, rather than in every worker.
+        ca_chain(profile, ca_name)
+
+        with ThreadPoolExecutor(max_workers=workers and int(workers)) as executor:
+            results = executor.map(
+                lambda cert_name: export_certificate(
+                    ctx, profile, ca_name, cert_name, formats=formats, pass_file=pass_file
+                ),
+                cert_names,
+            )
+            count = sum(len(written) for written in results)
+
+        print('Exported %d files for %d certificates.' % (count, len(cert_names)))
@@ -0,0 +1,174 @@
+import os
+import queue
+import threading
+
+from contextlib import contextmanager
+
+from .config import expand
+
+
+# DER encoded DigestInfo prefixes, prepended to a digest for PKCS#1 v1.5.
+DIGEST_INFO_PREFIXES = {
+    'sha1': bytes.fromhex('3021300906052b0e03021a05000414'),
+    'sha256': bytes.fromhex('3031300d060960864801650304020105000420'),
+    'sha384': bytes.fromhex('3041300d060960864801650304020205000430'),
+    'sha512': bytes.fromhex('3051300d060960864801650304020305000440'),
+}
+
+
+class SessionPool:
+    """
+    Pool of logged in sessions on a PKCS#11 token.
+
+    Sessions are opened on demand up to the pool size and then reused, so
+    signing doesn't pay for opening a session and logging in every time.
+    Each session is only used by one thread at a time; concurrent signers
+    are spread across the pool's sessions.
+    """
+
+    def __init__(self, module, token_label, pin, size=4):
+        try:
+            import pkcs11
+        except ImportError:
+            raise Exception(
+                'The `python-pkcs11` package is required for PKCS#11 keys, '
+                'install invocare-pki[pkcs11].'
+            )
+
+        self.pkcs11 = pkcs11
+        self.token = pkcs11.lib(module).get_token(token_label=token_label)
+        self.pin = pin
+        self.size = size
+        self.opened = 0
+        self.idle = queue.Queue()
+        self._lock = threading.Lock()
+
+    def _open(self):
+        return self.token.open(user_pin=self.pin, rw=True)
+
+    @contextmanager
+    def session(self):
+        """
+        Borrows a logged in session from the pool.
+        """
+        try:
+            session = self.idle.get_nowait()
+        except queue.Empty:
+            with self._lock:
+                create = self.opened < self.size
+                if create:
+                    self.opened += 1
+            if create:
+                try:
+                    session = self._open()
+                except Exception:
+                    with self._lock:
+                        self.opened -= 1
+                    raise
+            else:
+                session = self.idle.get()
+
+        try:
+            yield session
+        finally:
+            self.idle.put(session)
+
+    def private_key(self, session, label):
+        return session.get_key(
+            object_class=self.pkcs11.ObjectClass.PRIVATE_KEY, label=label
+        )
+
+    def has_key(self, label):
+        with self.session() as session:
+            try:
+                self.private_key(session, label)
+            except self.pkcs11.NoSuchKey:
+                return False
+        return True
+
+    def generate_key(self, label, bits=4096):
+        """
+        Generates an RSA key pair on the token, stored under the label.
+        """
+        with self.session() as session:
+            session.generate_keypair(
+                self.pkcs11.KeyType.RSA, bits, label=label, store=True
+            )
+
+    def sign_digest(self, label, digest, md):
+        """
+        Returns the PKCS#1 v1.5 signature of a message digest.
+        """
+        with self.session() as session:
+            key = self.private_key(session, label)
+            return key.sign(
+                DIGEST_INFO_PREFIXES[md] + digest,
+                mechanism=self.pkcs11.Mechanism.RSA_PKCS,
+            )
+
+    def close(self):
+        while True:
+            try:
+                session = self.idle.get_nowait()
+            except queue.Empty:
+                break
+            session.close()
+            with self._lock:
+                self.opened -= 1
+
+
+class HSMSigner:
+    """
+    Signs digests with a private key on a PKCS#11 token; a drop-in for
+    `FileKeySigner` when building CRLs.
+    """
+
+    def __init__(self, pool, label):
+        self.pool = pool
+        self.label = label
+
+    def __call__(self, digest, md):
+        return self.pool.sign_digest(self.label, digest, md)
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def hsm_key_label(profile, ca_name):
+    """
+    Returns the label of the CA's key on the PKCS#11 token, or None if the
+    CA uses a key file.
+    """
+    return profile.cfg[ca_name].get('pkcs11_key', None)
+
+
+def ca_key(profile, ca_name):
+    """
+    Returns the CA's private key as given to OpenSSL: either the path to
+    the key file or a PKCS#11 URI.
+    """
+    return expand(profile, profile.cfg[ca_name]['private_key'])
+
+
+def get_pool(profile, ca_name):
+    """
+    Returns the session pool for the token holding the CA's key, logging
+    in with the PIN stored in the CA's passphrase file.
+    """
+    defaults = profile.cfg['default']
+    pass_file = os.path.join(profile.private, ca_name, 'ca.pass')
+    with open(pass_file, 'r') as fh:
+        pin = fh.read().strip()
+
+    key = (defaults['pkcs11_module'], defaults['pkcs11_token'], pin)
+    with _pools_lock:
+        if key not in _pools:
+            _pools[key] = SessionPool(
+                *key, size=int(defaults.get('pkcs11_pool_size', 4))
+            )
+        return _pools[key]
+
+
+def hsm_signer(profile, ca_name):
+    return HSMSigner(get_pool(profile, ca_name), hsm_key_label(profile, ca_name))
@@ -1,8 +1,10 @@
+import io
 import os
 
 from invoke import task
 
-from .profile import PKIProfile
+from .profile import CA_DIRS, PKIProfile
+from .storage import FileSystemStorage
 
 
 @task(
@@ -19,16 +21,43 @@ def initialize(
     Initializes directory structure
     """
     profile = PKIProfile.from_context(profile, ctx)
+    storage = profile.storage
 
-    for ca_name in ('root',) + tuple(sorted(profile.intermediates.keys())):
-        ca_initialize(ctx, profile.dir, ca_name)
-        ca_private = os.path.join(profile.private, ca_name)
-        if not os.path.isdir(ca_private):
-            os.makedirs(ca_private, 0o700)
+    # Write the whole layout at once, which is a single transaction for
+    # SQLite storage.
+    with storage.transaction():
+        for ca_name in ('root',) + tuple(sorted(profile.intermediates.keys())):
+            ca_layout(storage, profile.relpath(profile.dir), ca_name)
+            storage.makedirs(profile.relpath(os.path.join(profile.private, ca_name)), 0o700)
 
-    if not os.path.isfile(profile.config_file):
-        with open(profile.config_file, 'w') as fh:
+        if not profile.initialized():
+            fh = io.StringIO()
             profile.cfg.write(fh)
+            storage.write(profile.relpath(profile.config_file), fh.getvalue().encode('utf-8'))
+
+
+def ca_layout(storage, base_name, name, dir_mode=0o755):
+    """
+    Creates the directories and database files for a CA in the storage,
+    returning the storage name of the CA directory.
+    """
+    ca_dir = '/'.join((base_name, name))
+    for d in ('',) + CA_DIRS:
+        storage.makedirs('/'.join((ca_dir, d)).rstrip('/'), dir_mode)
+
+    database = '/'.join((ca_dir, 'db', 'index.txt'))
+    database_attr = database + '.attr'
+    for f in (database, database_attr):
+        if not storage.exists(f):
+            storage.write(f, b'')
+
+    crlnumber = '/'.join((ca_dir, 'db', 'crl.srl'))
+    serial = '/'.join((ca_dir, 'db', 'crt.srl'))
+    for f in (crlnumber, serial):
+        if not storage.exists(f):
+            storage.write(f, b'01\n')
+
+    return ca_dir
 
 
 @task(
@@ -47,27 +76,5 @@ def ca_initialize(
     """
     Initializes the directory structure for a CA in the given base directory.
     """
-    ca_dir = os.path.join(base_dir, name)
-    certs_dir = os.path.join(ca_dir, 'certs')
-    crl_dir = os.path.join(ca_dir, 'crl')
-    db_dir = os.path.join(ca_dir, 'db')
-    archive_dir = os.path.join(ca_dir, 'archive')
-    reqs_dir = os.path.join(ca_dir, 'reqs')
-
-    for d in (ca_dir, certs_dir, crl_dir, db_dir, archive_dir, reqs_dir):
-        if not os.path.isdir(d):
-            os.makedirs(d, dir_mode)
-
-    database = os.path.join(db_dir, 'index.txt')
-    database_attr = database + '.attr'
-    for f in (database, database_attr):
-        if not os.path.isfile(f):
-            ctx.run('cp /dev/null %s' % f)
-
-    crlnumber = os.path.join(db_dir, 'crl.srl')
-    serial = os.path.join(db_dir, 'crt.srl')
-    for f in (crlnumber, serial):
-        if not os.path.isfile(f):
-            ctx.run('echo %s > %s' % ('01', f))
-
-    return ca_dir
+    ca_layout(FileSystemStorage(base_dir), '.', name, dir_mode)
+    return os.path.join(base_dir, name)
@@ -1,4 +1,5 @@
 import os
+import shlex
 import string
 
 from random import SystemRandom
@@ -6,6 +7,8 @@ from random import SystemRandom
 from invocare.openssl import openssl_genpkey
 from invoke import task
 
+from .metrics import get_metrics
+
 
 @task(
     help={
@@ -61,14 +64,17 @@ def generate_keyfile(
     Generates an OpenSSL RSA private key.
     """
     if not os.path.isfile(key_file):
-        openssl_genpkey(
-            ctx,
-            key_file,
-            algorithm='RSA',
-            cipher=pass_file and cipher,
-            passwd=pass_file,
-            pkeyopt={
-                'rsa_keygen_bits': bits,
-            }
-        )
-        os.chmod(key_file, mode)
+        metrics = get_metrics(ctx)
+        with metrics.span('generate_keyfile', 'genpkey', bits=bits):
+            openssl_genpkey(
+                ctx,
+                shlex.quote(key_file),
+                algorithm='RSA',
+                cipher=pass_file and cipher,
+                passwd=pass_file and shlex.quote(pass_file),
+                pkeyopt={
+                    'rsa_keygen_bits': bits,
+                }
+            )
+            os.chmod(key_file, mode)
+        metrics.incr('keys_generated', bits=bits)
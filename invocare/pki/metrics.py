@@ -0,0 +1,299 @@
+import atexit
+import fcntl
+import json
+import os
+import re
+import tempfile
+import threading
+import time
+
+from collections import OrderedDict
+
+
+SAMPLE_RE = re.compile(r'^(?P<name>[a-zA-Z_:][a-zA-Z0-9_:]*)(?:\{(?P<labels>.*)\})? (?P<value>\S+)$')
+LABEL_RE = re.compile(r'(?P<key>[a-zA-Z_][a-zA-Z0-9_]*)="(?P<value>(?:[^"\\]|\\.)*)"')
+
+
+class _NullSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+class NullMetrics:
+    """
+    Metrics recorder used when instrumentation is disabled; every method
+    is a no-op so the tasks pay only for an attribute lookup.
+    """
+    enabled = False
+    _span = _NullSpan()
+
+    def span(self, task, stage, **labels):
+        return self._span
+
+    def incr(self, name, value=1, **labels):
+        pass
+
+    def exposition(self):
+        return ''
+
+    def flush(self):
+        pass
+
+
+class _Span:
+    def __init__(self, metrics, task, stage, labels):
+        self.metrics = metrics
+        self.task = task
+        self.stage = stage
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.time()
+        self.counter = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        elapsed = time.perf_counter() - self.counter
+        self.metrics._record_span(
+            self.task, self.stage, self.labels, self.start, elapsed,
+            exc_type is None
+        )
+        return False
+
+
+class Metrics:
+    """
+    Records timing spans and counters for PKI tasks.  Events are appended
+    to a JSONL log as they happen, and aggregates are written out in the
+    Prometheus text format (suitable for the node exporter's textfile
+    collector).
+    """
+    enabled = True
+
+    def __init__(self, event_log=None, prometheus_file=None, flush_interval=1.0):
+        self.event_log = event_log
+        self.prometheus_file = prometheus_file
+        self.flush_interval = flush_interval
+        self.samples = OrderedDict()
+        self.types = OrderedDict()
+        # The values already merged into the Prometheus file.
+        self.flushed = {}
+        self._event_fh = None
+        self._last_flush = 0.0
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+
+        atexit.register(self.close)
+
+    def span(self, task, stage, **labels):
+        """
+        Returns a context manager that times the given stage of a task.
+        """
+        return _Span(self, task, stage, labels)
+
+    def incr(self, name, value=1, **labels):
+        """
+        Increments the named counter by the given value.
+        """
+        with self._lock:
+            self._add('pki_%s_total' % name, 'counter', labels, value)
+        self._event(OrderedDict((
+            ('ts', time.time()),
+            ('event', 'counter'),
+            ('name', name),
+            ('value', value),
+        )), labels)
+        self._maybe_flush()
+
+    def _record_span(self, task, stage, labels, start, elapsed, ok):
+        sample_labels = OrderedDict((('task', task), ('stage', stage)))
+        sample_labels.update(labels)
+        with self._lock:
+            self._add('pki_stage_seconds_sum', 'summary', sample_labels, elapsed)
+            self._add('pki_stage_seconds_count', 'summary', sample_labels, 1)
+            if not ok:
+                self._add('pki_stage_errors_total', 'counter', sample_labels, 1)
+        self._event(OrderedDict((
+            ('ts', start),
+            ('event', 'span'),
+            ('task', task),
+            ('stage', stage),
+            ('seconds', elapsed),
+            ('ok', ok),
+        )), labels)
+        self._maybe_flush()
+
+    def _add(self, name, metric_type, labels, value):
+        key = tuple(sorted((k, str(v)) for k, v in labels.items()))
+        family = self.samples.setdefault(name, OrderedDict())
+        family[key] = family.get(key, 0) + value
+        self.types.setdefault(family_name(name), metric_type)
+
+    def _event(self, event, labels):
+        if not self.event_log:
+            return
+        event.update(labels)
+        line = json.dumps(event) + '\n'
+        with self._lock:
+            if self._event_fh is None:
+                self._event_fh = open(self.event_log, 'a')
+            self._event_fh.write(line)
+            self._event_fh.flush()
+
+    def _maybe_flush(self):
+        if not self.prometheus_file or time.time() - self._last_flush < self.flush_interval:
+            return
+        # Don't hold up the caller when another thread is already flushing.
+        if self._flush_lock.acquire(blocking=False):
+            try:
+                if time.time() - self._last_flush >= self.flush_interval:
+                    self._flush()
+            finally:
+                self._flush_lock.release()
+
+    def exposition(self):
+        """
+        Returns this process's aggregates in the Prometheus text format.
+        """
+        with self._lock:
+            return render(self.samples, self.types)
+
+    def flush(self):
+        """
+        Merges this process's new samples into the Prometheus text-format
+        file.
+        """
+        if not self.prometheus_file:
+            return
+        with self._flush_lock:
+            self._flush()
+
+    def _flush(self):
+        # Other processes update the same file, so lock it, re-read it and
+        # only add what has changed here since the last flush.
+        with open(self.prometheus_file + '.lock', 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                samples, types = read_samples(self.prometheus_file)
+                with self._lock:
+                    for name, family in self.samples.items():
+                        merged = samples.setdefault(name, OrderedDict())
+                        for key, value in family.items():
+                            delta = value - self.flushed.get((name, key), 0)
+                            merged[key] = merged.get(key, 0) + delta
+                            self.flushed[(name, key)] = value
+                    for name, metric_type in self.types.items():
+                        types.setdefault(name, metric_type)
+
+                fd, tmp_file = tempfile.mkstemp(
+                    dir=os.path.dirname(os.path.abspath(self.prometheus_file)),
+                    prefix='.pki-', suffix='.prom.tmp',
+                )
+                try:
+                    with os.fdopen(fd, 'w') as fh:
+                        fh.write(render(samples, types))
+                    os.chmod(tmp_file, 0o644)
+                    os.rename(tmp_file, self.prometheus_file)
+                except BaseException:
+                    os.unlink(tmp_file)
+                    raise
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+        self._last_flush = time.time()
+
+    def close(self):
+        self.flush()
+        with self._lock:
+            if self._event_fh is not None:
+                self._event_fh.close()
+                self._event_fh = None
+
+
+def family_name(name):
+    for suffix in ('_sum', '_count'):
+        if name.endswith(suffix):
+            return name[:-len(suffix)]
+    return name
+
+
+def read_samples(prometheus_file):
+    """
+    Reads the samples and metric types from a Prometheus text-format file,
+    which may not exist yet.
+    """
+    samples = OrderedDict()
+    types = OrderedDict()
+    if not os.path.isfile(prometheus_file):
+        return samples, types
+
+    with open(prometheus_file, 'r') as fh:
+        for line in fh:
+            line = line.strip()
+            if line.startswith('# TYPE '):
+                _, _, name, metric_type = line.split(' ', 3)
+                types[name] = metric_type
+                continue
+            match = SAMPLE_RE.match(line)
+            if not match:
+                continue
+            labels = dict(
+                (m.group('key'), m.group('value').replace('\\"', '"').replace('\\\\', '\\'))
+                for m in LABEL_RE.finditer(match.group('labels') or '')
+            )
+            key = tuple(sorted(labels.items()))
+            family = samples.setdefault(match.group('name'), OrderedDict())
+            family[key] = float(match.group('value'))
+    return samples, types
+
+
+def render(samples, types):
+    """
+    Returns samples in the Prometheus text format.
+    """
+    lines = []
+    seen = set()
+    for name, family in samples.items():
+        base_name = family_name(name)
+        if base_name not in seen:
+            seen.add(base_name)
+            lines.append('# TYPE %s %s' % (base_name, types.get(base_name, 'untyped')))
+        for key, value in family.items():
+            if key:
+                labels = ','.join(
+                    '%s="%s"' % (k, v.replace('\\', '\\\\').replace('"', '\\"'))
+                    for k, v in key
+                )
+                lines.append('%s{%s} %s' % (name, labels, repr(value)))
+            else:
+                lines.append('%s %s' % (name, repr(value)))
+    return '\n'.join(lines) + '\n'
+
+
+_null_metrics = NullMetrics()
+_registry = {}
+
+
+def get_metrics(ctx):
+    """
+    Returns the metrics recorder configured for the context under the
+    `pki.metrics` settings, e.g.:
+
+        pki:
+          metrics:
+            event_log: /var/log/pki/events.jsonl
+            prometheus_file: /var/lib/node_exporter/pki.prom
+    """
+    config = ctx.config.get('pki', {}).get('metrics', None)
+    if not config:
+        return _null_metrics
+
+    key = (config.get('event_log', None), config.get('prometheus_file', None))
+    if not any(key):
+        return _null_metrics
+
+    if key not in _registry:
+        _registry[key] = Metrics(*key)
+    return _registry[key]
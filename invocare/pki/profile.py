@@ -1,9 +1,16 @@
 import os
 import sys
+import tempfile
 
 from collections import OrderedDict
+from contextlib import contextmanager
 
-from .config import CAConfig, CAPolicies, OpenSSLConfig
+from .config import CAConfig, CAPolicies, OpenSSLConfig, escape
+from .storage import FileSystemStorage, open_storage
+
+
+# The directories of each CA, which OpenSSL expects to exist.
+CA_DIRS = ('certs', 'crl', 'db', 'archive', 'reqs')
 
 
 class PKIProfile:
@@ -13,16 +20,22 @@ class PKIProfile:
 
     def __init__(self, name, **options):
         self.name = name
+        self.options = options
         self.display_name = options.get('display_name', self.name.capitalize())
         self.base_dir = options.get('base_dir', os.path.curdir)
         self.dir = os.path.join(self.base_dir, self.name)
         self.config_file = os.path.join(self.dir, 'openssl.cnf')
         self.private = os.path.join(self.base_dir, 'private', self.name)
 
-        if os.path.isfile(self.config_file):
+        # Where the profile's files are kept, the base directory by default.
+        self.storage_location = options.get('storage', None) or self.base_dir
+        self.storage = open_storage(self.storage_location)
+
+        if self.initialized():
             self.cfg = OpenSSLConfig()
-            with open(self.config_file, 'r') as fh:
-                self.cfg.read_file(fh)
+            self.cfg.read_string(
+                self.storage.read(self.relpath(self.config_file)).decode('utf-8')
+            )
 
             try:
                 self.dn = self.cfg['dn']
@@ -70,6 +83,18 @@ class PKIProfile:
                 ('private', self.private),
             ))
 
+            # CA keys may be kept on a PKCS#11 token, which OpenSSL accesses
+            # through the pkcs11 provider.
+            pkcs11 = options.get('pkcs11', None)
+            if pkcs11:
+                self.defaults.update((
+                    ('openssl_conf', 'openssl_init'),
+                    ('pkcs11_module', pkcs11['module']),
+                    ('pkcs11_pool_size', pkcs11.get('pool_size', 4)),
+                    ('pkcs11_provider', pkcs11.get('provider', 'pkcs11')),
+                    ('pkcs11_token', pkcs11['token']),
+                ))
+
             dn = options.get('dn', {})
             self.dn = OrderedDict((
                 ('countryName', dn.get('countryName', 'US')),
@@ -82,6 +107,75 @@ class PKIProfile:
 
             self.cfg = self.default_config()
 
+    def relpath(self, path):
+        """
+        Returns the storage name for a path in the profile.
+        """
+        return os.path.relpath(path, self.base_dir).replace(os.sep, '/')
+
+    def initialized(self):
+        """
+        Returns whether the profile's OpenSSL config file has been written.
+        """
+        return self.storage.exists(self.relpath(self.config_file))
+
+    def in_base_dir(self):
+        """
+        Returns whether the profile's files are kept in its base directory.
+        """
+        storage = self.storage
+        return (
+            isinstance(storage, FileSystemStorage) and
+            os.path.abspath(storage.root) == os.path.abspath(self.base_dir)
+        )
+
+    @contextmanager
+    def workspace(self):
+        """
+        Yields the profile with its files in a local directory, for tasks
+        that hand their paths to OpenSSL.  A profile kept in its base
+        directory is yielded as it is.  Otherwise the storage's files are
+        copied out with `Storage.local_tree`, which writes back what the
+        task changes, and a copy of the profile based there is yielded; its
+        OpenSSL config is rewritten to a temporary file so the stored config
+        keeps its paths.
+        """
+        if self.in_base_dir():
+            yield self
+            return
+
+        with self.storage.local_tree() as base_dir:
+            options = dict(self.options, base_dir=base_dir, storage=None)
+            profile = PKIProfile(self.name, **options)
+
+            # Directories that held no files weren't copied.
+            for ca_name in ('root',) + tuple(profile.intermediates):
+                for d in CA_DIRS:
+                    os.makedirs(os.path.join(profile.dir, ca_name, d), 0o755, exist_ok=True)
+                os.makedirs(os.path.join(profile.private, ca_name), 0o700, exist_ok=True)
+
+            for key in ('base_dir', 'dir', 'private'):
+                profile.cfg['default'][key] = getattr(profile, key)
+            fd, profile.config_file = tempfile.mkstemp(prefix='pki-', suffix='.cnf')
+            try:
+                with os.fdopen(fd, 'w') as fh:
+                    profile.cfg.write(fh)
+                yield profile
+            finally:
+                os.unlink(profile.config_file)
+
+    def require_filesystem(self, task_name):
+        """
+        Exits unless the profile's files are kept in its base directory, for
+        long-running tasks that can't work on a copy (see `workspace`).
+        """
+        if not self.in_base_dir():
+            sys.stderr.write(
+                'The %s task requires the files of PKI profile "%s" in its base '
+                'directory, not in "%s" storage.\n' % (task_name, self.name, self.storage_location)
+            )
+            sys.exit(os.EX_CONFIG)
+
     def base_subject(self):
         """
         Returns a base OpenSSL-formatted subject field for the PKI profile.
@@ -146,6 +240,24 @@ class PKIProfile:
         ## Policies
         openssl_config.update(CAPolicies)
 
+        ## Providers
+        if 'pkcs11_module' in self.defaults:
+            openssl_config['openssl_init'] = OrderedDict((
+                ('providers', 'providers'),
+            ))
+            openssl_config['providers'] = OrderedDict((
+                ('default', 'provider_default'),
+                ('pkcs11', 'provider_pkcs11'),
+            ))
+            openssl_config['provider_default'] = OrderedDict((
+                ('activate', 1),
+            ))
+            openssl_config['provider_pkcs11'] = OrderedDict((
+                ('module', '$pkcs11_provider'),
+                ('pkcs11-module-path', '$pkcs11_module'),
+                ('activate', 1),
+            ))
+
         ## X509 Extensions.
 
         # Add special intermediate certificate extension section.
@@ -202,7 +314,7 @@ class PKIProfile:
 
         # Add in the common name and OU for the CA.
         req_cfg['dn'].update({
-            'commonName': common_name,
+            'commonName': escape(common_name),
             'organizationalUnitName': self.cfg[ca_name]['org_unit'],
         })
 
@@ -215,7 +327,7 @@ class PKIProfile:
 
             # TODO: Support different types of SAN entries.
             req_cfg['san'] = OrderedDict([
-                ('DNS.%d' % i, alt_name)
+                ('DNS.%d' % i, escape(alt_name))
                 for i, alt_name in enumerate(san, 1)
             ])
 
@@ -0,0 +1,725 @@
+import asyncio
+import json
+import os
+import re
+import shlex
+import sys
+import tempfile
+
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from invoke import task
+from invoke.exceptions import UnexpectedExit
+
+from .ca import certificate_request, gencrl, sign_request
+from .cert import CertificateRequest, issue_certificates, revoke_certificate
+from .config import expand
+from .ephemeral import ephemeral_hours, ephemeral_request, is_ephemeral, issue_ephemeral
+from .hsm import hsm_key_label
+from .metrics import get_metrics
+from .profile import PKIProfile
+from .validate import csr_request, database_subject, request_subject, validate_requests
+
+
+PEM_CERT_RE = re.compile(
+    r'-----BEGIN CERTIFICATE-----\r?\n.+?-----END CERTIFICATE-----\r?\n?',
+    re.DOTALL
+)
+
+# Revocation reasons accepted by `openssl ca -crl_reason`.
+CRL_REASONS = (
+    'unspecified', 'keyCompromise', 'CACompromise', 'affiliationChanged',
+    'superseded', 'cessationOfOperation', 'certificateHold', 'removeFromCRL',
+)
+
+HTTP_REASONS = {
+    200: 'OK',
+    400: 'Bad Request',
+    404: 'Not Found',
+    405: 'Method Not Allowed',
+    413: 'Payload Too Large',
+    500: 'Internal Server Error',
+}
+
+
+class ServiceError(Exception):
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+
+def pem_certificate(data):
+    """
+    Returns the PEM certificate from a file written by `openssl ca`,
+    without the text dump that precedes it.
+    """
+    match = PEM_CERT_RE.search(data)
+    if not match:
+        raise ServiceError('No certificate found.', 500)
+    return match.group(0)
+
+
+class IssueRequest:
+    """
+    A pending request to sign a CSR with a CA.
+    """
+    kind = 'sign'
+
+    def __init__(self, req_file, cert_file=None, days=None, cleanup=None):
+        self.req_file = req_file
+        self.cert_file = cert_file
+        self.days = days
+        self.cleanup = cleanup
+        self.future = asyncio.get_event_loop().create_future()
+
+
+class RevokeRequest:
+    """
+    A pending request to revoke a certificate issued by a CA.
+    """
+    kind = 'revoke'
+
+    def __init__(self, cert_file, reason='unspecified', cleanup=None):
+        self.cert_file = cert_file
+        self.reason = reason
+        self.cleanup = cleanup
+        self.future = asyncio.get_event_loop().create_future()
+
+
+class CABatcher:
+    """
+    Queues issuance and revocation requests for a single CA, and processes
+    them in batches so that one `openssl ca` invocation signs many CSRs and
+    one CRL is generated for many revocations.  Requests for a CA are only
+    ever processed by a single worker, as the CA database is not safe for
+    concurrent updates.
+    """
+
+    def __init__(self, ctx, profile, ca_name, executor, batch_size=64, batch_wait=0.05):
+        self.ctx = ctx
+        self.profile = profile
+        self.ca_name = ca_name
+        self.executor = executor
+        self.batch_size = batch_size
+        self.batch_wait = batch_wait
+        self.metrics = get_metrics(ctx)
+        self.pass_file = os.path.join(profile.private, ca_name, 'ca.pass')
+        self.queue = asyncio.Queue()
+        self.worker = asyncio.ensure_future(self.run())
+        # Requests for new keys waiting to be validated together.
+        self.unvalidated = []
+
+    async def submit(self, request):
+        await self.queue.put(request)
+        return await request.future
+
+    async def validate(self, subject, san=None):
+        """
+        Rejects a request the CA would refuse to sign, before a new key is
+        generated or a submitted CSR is queued.  Requests arriving within
+        the batch window are checked together, so subjects repeated across
+        them are caught too.
+        """
+        loop = asyncio.get_event_loop()
+        future = loop.create_future()
+        self.unvalidated.append((subject, san, future))
+        if len(self.unvalidated) == 1:
+            loop.call_later(
+                self.batch_wait, lambda: asyncio.ensure_future(self.validate_batch())
+            )
+        error = await future
+        if error:
+            raise ServiceError(error)
+
+    async def validate_batch(self):
+        # Loading the subject index reads the CA database, so it happens on
+        # the executor rather than the event loop.
+        loop = asyncio.get_event_loop()
+        batch, self.unvalidated = self.unvalidated, []
+        try:
+            errors = await loop.run_in_executor(
+                self.executor, validate_requests,
+                self.profile, self.ca_name, [(subject, san) for subject, san, _ in batch],
+            )
+        except Exception as exc:
+            errors = [exc] * len(batch)
+
+        for (_, _, future), error in zip(batch, errors):
+            if future.done():
+                continue
+            if isinstance(error, Exception):
+                future.set_exception(error)
+            else:
+                future.set_result(error)
+
+    async def next_batch(self):
+        loop = asyncio.get_event_loop()
+        batch = [await self.queue.get()]
+        deadline = loop.time() + self.batch_wait
+        while len(batch) < self.batch_size:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def run(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            batch = await self.next_batch()
+            revocations = [r for r in batch if r.kind == 'revoke']
+            issues = [r for r in batch if r.kind == 'sign']
+
+            # Group issuance by validity period, as that applies to
+            # an entire `openssl ca` invocation.
+            groups = OrderedDict()
+            for request in issues:
+                groups.setdefault(request.days, []).append(request)
+
+            for days, requests in groups.items():
+                await self.dispatch(loop, self.sign_batch, requests, days)
+
+            if revocations:
+                await self.dispatch(loop, self.revoke_batch, revocations)
+
+    async def dispatch(self, loop, func, requests, *args):
+        try:
+            results = await loop.run_in_executor(
+                self.executor, func, requests, *args
+            )
+        except Exception as exc:
+            results = [exc] * len(requests)
+
+        for request, result in zip(requests, results):
+            if request.cleanup:
+                request.cleanup()
+            if isinstance(result, Exception):
+                request.future.set_exception(result)
+            else:
+                request.future.set_result(result)
+
+    def ca_command(self, *args):
+        return ' '.join((
+            'openssl ca -batch',
+            '-config %s' % shlex.quote(self.profile.config_file),
+            '-name %s' % shlex.quote(self.ca_name),
+            '-passin %s' % shlex.quote('file:%s' % self.pass_file),
+        ) + args)
+
+    def sign_batch(self, requests, days):
+        """
+        Signs every CSR in the batch with a single `openssl ca` invocation.
+        The certificates are read from the CA's archive, using the entries
+        the batch added to the CA database to tell which CSRs were
+        certified.  Requests are checked against the CA's policy before
+        they're queued, but when `openssl ca` still refuses one it aborts
+        the whole run; then they're signed one at a time, so the failure
+        is isolated to its own request.
+
+        CAs with keys on a PKCS#11 token sign in this process instead, see
+        `hsm_sign_batch`.
+        """
+        days = days or int(self.profile.cfg[self.ca_name]['default_days'])
+        if hsm_key_label(self.profile, self.ca_name):
+            return self.hsm_sign_batch(requests, days)
+        settings = self.profile.cfg[self.ca_name]
+        database = expand(self.profile, settings['database'])
+        archive = expand(self.profile, settings['new_certs_dir'])
+
+        with open(database, 'r') as fh:
+            offset = len(fh.readlines())
+
+        with self.metrics.span('serve', 'sign_batch', ca=self.ca_name):
+            self.ctx.run(
+                self.ca_command(
+                    '-notext',
+                    '-days %d' % days,
+                    '-extensions %s' % settings['x509_extensions'],
+                    '-infiles %s' % ' '.join(shlex.quote(r.req_file) for r in requests),
+                ),
+                hide=True,
+                warn=True,
+            )
+
+        # Entries are (serial, subject), in the order the CSRs were signed.
+        with open(database, 'r') as fh:
+            entries = [
+                (fields[3], fields[5]) for fields in (
+                    line.rstrip('\n').split('\t') for line in fh.readlines()[offset:]
+                )
+            ]
+        if not entries:
+            return [self.sign_one(request, days) for request in requests]
+
+        if len(entries) == len(requests):
+            serials = [serial for serial, _ in entries]
+        else:
+            # Some were refused, so match the rest up by subject.
+            by_subject = OrderedDict()
+            for serial, subject in entries:
+                by_subject.setdefault(subject, []).append(serial)
+            policy = self.profile.cfg[settings['policy']]
+            serials = []
+            for request in requests:
+                try:
+                    with open(request.req_file, 'r') as fh:
+                        subject = database_subject(csr_request(fh.read())[0], policy)
+                except ValueError:
+                    subject = None
+                serials.append(by_subject[subject].pop(0) if by_subject.get(subject) else None)
+
+        results = []
+        for request, serial in zip(requests, serials):
+            if serial is None:
+                results.append(ServiceError('Certificate request was not certified.'))
+                continue
+            with open(os.path.join(archive, '%s.pem' % serial), 'r') as fh:
+                cert = pem_certificate(fh.read())
+            if request.cert_file:
+                with open(request.cert_file, 'w') as fh:
+                    fh.write(cert)
+                os.chmod(request.cert_file, 0o444)
+            results.append(cert)
+
+        self.metrics.incr('certs_signed', len(entries), ca=self.ca_name)
+        return results
+
+    def hsm_sign_batch(self, requests, days):
+        """
+        Signs the batch with `issue_certificates`, which uses the token's
+        pooled sessions rather than an `openssl ca` process logging in, and
+        records the certificates in the CA's database the same way.  A
+        refused request doesn't affect the rest of the batch.
+        """
+        parsed = []
+        for request in requests:
+            with open(request.req_file, 'r') as fh:
+                try:
+                    parsed.append(CertificateRequest.from_pem(fh.read()))
+                except ValueError as exc:
+                    parsed.append(exc)
+
+        with self.metrics.span('serve', 'sign_batch', ca=self.ca_name):
+            certs = iter(issue_certificates(
+                self.profile, self.ca_name,
+                [r for r in parsed if not isinstance(r, ValueError)], days,
+            ))
+
+        results = []
+        for request, parsed_request in zip(requests, parsed):
+            cert = parsed_request if isinstance(parsed_request, ValueError) else next(certs)
+            if isinstance(cert, ValueError):
+                results.append(ServiceError('Certificate request was not certified: %s' % cert))
+                continue
+            if request.cert_file:
+                with open(request.cert_file, 'w') as fh:
+                    fh.write(cert)
+                os.chmod(request.cert_file, 0o444)
+            results.append(cert)
+
+        signed = sum(1 for result in results if isinstance(result, str))
+        if signed:
+            self.metrics.incr('certs_signed', signed, ca=self.ca_name)
+        return results
+
+    def sign_one(self, request, days):
+        cert_file = request.cert_file
+        if not cert_file:
+            fd, cert_file = tempfile.mkstemp(prefix='pki-', suffix='.crt')
+            os.close(fd)
+        try:
+            if not sign_request(
+                    self.ctx, self.profile, self.ca_name,
+                    request.req_file, cert_file, batch=True, days=days):
+                return ServiceError('Certificate request was not certified.')
+            with open(cert_file, 'r') as fh:
+                return pem_certificate(fh.read())
+        except UnexpectedExit as exc:
+            # OpenSSL's output names the CA's files, so it's only logged.
+            sys.stderr.write(exc.result.stderr)
+            return ServiceError('Certificate request was not certified.')
+        except Exception as exc:
+            return exc
+        finally:
+            if not request.cert_file and os.path.isfile(cert_file):
+                os.unlink(cert_file)
+
+    def revoke_batch(self, requests):
+        """
+        Revokes every certificate in the batch, then generates a single CRL.
+        CAs with keys on a PKCS#11 token update their database in this
+        process, as `openssl ca -revoke` would log in to the token.
+        """
+        hsm = hsm_key_label(self.profile, self.ca_name)
+        results = []
+        for request in requests:
+            with self.metrics.span('serve', 'revoke', ca=self.ca_name):
+                if hsm:
+                    try:
+                        with open(request.cert_file, 'r') as fh:
+                            revoke_certificate(
+                                self.profile, self.ca_name, fh.read(), reason=request.reason
+                            )
+                        error = None
+                    except ValueError as exc:
+                        error = str(exc)
+                else:
+                    result = self.ctx.run(
+                        self.ca_command(
+                            '-revoke %s' % shlex.quote(request.cert_file),
+                            '-crl_reason %s' % shlex.quote(request.reason),
+                        ),
+                        hide=True,
+                        warn=True,
+                    )
+                    error = None if result.ok else result.stderr.strip() or 'Revocation failed.'
+            if error is None:
+                self.metrics.incr('certs_revoked', ca=self.ca_name)
+                results.append(True)
+            else:
+                results.append(ServiceError(error))
+
+        if any(r is True for r in results):
+            gencrl(self.ctx, self.profile, self.ca_name, batch=True, task_name='serve')
+        return results
+
+
+class IssuanceService:
+    """
+    Asynchronous HTTP service for issuing and revoking certificates with
+    the CAs of a PKI profile.
+    """
+
+    def __init__(self, ctx, profile, workers=None, batch_size=64, batch_wait=0.05, max_body=65536):
+        self.ctx = ctx
+        self.profile = profile
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.batch_size = batch_size
+        self.batch_wait = batch_wait
+        self.max_body = max_body
+        self.metrics = get_metrics(ctx)
+        self.batchers = {}
+        # Issuance of new certificates in flight, by CA and common name.
+        self.pending = {}
+
+    def batcher(self, ca_name):
+        if ca_name not in self.profile.intermediates:
+            raise ServiceError('No configuration for "%s" intermediate CA.' % ca_name)
+        if ca_name not in self.batchers:
+            self.batchers[ca_name] = CABatcher(
+                self.ctx, self.profile, ca_name, self.executor,
+                batch_size=self.batch_size, batch_wait=self.batch_wait,
+            )
+        return self.batchers[ca_name]
+
+    def validate(self, ca_name, body):
+        """
+        Rejects a request for a new ephemeral key and CSR that breaks the
+        CA's policy, before the key is generated.  Ephemeral CAs keep no
+        database, so there are no other requests to check it against.
+        """
+        subject = request_subject(self.profile, ca_name, body['common_name'])
+        error = validate_requests(self.profile, ca_name, [(subject, body.get('san', None))])[0]
+        if error:
+            raise ServiceError(error)
+
+    @staticmethod
+    def integer(body, name):
+        """
+        Returns the named positive integer from the request body, or None.
+        """
+        value = body.get(name, None)
+        if value is None:
+            return None
+        try:
+            value = int(value)
+        except (TypeError, ValueError):
+            raise ServiceError('Invalid %s: %r.' % (name, value))
+        if value <= 0:
+            raise ServiceError('Invalid %s: %r.' % (name, value))
+        return value
+
+    @staticmethod
+    def spool(data, suffix):
+        """
+        Writes submitted PEM data to a temporary file, returning its path and
+        a callable that removes it.
+        """
+        fd, path = tempfile.mkstemp(prefix='pki-', suffix=suffix)
+        with os.fdopen(fd, 'w') as fh:
+            fh.write(data)
+        return path, lambda: os.unlink(path)
+
+    async def issue_ephemeral(self, ca_name, body):
+        """
+        Issues from an ephemeral CA; there's no CA database to serialize
+        on, so signing happens straight away on the executor.
+        """
+        loop = asyncio.get_event_loop()
+        try:
+            hours = ephemeral_hours(self.profile, ca_name, self.integer(body, 'hours'))
+        except ValueError as exc:
+            raise ServiceError(str(exc))
+
+        key = None
+        csr = body.get('csr')
+        if csr:
+            # `x509 -req` enforces no policy, and copies the CSR's subject
+            # and SANs as they are.
+            try:
+                subject, san = csr_request(csr)
+            except ValueError as exc:
+                raise ServiceError('Invalid certificate request: %s' % exc)
+            error = validate_requests(self.profile, ca_name, [(subject, san)])[0]
+            if error:
+                raise ServiceError(error)
+        else:
+            if not body.get('common_name'):
+                raise ServiceError('A CSR or a common name must be provided.')
+            self.validate(ca_name, body)
+            key, csr = await loop.run_in_executor(
+                self.executor, ephemeral_request,
+                self.ctx, self.profile, ca_name, body['common_name'],
+                self.integer(body, 'bits'), body.get('san', None),
+            )
+        try:
+            cert = await loop.run_in_executor(
+                self.executor, issue_ephemeral,
+                self.ctx, self.profile, ca_name, csr, hours,
+            )
+        except ValueError as exc:
+            # CSRs signed in-process for PKCS#11 keys are verified there.
+            raise ServiceError('Invalid certificate request: %s' % exc)
+        return cert, key
+
+    async def issue(self, body):
+        ca_name = body.get('ca_name')
+        if ca_name in self.profile.intermediates and is_ephemeral(self.profile, ca_name):
+            return await self.issue_ephemeral(ca_name, body)
+
+        batcher = self.batcher(ca_name)
+        days = self.integer(body, 'days')
+
+        if body.get('csr'):
+            # A CSR `openssl ca` refuses would abort the batch it's in.
+            try:
+                subject, san = csr_request(body['csr'])
+            except ValueError as exc:
+                raise ServiceError('Invalid certificate request: %s' % exc)
+            await batcher.validate(subject, san)
+            req_file, cleanup = self.spool(body['csr'], '.csr')
+            cert = await batcher.submit(IssueRequest(req_file, days=days, cleanup=cleanup))
+            return cert, None
+
+        cert_name = body.get('common_name')
+        if not cert_name or os.sep in cert_name:
+            raise ServiceError('A CSR or a valid common name must be provided.')
+
+        cert_file = os.path.join(
+            self.profile.dir, batcher.ca_name, 'certs', '%s.crt' % cert_name
+        )
+        if os.path.isfile(cert_file):
+            with open(cert_file, 'r') as fh:
+                return pem_certificate(fh.read()), None
+
+        # Concurrent requests for the same new certificate share one
+        # issuance, as they'd use the same key and CSR files.
+        key = (batcher.ca_name, cert_name)
+        if key not in self.pending:
+            self.pending[key] = asyncio.ensure_future(self.issue_new(
+                batcher, cert_name, cert_file, days, self.integer(body, 'bits'), body.get('san', None)
+            ))
+            self.pending[key].add_done_callback(lambda _: self.pending.pop(key, None))
+        # Shielded, so a client going away doesn't cancel it for the others.
+        cert = await asyncio.shield(self.pending[key])
+        return cert, None
+
+    async def issue_new(self, batcher, cert_name, cert_file, days, bits, san):
+        await batcher.validate(
+            request_subject(self.profile, batcher.ca_name, cert_name), san
+        )
+        # Key generation and the CSR are CPU-bound, keep them off the loop.
+        req_file = await asyncio.get_event_loop().run_in_executor(
+            self.executor, certificate_request,
+            self.ctx, self.profile, batcher.ca_name, cert_name, bits, san,
+        )
+        return await batcher.submit(IssueRequest(req_file, cert_file=cert_file, days=days))
+
+    async def revoke(self, body):
+        batcher = self.batcher(body.get('ca_name'))
+        if is_ephemeral(self.profile, batcher.ca_name):
+            raise ServiceError('Ephemeral certificates cannot be revoked.')
+        reason = body.get('reason', 'unspecified')
+        if reason not in CRL_REASONS:
+            raise ServiceError('Invalid revocation reason: %r.' % (reason,))
+        cleanup = None
+        if body.get('certificate'):
+            cert_file, cleanup = self.spool(body['certificate'], '.crt')
+        elif body.get('serial'):
+            serial = body['serial'].upper()
+            if not re.match(r'^[0-9A-F]+$', serial):
+                raise ServiceError('Invalid serial number.')
+            cert_file = os.path.join(
+                self.profile.dir, batcher.ca_name, 'archive', '%s.pem' % serial
+            )
+            if not os.path.isfile(cert_file):
+                raise ServiceError('No certificate with serial %s.' % serial, 404)
+        else:
+            raise ServiceError('A certificate or serial number must be provided.')
+        return await batcher.submit(RevokeRequest(cert_file, reason=reason, cleanup=cleanup))
+
+    async def route(self, method, path, body):
+        if path == '/metrics':
+            if method != 'GET':
+                raise ServiceError('Method not allowed.', 405)
+            return 200, 'text/plain; version=0.0.4', self.metrics.exposition()
+
+        handlers = {
+            '/certificate': self.issue,
+            '/revoke': self.revoke,
+        }
+        if path not in handlers:
+            raise ServiceError('Not found.', 404)
+        if method != 'POST':
+            raise ServiceError('Method not allowed.', 405)
+
+        try:
+            payload = json.loads(body.decode('utf-8') or '{}')
+        except ValueError:
+            raise ServiceError('Request body is not valid JSON.')
+        if not isinstance(payload, dict):
+            raise ServiceError('Request body must be a JSON object.')
+
+        result = await handlers[path](payload)
+        if path == '/certificate':
+            cert, key = result
+            content = {'certificate': cert}
+            if key:
+                content['private_key'] = key
+        else:
+            content = {'revoked': result}
+        return 200, 'application/json', json.dumps(content)
+
+    async def handle(self, reader, writer):
+        """
+        Handles an HTTP/1.1 connection, which may carry several requests.
+        """
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                try:
+                    method, path, version = request_line.decode('latin-1').split()
+                except ValueError:
+                    break
+
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+
+                keep_alive = (
+                    version == 'HTTP/1.1' and
+                    headers.get('connection', '').lower() != 'close'
+                )
+
+                try:
+                    length = int(headers.get('content-length', 0))
+                    if length > self.max_body:
+                        keep_alive = False
+                        raise ServiceError('Request body too large.', 413)
+                    body = await reader.readexactly(length) if length else b''
+                    status, content_type, content = await self.route(
+                        method, path.split('?', 1)[0], body
+                    )
+                except ServiceError as exc:
+                    status, content_type = exc.status, 'application/json'
+                    content = json.dumps({'error': str(exc)})
+                except Exception as exc:
+                    status, content_type = 500, 'application/json'
+                    content = json.dumps({'error': str(exc)})
+
+                data = content.encode('utf-8')
+                writer.write(('\r\n'.join((
+                    'HTTP/1.1 %d %s' % (status, HTTP_REASONS.get(status, '')),
+                    'Content-Type: %s' % content_type,
+                    'Content-Length: %d' % len(data),
+                    'Connection: %s' % ('keep-alive' if keep_alive else 'close'),
+                    '', '',
+                ))).encode('latin-1') + data)
+                await writer.drain()
+
+                if not keep_alive:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, host, port):
+        server = await asyncio.start_server(self.handle, host, port)
+        sys.stderr.write('Serving PKI profile "%s" on %s:%d.\n' % (self.profile.name, host, port))
+        async with server:
+            await server.serve_forever()
+
+
+@task(
+    help={
+        'profile': 'The PKI profile to issue certificates from.',
+        'host': 'The address to listen on, defaults to 127.0.0.1.',
+        'port': 'The port to listen on, defaults to 8080.',
+        'workers': 'The number of threads for key generation and signing.',
+        'batch_size': 'The maximum number of requests signed at once, defaults to 64.',
+        'batch_wait': 'Seconds to wait for a signing batch to fill, defaults to 0.05.',
+    }
+)
+def serve(
+        ctx,
+        profile=None,
+        host='127.0.0.1',
+        port=8080,
+        workers=None,
+        batch_size=64,
+        batch_wait=0.05,
+):
+    """
+    Runs an HTTP service that issues and revokes certificates in batches.
+    """
+    profile = PKIProfile.from_context(profile, ctx)
+
+    if not profile.initialized():
+        sys.stderr.write('PKI profile "%s" has not been initialized.\n' % profile.name)
+        sys.exit(os.EX_CONFIG)
+
+    # Catch CAs that can't be served before serving anything.
+    for ca_name in profile.intermediates:
+        if not is_ephemeral(profile, ca_name):
+            # Batches are signed by `openssl ca` for as long as the service
+            # runs, too often to copy the profile out with `workspace`.
+            profile.require_filesystem('serve')
+        else:
+            try:
+                ephemeral_hours(profile, ca_name)
+            except ValueError as exc:
+                sys.stderr.write('%s\n' % exc)
+                sys.exit(os.EX_CONFIG)
+
+    service = IssuanceService(
+        ctx,
+        profile,
+        workers=workers and int(workers),
+        batch_size=int(batch_size),
+        batch_wait=float(batch_wait),
+    )
+    try:
+        asyncio.run(service.serve(host, int(port)))
+    except KeyboardInterrupt:
+        pass
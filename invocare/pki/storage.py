@@ -0,0 +1,382 @@
+import fcntl
+import os
+import shutil
+import sqlite3
+import stat
+import tempfile
+import threading
+import time
+
+from contextlib import contextmanager
+
+
+class Storage:
+    """
+    Base class for the storage backing a PKI profile.  Files are named by
+    '/'-separated paths relative to the profile's base directory.
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+
+    def read(self, name):
+        raise NotImplementedError
+
+    def write(self, name, data, mode=0o644):
+        raise NotImplementedError
+
+    def append(self, name, data):
+        raise NotImplementedError
+
+    def exists(self, name):
+        raise NotImplementedError
+
+    def size(self, name):
+        raise NotImplementedError
+
+    def delete(self, name):
+        raise NotImplementedError
+
+    def rename(self, src, dst):
+        raise NotImplementedError
+
+    def list(self, prefix=''):
+        raise NotImplementedError
+
+    def makedirs(self, name, mode=0o755):
+        """
+        Creates a directory; only meaningful for storage with directories.
+        """
+        pass
+
+    @contextmanager
+    def transaction(self):
+        """
+        Groups writes so they're applied together, e.g., in one SQLite
+        transaction.
+        """
+        with self._lock:
+            yield self
+
+    @contextmanager
+    def lock(self, name):
+        """
+        Exclusive lock for read-modify-write sequences on the named file.
+        """
+        with self._lock:
+            yield
+
+    @contextmanager
+    def local_path(self, name, writable=False):
+        """
+        Yields a filesystem path holding the named file, for handing to
+        OpenSSL.  Backends without a filesystem copy the data to a private
+        temporary file, and copy it back afterwards when `writable`.
+        """
+        fd, path = tempfile.mkstemp(prefix='pki-')
+        try:
+            with os.fdopen(fd, 'wb') as fh:
+                if self.exists(name):
+                    fh.write(self.read(name))
+            yield path
+            if writable:
+                with open(path, 'rb') as fh:
+                    self.write(name, fh.read(), mode=0o600)
+        finally:
+            os.unlink(path)
+
+    @contextmanager
+    def local_tree(self):
+        """
+        Yields a directory holding every file in the storage, for tasks that
+        hand many paths to OpenSSL.  Backends without a filesystem copy the
+        files to a private temporary directory, and write back the ones the
+        task adds, changes or removes when it completes.  The storage stays
+        in a transaction meanwhile, so other writers wait rather than lose
+        their updates.
+        """
+        root = tempfile.mkdtemp(prefix='pki-')
+        try:
+            with self.transaction():
+                saved = {}
+                for name in self.list():
+                    path = os.path.join(root, *name.split('/'))
+                    os.makedirs(os.path.dirname(path), 0o755, exist_ok=True)
+                    saved[name] = self.read(name)
+                    with open(path, 'wb') as fh:
+                        fh.write(saved[name])
+
+                yield root
+
+                local = FileSystemStorage(root)
+                names = local.list()
+                for name in names:
+                    data = local.read(name)
+                    if saved.get(name, None) != data:
+                        mode = stat.S_IMODE(os.stat(local.path(name)).st_mode)
+                        self.write(name, data, mode=mode)
+                for name in sorted(set(saved).difference(names)):
+                    self.delete(name)
+        finally:
+            shutil.rmtree(root)
+
+
+class FileSystemStorage(Storage):
+    """
+    Storage in a local directory tree, the layout OpenSSL itself uses.
+    """
+
+    def __init__(self, root):
+        super().__init__()
+        self.root = root
+
+    def path(self, name):
+        return os.path.join(self.root, *name.split('/'))
+
+    def read(self, name):
+        with open(self.path(name), 'rb') as fh:
+            return fh.read()
+
+    def write(self, name, data, mode=0o644):
+        path = self.path(name)
+        # A unique name, so concurrent writers never share a partial file.
+        fd, tmp_file = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.tmp-')
+        try:
+            with os.fdopen(fd, 'wb') as fh:
+                fh.write(data)
+            os.chmod(tmp_file, mode)
+            os.rename(tmp_file, path)
+        except BaseException:
+            os.unlink(tmp_file)
+            raise
+
+    def append(self, name, data):
+        with open(self.path(name), 'ab') as fh:
+            fh.write(data)
+
+    def exists(self, name):
+        return os.path.isfile(self.path(name))
+
+    def size(self, name):
+        return os.stat(self.path(name)).st_size
+
+    def delete(self, name):
+        os.unlink(self.path(name))
+
+    def rename(self, src, dst):
+        os.rename(self.path(src), self.path(dst))
+
+    def list(self, prefix=''):
+        names = []
+        for dir_path, _, file_names in os.walk(self.path(prefix)):
+            for file_name in file_names:
+                if file_name.endswith('.lock'):
+                    # Made by `lock`, they aren't part of the profile.
+                    continue
+                path = os.path.relpath(os.path.join(dir_path, file_name), self.root)
+                names.append(path.replace(os.sep, '/'))
+        return sorted(names)
+
+    def makedirs(self, name, mode=0o755):
+        path = self.path(name)
+        if not os.path.isdir(path):
+            os.makedirs(path, mode)
+
+    @contextmanager
+    def lock(self, name):
+        # Other processes may be using the same files.
+        with open(self.path(name) + '.lock', 'a') as fh:
+            fcntl.flock(fh, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(fh, fcntl.LOCK_UN)
+
+    @contextmanager
+    def local_path(self, name, writable=False):
+        yield self.path(name)
+
+    @contextmanager
+    def local_tree(self):
+        yield self.root
+
+
+class MemoryStorage(Storage):
+    """
+    Storage kept in a dictionary, for tests and ephemeral CAs.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.files = {}
+
+    def read(self, name):
+        try:
+            return self.files[name][0]
+        except KeyError:
+            raise FileNotFoundError(name)
+
+    def write(self, name, data, mode=0o644):
+        with self._lock:
+            self.files[name] = (bytes(data), mode)
+
+    def append(self, name, data):
+        with self._lock:
+            existing, mode = self.files.get(name, (b'', 0o644))
+            self.files[name] = (existing + data, mode)
+
+    def exists(self, name):
+        return name in self.files
+
+    def size(self, name):
+        return len(self.read(name))
+
+    def delete(self, name):
+        with self._lock:
+            del self.files[name]
+
+    def rename(self, src, dst):
+        with self._lock:
+            if src not in self.files:
+                raise FileNotFoundError(src)
+            self.files[dst] = self.files.pop(src)
+
+    def list(self, prefix=''):
+        return sorted(name for name in self.files if name.startswith(prefix))
+
+    @contextmanager
+    def transaction(self):
+        # Roll back every write in the transaction if it fails.
+        with self._lock:
+            files = dict(self.files)
+            try:
+                yield self
+            except Exception:
+                self.files = files
+                raise
+
+
+class SQLiteStorage(Storage):
+    """
+    Storage in a single SQLite database file.  Outside of a transaction
+    every write is committed on its own; inside one, writes are committed
+    together.
+    """
+
+    def __init__(self, path):
+        super().__init__()
+        self.path = path
+        self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute(
+            'CREATE TABLE IF NOT EXISTS files ('
+            'name TEXT PRIMARY KEY, data BLOB NOT NULL, '
+            'mode INTEGER NOT NULL, mtime REAL NOT NULL)'
+        )
+        self.depth = 0
+
+    def execute(self, sql, *params):
+        with self._lock:
+            return self.db.execute(sql, params)
+
+    def read(self, name):
+        row = self.execute('SELECT data FROM files WHERE name = ?', name).fetchone()
+        if row is None:
+            raise FileNotFoundError(name)
+        return bytes(row[0])
+
+    def write(self, name, data, mode=0o644):
+        self.execute(
+            'INSERT OR REPLACE INTO files (name, data, mode, mtime) VALUES (?, ?, ?, ?)',
+            name, bytes(data), mode, time.time()
+        )
+
+    def append(self, name, data):
+        with self.transaction():
+            if self.exists(name):
+                self.execute(
+                    # Concatenation yields text, so cast back to a blob.
+                    'UPDATE files SET data = CAST(data || ? AS BLOB), mtime = ? WHERE name = ?',
+                    bytes(data), time.time(), name
+                )
+            else:
+                self.write(name, data)
+
+    def exists(self, name):
+        return self.execute('SELECT 1 FROM files WHERE name = ?', name).fetchone() is not None
+
+    def size(self, name):
+        row = self.execute('SELECT length(data) FROM files WHERE name = ?', name).fetchone()
+        if row is None:
+            raise FileNotFoundError(name)
+        return row[0]
+
+    def delete(self, name):
+        self.execute('DELETE FROM files WHERE name = ?', name)
+
+    def rename(self, src, dst):
+        with self.transaction():
+            if not self.exists(src):
+                raise FileNotFoundError(src)
+            self.execute('DELETE FROM files WHERE name = ?', dst)
+            self.execute('UPDATE files SET name = ? WHERE name = ?', dst, src)
+
+    def list(self, prefix=''):
+        rows = self.execute(
+            "SELECT name FROM files WHERE substr(name, 1, ?) = ? ORDER BY name",
+            len(prefix), prefix
+        )
+        return [row[0] for row in rows]
+
+    @contextmanager
+    def transaction(self):
+        with self._lock:
+            if not self.depth:
+                self.db.execute('BEGIN IMMEDIATE')
+            self.depth += 1
+            try:
+                yield self
+            except Exception:
+                self.depth -= 1
+                if not self.depth:
+                    self.db.execute('ROLLBACK')
+                raise
+            else:
+                self.depth -= 1
+                if not self.depth:
+                    self.db.execute('COMMIT')
+
+    @contextmanager
+    def lock(self, name):
+        with self.transaction():
+            yield
+
+
+_memory_storage = {}
+_sqlite_storage = {}
+_open_lock = threading.Lock()
+
+
+def open_storage(location):
+    """
+    Returns the storage for a location, which is either a directory path
+    (or `file://` URL), a `sqlite://` URL naming a database file, or a
+    `memory://` URL naming an in-process store.
+    """
+    if isinstance(location, Storage):
+        return location
+    if location.startswith('sqlite://'):
+        # One connection per database file, however many profiles use it.
+        path = os.path.abspath(location[len('sqlite://'):])
+        with _open_lock:
+            if path not in _sqlite_storage:
+                _sqlite_storage[path] = SQLiteStorage(path)
+            return _sqlite_storage[path]
+    if location.startswith('memory://'):
+        with _open_lock:
+            if location not in _memory_storage:
+                _memory_storage[location] = MemoryStorage()
+            return _memory_storage[location]
+    if location.startswith('file://'):
+        location = location[len('file://'):]
+    return FileSystemStorage(location)
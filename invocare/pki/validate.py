@@ -0,0 +1,304 @@
+import base64
+import os
+import re
+import threading
+
+from collections import OrderedDict
+
+from .config import expand
+from .crl import der_children, der_read
+from .ephemeral import is_ephemeral
+
+
+# Short names used in the subjects of the CA database.
+SHORT_NAMES = {
+    'countryName': 'C',
+    'stateOrProvinceName': 'ST',
+    'localityName': 'L',
+    'organizationName': 'O',
+    'organizationalUnitName': 'OU',
+    'commonName': 'CN',
+}
+
+# Upper bounds from RFC 5280, which OpenSSL enforces when signing.
+MAX_LENGTHS = {
+    'countryName': 2,
+    'stateOrProvinceName': 128,
+    'localityName': 128,
+    'organizationName': 64,
+    'organizationalUnitName': 64,
+    'commonName': 64,
+    'emailAddress': 255,
+}
+
+# Subject attribute types and extensions read from CSRs.
+NAME_OIDS = {
+    '2.5.4.3': 'commonName',
+    '2.5.4.6': 'countryName',
+    '2.5.4.7': 'localityName',
+    '2.5.4.8': 'stateOrProvinceName',
+    '2.5.4.10': 'organizationName',
+    '2.5.4.11': 'organizationalUnitName',
+    '1.2.840.113549.1.9.1': 'emailAddress',
+}
+OID_EXTENSION_REQUEST = '1.2.840.113549.1.9.14'
+OID_SAN = '2.5.29.17'
+
+# Codecs for the DER string types used in names.
+STRING_CODECS = {
+    0x0c: 'utf-8',
+    0x13: 'ascii',
+    0x14: 'latin-1',
+    0x16: 'ascii',
+    0x1c: 'utf-32-be',
+    0x1e: 'utf-16-be',
+}
+GENERAL_NAME_TYPES = {
+    0x81: 'email',
+    0x82: 'DNS',
+    0x86: 'URI',
+    0x87: 'IP',
+}
+CSR_PEM_RE = re.compile(
+    r'-----BEGIN (?:NEW )?CERTIFICATE REQUEST-----(?P<body>.+?)'
+    r'-----END (?:NEW )?CERTIFICATE REQUEST-----',
+    re.DOTALL
+)
+
+DNS_LABEL = r'[a-z0-9](?:[a-z0-9-]{0,61}[a-z0-9])?'
+DNS_NAME_RE = re.compile(
+    r'^(?:\*\.)?(?:%s\.)*%s\.?$' % (DNS_LABEL, DNS_LABEL), re.IGNORECASE
+)
+
+
+def database_subject(subject, policy):
+    """
+    Returns a subject as `openssl ca` writes it to the CA database: only
+    the fields in the policy, in the policy's order (the profile's CAs
+    don't preserve the requested order).
+    """
+    return ''.join(
+        '/%s=%s' % (SHORT_NAMES.get(attr, attr), subject[attr])
+        for attr in policy if subject.get(attr, '')
+    )
+
+
+class SubjectIndex:
+    """
+    The subjects of the active (non-revoked) certificates in a CA's
+    database, and whether the CA requires them to be unique.
+    """
+
+    def __init__(self, database, unique=True):
+        self.database = database
+        self.stamp = database_stamp(database)
+
+        # Like OpenSSL, the database's attribute file has the final say.
+        self.unique = unique
+        attr_file = database + '.attr'
+        if os.path.isfile(attr_file):
+            with open(attr_file, 'r') as fh:
+                for line in fh:
+                    name, _, value = line.partition('=')
+                    if name.strip() == 'unique_subject':
+                        self.unique = value.strip().lower() in ('y', 'yes', 'true', '1')
+
+        # Subjects are the last field; revoked entries don't count.
+        self.subjects = set()
+        if self.stamp:
+            with open(database, 'r') as fh:
+                self.subjects.update(
+                    line.rstrip('\n').rpartition('\t')[2]
+                    for line in fh if not line.startswith('R')
+                )
+
+    def __contains__(self, subject):
+        return subject in self.subjects
+
+
+def database_stamp(database):
+    try:
+        stat = os.stat(database)
+    except FileNotFoundError:
+        return None
+    return (stat.st_mtime_ns, stat.st_size)
+
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+
+def subject_index(profile, ca_name):
+    """
+    Returns the subject index for the CA, reusing the cached one unless the
+    CA database has changed since it was loaded.
+    """
+    settings = profile.cfg[ca_name]
+    database = expand(profile, settings['database'])
+    unique = settings.get('unique_subject', 'yes').lower() in ('y', 'yes', 'true', '1')
+    with _indexes_lock:
+        index = _indexes.get(database, None)
+        if index is None or index.stamp != database_stamp(database):
+            index = _indexes[database] = SubjectIndex(database, unique=unique)
+        return index
+
+
+def request_subject(profile, ca_name, common_name):
+    """
+    Returns the subject requested for a certificate issued by the CA, the
+    same one `PKIProfile.req_cfg` writes into the request config.
+    """
+    subject = OrderedDict(profile.cfg['dn'])
+    subject['organizationalUnitName'] = profile.cfg[ca_name]['org_unit']
+    subject['commonName'] = common_name
+    return subject
+
+
+def ca_subject(profile, ca_name):
+    """
+    Returns the subject of the CA's own certificate.
+    """
+    if ca_name == 'root':
+        subject = OrderedDict(profile.cfg['dn'])
+        subject['commonName'] = profile.cfg['root']['common_name']
+        return subject
+    return request_subject(profile, ca_name, profile.cfg[ca_name]['common_name'])
+
+
+def decode_oid(data):
+    arcs = list(divmod(data[0], 40)) if data[0] < 80 else [2, data[0] - 80]
+    value = 0
+    for byte in data[1:]:
+        value = (value << 7) | (byte & 0x7f)
+        if not byte & 0x80:
+            arcs.append(value)
+            value = 0
+    return '.'.join(str(arc) for arc in arcs)
+
+
+def csr_request(csr):
+    """
+    Returns the subject and subjectAltNames of a PEM-encoded CSR, as a
+    request for `validate_requests`.  Raises ValueError when the CSR
+    can't be parsed or repeats a subject field.
+    """
+    match = CSR_PEM_RE.search(csr)
+    if not match:
+        raise ValueError('No certificate request found.')
+    try:
+        der = base64.b64decode(match.group('body'))
+        _, start, end = der_read(der)
+        _, info_start, info_end = der_read(der, start)
+        info = list(der_children(der, info_start, info_end))
+        _, _, name_start, name_end = info[1]
+
+        subject = OrderedDict()
+        for _, _, rdn_start, rdn_end in der_children(der, name_start, name_end):
+            for _, _, atv_start, atv_end in der_children(der, rdn_start, rdn_end):
+                oid, value = list(der_children(der, atv_start, atv_end))[:2]
+                attr = decode_oid(der[oid[2]:oid[3]])
+                attr = NAME_OIDS.get(attr, attr)
+                if attr in subject:
+                    raise ValueError('The %s field is repeated.' % attr)
+                subject[attr] = der[value[2]:value[3]].decode(
+                    STRING_CODECS.get(value[0], 'utf-8')
+                )
+
+        san = []
+        attributes = [child for child in info[3:] if child[0] == 0xa0]
+        for _, _, attrs_start, attrs_end in attributes:
+            for _, _, attr_start, attr_end in der_children(der, attrs_start, attrs_end):
+                oid, values = list(der_children(der, attr_start, attr_end))[:2]
+                if decode_oid(der[oid[2]:oid[3]]) != OID_EXTENSION_REQUEST:
+                    continue
+                for _, _, exts_start, exts_end in der_children(der, values[2], values[3]):
+                    for _, _, ext_start, ext_end in der_children(der, exts_start, exts_end):
+                        ext = list(der_children(der, ext_start, ext_end))
+                        if decode_oid(der[ext[0][2]:ext[0][3]]) != OID_SAN:
+                            continue
+                        _, names_start, names_end = der_read(der, ext[-1][2])
+                        for tag, _, name_start, name_end in der_children(der, names_start, names_end):
+                            name_type = GENERAL_NAME_TYPES.get(tag, 'other')
+                            value = der[name_start:name_end]
+                            if name_type == 'DNS':
+                                san.append(value.decode('ascii'))
+                            else:
+                                san.append('%s:%s' % (name_type, value.hex()))
+    except (IndexError, UnicodeDecodeError):
+        raise ValueError('Malformed DER encoding.')
+    return subject, san
+
+
+def validate_requests(profile, ca_name, requests):
+    """
+    Checks a batch of requests to be signed by the CA against its policy,
+    and against the subjects in its database when they must be unique, so
+    that bad requests are rejected before any keys are generated.
+
+    Each request is a (subject, san) pair, where the subject maps long
+    attribute names to values and the SAN is a list or comma-separated
+    string of DNS names.  Returns a list with an error message, or None,
+    for each request.
+    """
+    policy = profile.cfg[profile.cfg[ca_name]['policy']]
+    issuer = ca_subject(profile, ca_name)
+    # Ephemeral CAs never record what they issue, and `x509 -req` copies
+    # the subject as it is rather than applying the policy.
+    ephemeral = is_ephemeral(profile, ca_name)
+    index = None if ephemeral else subject_index(profile, ca_name)
+    seen = set()
+
+    errors = []
+    for subject, san in requests:
+        errors.append(
+            check_subject(subject, policy, issuer, strict=ephemeral) or
+            check_san(san) or
+            check_unique(subject, policy, index, seen)
+        )
+    return errors
+
+
+def check_subject(subject, policy, issuer, strict=False):
+    """
+    Checks the subject against the CA's policy.  Attributes the policy
+    doesn't name are dropped by `openssl ca`, so they are only refused when
+    `strict`, for CAs that would copy them into the certificate.
+    """
+    for attr, rule in policy.items():
+        value = subject.get(attr, '')
+        if rule == 'supplied' and not value:
+            return 'The %s field must be supplied.' % attr
+        if rule == 'match' and value != issuer.get(attr, ''):
+            return 'The %s field must be "%s".' % (attr, issuer.get(attr, ''))
+
+    for attr, value in subject.items():
+        if attr not in policy:
+            if strict:
+                return 'The %s field is not allowed.' % attr
+            continue
+        if attr in MAX_LENGTHS and len(value) > MAX_LENGTHS[attr]:
+            return 'The %s field is longer than %d characters.' % (attr, MAX_LENGTHS[attr])
+    return None
+
+
+def check_san(san):
+    if not san:
+        return None
+    if isinstance(san, str):
+        san = san.split(',')
+    for alt_name in san:
+        if len(alt_name) > 253 or not DNS_NAME_RE.match(alt_name):
+            return 'Invalid subjectAltName, only DNS names are allowed: %s' % alt_name
+    return None
+
+
+def check_unique(subject, policy, index, seen):
+    if index is None or not index.unique:
+        return None
+    key = database_subject(subject, policy)
+    if key in index:
+        return 'A valid certificate already exists for subject CN=%s.' % subject.get('commonName', '')
+    if key in seen:
+        return 'Subject CN=%s is requested more than once.' % subject.get('commonName', '')
+    seen.add(key)
+    return None
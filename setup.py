@@ -19,6 +19,9 @@ setup(name='invocare-pki',
       install_requires=[
         'invocare-openssl>=0.0.1,<1.0.0',
       ],
+      extras_require={
+        'pkcs11': ['python-pkcs11'],
+      },
       packages=['invocare.pki'],
       zip_safe=False,
       classifiers=[
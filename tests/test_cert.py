@@ -0,0 +1,334 @@
+import base64
+import datetime
+import os
+import shutil
+import subprocess
+import tempfile
+import unittest
+
+import invoke
+
+from invocare.pki.ca import certificate_request, inter_ca, revoke, root_ca, sign_request
+from invocare.pki.cert import (
+    CertificateBuilder, CertificateRequest, NS_CERT_TYPE_BITS, certificate_extensions,
+    der_named_bits, issue_certificates, revoke_certificate,
+)
+from invocare.pki.config import CAConfig, OpenSSLConfig
+from invocare.pki.crl import (
+    PEM_RE, CACertificate, FileKeySigner, der_children, der_read,
+)
+from invocare.pki.init import initialize
+from invocare.pki.profile import PKIProfile
+
+
+def openssl(*args, **kwargs):
+    return subprocess.run(
+        ['openssl'] + list(args), check=True,
+        stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, **kwargs
+    ).stdout
+
+
+class ExtensionProfile:
+    """
+    The part of a `PKIProfile` that `certificate_extensions` reads.
+    """
+
+    def __init__(self, cfg):
+        self.cfg = cfg
+
+
+@unittest.skipIf(shutil.which('openssl') is None, 'openssl is not installed')
+class CertificateBuilderTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tmp_dir = tempfile.mkdtemp()
+        cls.ca_key = cls.path('ca.key')
+        cls.ca_file = cls.path('ca.crt')
+        openssl(
+            'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-days', '1',
+            '-subj', '/C=US/O=Acme/CN=Acme Test CA', '-keyout', cls.ca_key, '-out', cls.ca_file,
+        )
+
+        # The sections the profile writes for service and person CAs.
+        cfg = OpenSSLConfig()
+        cfg['default'] = {'base_url': 'http://pki.acme.test'}
+        for ca_type in ('service', 'person'):
+            ca = CAConfig(ca_type, ca_type=ca_type)
+            cfg[ca.x509_ext_name] = ca.x509_ext
+            cfg[ca.aia_name] = ca.aia
+            cfg[ca.crl_info_name] = ca.crl_info
+        with open(cls.path('openssl.cnf'), 'w') as fh:
+            cfg.write(fh)
+        cls.profile = ExtensionProfile(cfg)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.tmp_dir)
+
+    @classmethod
+    def path(cls, name):
+        return os.path.join(cls.tmp_dir, name)
+
+    def request(self, name, *args):
+        csr_file = self.path('%s.csr' % name)
+        openssl(
+            'req', '-new', '-nodes', '-keyout', self.path('%s.key' % name),
+            '-out', csr_file, *args
+        )
+        with open(csr_file, 'r') as fh:
+            return csr_file, CertificateRequest.from_pem(fh.read())
+
+    def openssl_certificate(self, csr_file, section, serial):
+        return openssl(
+            'x509', '-req', '-in', csr_file, '-CA', self.ca_file, '-CAkey', self.ca_key,
+            '-set_serial', str(serial), '-extfile', self.path('openssl.cnf'),
+            '-extensions', section, '-copy_extensions', 'copy', '-sha256', '-days', '1',
+            '-outform', 'DER',
+        )
+
+    def assertMatchesOpenSSL(self, csr_file, request, section):
+        expected = self.openssl_certificate(csr_file, section, 4242)
+
+        # Reuse the validity OpenSSL picked, as it depends on the clock.
+        _, cert_start, cert_end = der_read(expected)
+        _, tbs_start, tbs_end = der_read(expected, cert_start)
+        validity = list(der_children(expected, tbs_start, tbs_end))[4]
+        not_before, not_after = [
+            datetime.datetime.strptime(expected[start:end].decode('ascii'), '%y%m%d%H%M%SZ')
+            for _, _, start, end in der_children(expected, validity[2], validity[3])
+        ]
+
+        builder = CertificateBuilder(
+            CACertificate.from_file(self.ca_file),
+            certificate_extensions(self.profile, section),
+            FileKeySigner(self.ca_key),
+        )
+        request.verify()
+        self.assertEqual(builder.build(request, 4242, not_before, not_after), expected)
+
+    def test_service_certificate(self):
+        csr_file, request = self.request(
+            'service', '-newkey', 'rsa:2048', '-subj', '/C=US/O=Acme/CN=www.acme.test',
+            '-addext', 'subjectAltName=DNS:www.acme.test,DNS:acme.test',
+        )
+        self.assertMatchesOpenSSL(csr_file, request, 'service_cert')
+
+    def test_person_certificate(self):
+        csr_file, request = self.request(
+            'person', '-newkey', 'rsa:2048', '-subj', '/C=US/O=Acme/CN=Jo Smith',
+        )
+        self.assertMatchesOpenSSL(csr_file, request, 'person_cert')
+
+    def test_requested_extensions(self):
+        # The CA's keyUsage and extendedKeyUsage replace the requested ones,
+        # while the others are copied.
+        csr_file, request = self.request(
+            'extensions', '-newkey', 'rsa:2048', '-subj', '/C=US/O=Acme/CN=ext.acme.test',
+            '-addext', 'extendedKeyUsage=codeSigning',
+            '-addext', 'keyUsage=critical,keyCertSign',
+            '-addext', 'subjectAltName=DNS:ext.acme.test',
+            '-addext', 'nsComment=requested',
+        )
+        self.assertMatchesOpenSSL(csr_file, request, 'service_cert')
+
+    def test_ec_request(self):
+        csr_file, request = self.request(
+            'ec', '-newkey', 'ec', '-pkeyopt', 'ec_paramgen_curve:P-256',
+            '-subj', '/C=US/O=Acme/CN=ec.acme.test',
+        )
+        self.assertMatchesOpenSSL(csr_file, request, 'service_cert')
+
+    def test_tampered_request(self):
+        for name, options in (
+                ('rsa', ('-newkey', 'rsa:2048')),
+                ('ec-tampered', ('-newkey', 'ec', '-pkeyopt', 'ec_paramgen_curve:P-256')),
+        ):
+            _, request = self.request(name, *options, '-subj', '/C=US/O=Acme/CN=%s.acme.test' % name)
+            request.verify()
+
+            # Change a byte of the common name.
+            der = bytearray(request.der)
+            der[der.index(b'.acme.test') + 1] ^= 0x01
+            with self.assertRaises(ValueError):
+                CertificateRequest(bytes(der)).verify()
+
+    def test_malformed_request(self):
+        with self.assertRaises(ValueError):
+            CertificateRequest(b'\x30\x05\x02\x01')
+        with self.assertRaises(ValueError):
+            CertificateRequest.from_pem('not a request')
+
+    def test_unsupported_extension(self):
+        cfg = OpenSSLConfig()
+        cfg['custom'] = {'certificatePolicies': '1.2.3.4'}
+        with self.assertRaises(Exception):
+            certificate_extensions(ExtensionProfile(cfg), 'custom')
+
+    def test_named_bits(self):
+        self.assertEqual(der_named_bits(['server'], NS_CERT_TYPE_BITS), b'\x03\x02\x06\x40')
+        self.assertEqual(der_named_bits(['client', 'email'], NS_CERT_TYPE_BITS), b'\x03\x02\x05\xa0')
+        self.assertEqual(der_named_bits(['objCA'], NS_CERT_TYPE_BITS), b'\x03\x02\x00\x01')
+
+
+def not_before(pem):
+    der = base64.b64decode(PEM_RE.search(pem).group('body'))
+    _, cert_start, _ = der_read(der)
+    _, tbs_start, tbs_end = der_read(der, cert_start)
+    validity = list(der_children(der, tbs_start, tbs_end))[4]
+    _, start, end = der_read(der, validity[2])
+    return datetime.datetime.strptime(der[start:end].decode('ascii'), '%y%m%d%H%M%SZ')
+
+
+@unittest.skipIf(shutil.which('openssl') is None, 'openssl is not installed')
+class IssueCertificatesTest(unittest.TestCase):
+    """
+    Issues and revokes from the same CA database with `openssl ca` and
+    in-process, and compares the CA's files afterwards.
+    """
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.ctx = invoke.Context(invoke.Config(overrides={'run': {'in_stream': False}}))
+        self.profile = PKIProfile(
+            'acme', base_dir=self.tmp_dir, bits='2048',
+            root={'common_name': 'AcmeRoot'},
+            dn={'countryName': 'US', 'stateOrProvinceName': 'CA', 'localityName': 'Springfield',
+                'organizationName': 'Acme'},
+            intermediates={'tls': {'display_name': 'TLS', 'common_name': 'AcmeTLS'}},
+        )
+        initialize(self.ctx, self.profile)
+        root_ca(self.ctx, self.profile, batch=True)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def path(self, *names):
+        return os.path.join(self.profile.dir, *names)
+
+    def signer(self, ca_name):
+        return FileKeySigner(
+            os.path.join(self.profile.private, ca_name, 'ca.key'),
+            os.path.join(self.profile.private, ca_name, 'ca.pass'),
+        )
+
+    def save(self, ca_name):
+        saved = os.path.join(self.tmp_dir, 'saved-%s' % ca_name)
+        shutil.rmtree(saved, ignore_errors=True)
+        for name in ('db', 'archive'):
+            shutil.copytree(self.path(ca_name, name), os.path.join(saved, name))
+
+    def restore(self, ca_name):
+        for name in ('db', 'archive'):
+            shutil.rmtree(self.path(ca_name, name))
+            shutil.copytree(os.path.join(self.tmp_dir, 'saved-%s' % ca_name, name), self.path(ca_name, name))
+
+    def state(self, ca_name):
+        """
+        Returns the CA's database files, and the certificates in its
+        archive without the text `openssl ca` writes with them.
+        """
+        files = {}
+        for name in sorted(os.listdir(self.path(ca_name, 'db'))):
+            with open(self.path(ca_name, 'db', name), 'r') as fh:
+                files[name] = fh.read()
+        for name in sorted(os.listdir(self.path(ca_name, 'archive'))):
+            with open(self.path(ca_name, 'archive', name), 'r') as fh:
+                files[name] = PEM_RE.search(fh.read()).group(0)
+        return files
+
+    def request(self, name, subject):
+        csr_file = os.path.join(self.tmp_dir, '%s.csr' % name)
+        openssl(
+            'req', '-new', '-newkey', 'rsa:2048', '-nodes', '-keyout', os.devnull,
+            '-subj', subject, '-addext', 'subjectAltName=DNS:%s.acme.test' % name,
+            '-out', csr_file,
+        )
+        with open(csr_file, 'r') as fh:
+            return csr_file, CertificateRequest.from_pem(fh.read())
+
+    def test_intermediate(self):
+        self.save('root')
+        inter_ca(self.ctx, self.profile, ca_name='tls', batch=True)
+        expected = self.state('root')
+        with open(self.path('tls', 'ca.crt'), 'r') as fh:
+            now = not_before(fh.read())
+
+        self.restore('root')
+        with open(self.path('root', 'reqs', 'tls.csr'), 'r') as fh:
+            request = CertificateRequest.from_pem(fh.read())
+        issue_certificates(
+            self.profile, 'root', [request], int(self.profile.cfg['root']['default_days']),
+            extensions='intermediate_cert', signer=self.signer('root'), now=now,
+        )
+        self.assertEqual(self.state('root'), expected)
+
+    def test_certificates(self):
+        inter_ca(self.ctx, self.profile, ca_name='tls', batch=True)
+        req_file = certificate_request(self.ctx, self.profile, 'tls', 'www.acme.test')
+        sign_request(
+            self.ctx, self.profile, 'tls', req_file, self.path('tls', 'certs', 'www.crt'), batch=True,
+        )
+
+        # Out of the policy's order, with an attribute it doesn't name.
+        requests = [
+            self.request('api', '/CN=api.acme.test/OU=TLS/O=Acme/L=Springfield/ST=CA/C=US'),
+            self.request('odd', '/emailAddress=odd@acme.test/CN=odd.acme.test/O=Acme/OU=TLS'
+                                '/C=US/L=Springfield/ST=CA'),
+        ]
+        self.save('tls')
+        openssl(
+            'ca', '-batch', '-config', self.profile.config_file, '-name', 'tls',
+            '-passin', 'file:%s' % os.path.join(self.profile.private, 'tls', 'ca.pass'),
+            '-days', '30', '-infiles', *[csr_file for csr_file, _ in requests],
+        )
+        expected = self.state('tls')
+        now = not_before(expected['02.pem'])
+
+        self.restore('tls')
+        results = issue_certificates(
+            self.profile, 'tls', [request for _, request in requests], 30,
+            signer=self.signer('tls'), now=now,
+        )
+        self.assertEqual(self.state('tls'), expected)
+        self.assertEqual(results, [expected['02.pem'] + '\n', expected['03.pem'] + '\n'])
+
+    def test_refused(self):
+        inter_ca(self.ctx, self.profile, ca_name='tls', batch=True)
+        _, request = self.request('api', '/C=US/ST=CA/L=Springfield/O=Acme/OU=TLS/CN=api.acme.test')
+        _, other = self.request('other', '/C=US/ST=CA/L=Springfield/O=Other/OU=TLS/CN=other.acme.test')
+        tampered = bytearray(request.der)
+        tampered[tampered.index(b'api.acme.test')] ^= 0x01
+
+        results = issue_certificates(
+            self.profile, 'tls', [CertificateRequest(bytes(tampered)), request, request, other], 30,
+            signer=self.signer('tls'),
+        )
+        self.assertTrue(results[1].startswith('-----BEGIN CERTIFICATE-----'))
+        for i in (0, 2, 3):
+            self.assertIsInstance(results[i], ValueError)
+        with open(self.path('tls', 'db', 'index.txt'), 'r') as fh:
+            self.assertEqual(len(fh.readlines()), 1)
+        with open(self.path('tls', 'db', 'crt.srl'), 'r') as fh:
+            self.assertEqual(fh.read(), '02\n')
+
+    def test_revoke(self):
+        inter_ca(self.ctx, self.profile, ca_name='tls', batch=True)
+        req_file = certificate_request(self.ctx, self.profile, 'tls', 'www.acme.test')
+        cert_file = self.path('tls', 'certs', 'www.acme.test.crt')
+        sign_request(self.ctx, self.profile, 'tls', req_file, cert_file, batch=True)
+        with open(cert_file, 'r') as fh:
+            pem = fh.read()
+
+        self.save('tls')
+        revoke(self.ctx, cert_file, self.profile, ca_name='tls', batch=True)
+        expected = self.state('tls')
+        revoked = expected['index.txt'].split('\t')[2]
+        now = datetime.datetime.strptime(revoked, '%y%m%d%H%M%SZ')
+
+        self.restore('tls')
+        revoke_certificate(self.profile, 'tls', pem, now=now)
+        for name in ('index.txt', 'index.txt.old'):
+            self.assertEqual(self.state('tls')[name], expected[name])
+        with self.assertRaises(ValueError):
+            revoke_certificate(self.profile, 'tls', pem)
@@ -0,0 +1,132 @@
+import datetime
+import os
+import shutil
+import subprocess
+import tempfile
+import unittest
+
+from invocare.pki.crl import (
+    CACertificate, CRLBuilder, FileKeySigner, der_children, der_read,
+)
+
+
+CA_CONFIG = """\
+[ ca ]
+default_ca = test
+
+[ test ]
+dir = %(dir)s
+database = $dir/index.txt
+crlnumber = $dir/crl.srl
+certificate = $dir/ca.crt
+private_key = $dir/ca.key
+new_certs_dir = $dir
+serial = $dir/crt.srl
+default_md = sha256
+default_days = 1
+default_crl_days = 7
+policy = policy
+crl_extensions = crl_ext
+
+[ policy ]
+commonName = supplied
+
+[ crl_ext ]
+authorityKeyIdentifier = keyid:always
+"""
+
+# `openssl ca` arguments for each revoked certificate.
+REVOCATIONS = [
+    ('-crl_reason', 'superseded'),
+    ('-crl_compromise', '20240102030405Z'),
+    ('-crl_CA_compromise', '20230102030405Z'),
+    ('-crl_hold', 'holdInstructionReject'),
+    ('-crl_hold', '1.2.840.10040.2.2'),
+    (),
+]
+
+
+@unittest.skipIf(shutil.which('openssl') is None, 'openssl is not installed')
+class CRLBuilderTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tmp_dir = tempfile.mkdtemp()
+        cls.config_file = cls.path('ca.cnf')
+        with open(cls.config_file, 'w') as fh:
+            fh.write(CA_CONFIG % {'dir': cls.tmp_dir})
+        for name, data in (('index.txt', ''), ('crl.srl', '01\n'), ('crt.srl', '01\n')):
+            with open(cls.path(name), 'w') as fh:
+                fh.write(data)
+        cls.openssl(
+            'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-days', '1', '-subj', '/CN=Test CA',
+            '-keyout', cls.path('ca.key'), '-out', cls.path('ca.crt'),
+        )
+
+        # Issue a certificate for each revocation, and one left valid.
+        for i, args in enumerate(REVOCATIONS + [None]):
+            csr_file, cert_file = cls.path('%d.csr' % i), cls.path('%d.crt' % i)
+            cls.openssl(
+                'req', '-new', '-newkey', 'rsa:2048', '-nodes', '-keyout', os.devnull,
+                '-subj', '/CN=cert-%d' % i, '-out', csr_file,
+            )
+            cls.openssl(
+                'ca', '-batch', '-config', cls.config_file, '-in', csr_file, '-out', cert_file,
+            )
+            if args is not None:
+                cls.openssl('ca', '-config', cls.config_file, '-revoke', cert_file, *args)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.tmp_dir)
+
+    @classmethod
+    def path(cls, name):
+        return os.path.join(cls.tmp_dir, name)
+
+    @staticmethod
+    def openssl(*args):
+        subprocess.run(
+            ['openssl'] + list(args), check=True,
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+        )
+
+    def test_matches_openssl(self):
+        self.openssl(
+            'ca', '-config', self.config_file, '-gencrl', '-out', self.path('openssl.crl'),
+        )
+        with open(self.path('openssl.crl'), 'r') as fh:
+            expected = fh.read()
+
+        # Build for the same thisUpdate, with the CRL number OpenSSL used.
+        with open(self.path('openssl.crl'), 'rb') as fh:
+            der = subprocess.run(
+                ['openssl', 'crl', '-outform', 'DER'], input=fh.read(),
+                stdout=subprocess.PIPE, check=True,
+            ).stdout
+        _, crl_start, _ = der_read(der)
+        _, tbs_start, tbs_end = der_read(der, crl_start)
+        this_update = list(der_children(der, tbs_start, tbs_end))[3]
+        now = datetime.datetime.strptime(
+            der[this_update[2]:this_update[3]].decode('ascii'), '%y%m%d%H%M%SZ'
+        )
+
+        builder = CRLBuilder(
+            CACertificate.from_file(self.path('ca.crt')),
+            self.path('index.txt'),
+            FileKeySigner(self.path('ca.key')),
+            crl_number=1,
+        )
+        builder.build(self.path('builder.crl'), now=now)
+        with open(self.path('builder.crl'), 'r') as fh:
+            self.assertEqual(fh.read(), expected)
+        self.assertEqual(builder.revoked, len(REVOCATIONS))
+
+    def test_unsupported_hold_instruction(self):
+        builder = CRLBuilder(
+            CACertificate.from_file(self.path('ca.crt')), self.path('index.txt'), None,
+        )
+        with self.assertRaises(Exception):
+            builder.entry('01', '240101000000Z,holdInstruction,not an oid')
+        with self.assertRaises(Exception):
+            builder.entry('01', '240101000000Z,unknownReason')
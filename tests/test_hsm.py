@@ -0,0 +1,301 @@
+import asyncio
+import datetime
+import hashlib
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+import unittest
+
+from unittest import mock
+
+import invoke
+
+from invocare.pki.ca import certificate, certificate_request, inter_ca, revoke, root_ca
+from invocare.pki.cert import (
+    OID_BASIC_CONSTRAINTS, OID_RSA_ENCRYPTION, CertificateBuilder, CertificateRequest,
+)
+from invocare.pki.crl import (
+    CACertificate, FileKeySigner, OID_AKI, OID_SKI, der_integer, der_oid, der_sequence,
+    der_tlv,
+)
+from invocare.pki.hsm import DIGEST_INFO_PREFIXES, HSMSigner, SessionPool
+from invocare.pki.init import initialize
+from invocare.pki.profile import PKIProfile
+from invocare.pki.service import CABatcher, IssueRequest, RevokeRequest
+
+try:
+    import pkcs11
+except ImportError:
+    pkcs11 = None
+
+
+# Where distributions install the SoftHSM module; SOFTHSM2_MODULE wins.
+SOFTHSM_MODULES = [
+    '/usr/lib/softhsm/libsofthsm2.so',
+    '/usr/lib/x86_64-linux-gnu/softhsm/libsofthsm2.so',
+    '/usr/lib64/pkcs11/libsofthsm2.so',
+    '/usr/local/lib/softhsm/libsofthsm2.so',
+    '/opt/homebrew/lib/softhsm/libsofthsm2.so',
+]
+
+
+def softhsm_module():
+    for path in [os.environ.get('SOFTHSM2_MODULE', None)] + SOFTHSM_MODULES:
+        if path and os.path.isfile(path):
+            return path
+    return None
+
+
+TOKEN = 'invocare-test'
+PIN = '1234'
+LABEL = 'test-ca'
+
+
+@unittest.skipIf(shutil.which('softhsm2-util') is None, 'softhsm2-util is not installed')
+@unittest.skipIf(pkcs11 is None, 'python-pkcs11 is not installed')
+@unittest.skipIf(softhsm_module() is None, 'the SoftHSM PKCS#11 module was not found')
+class SoftHSMTest(unittest.TestCase):
+    """
+    Signs with a key on a throwaway SoftHSM token through `SessionPool`.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tmp_dir = tempfile.mkdtemp()
+        tokens = os.path.join(cls.tmp_dir, 'tokens')
+        os.makedirs(tokens)
+        conf = os.path.join(cls.tmp_dir, 'softhsm2.conf')
+        with open(conf, 'w') as fh:
+            fh.write('directories.tokendir = %s\nobjectstore.backend = file\n' % tokens)
+        cls.saved_conf = os.environ.get('SOFTHSM2_CONF', None)
+        os.environ['SOFTHSM2_CONF'] = conf
+        subprocess.run(
+            ['softhsm2-util', '--init-token', '--free', '--label', TOKEN,
+             '--pin', PIN, '--so-pin', PIN],
+            check=True, stdout=subprocess.DEVNULL,
+        )
+
+        cls.pool = SessionPool(softhsm_module(), TOKEN, PIN, size=2)
+        cls.pool.generate_key(LABEL, bits=2048)
+        with cls.pool.session() as session:
+            public_key = session.get_key(
+                object_class=pkcs11.ObjectClass.PUBLIC_KEY, label=LABEL
+            )
+            cls.modulus = int.from_bytes(public_key[pkcs11.Attribute.MODULUS], 'big')
+            cls.exponent = int.from_bytes(public_key[pkcs11.Attribute.PUBLIC_EXPONENT], 'big')
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.pool.close()
+        if cls.saved_conf is None:
+            del os.environ['SOFTHSM2_CONF']
+        else:
+            os.environ['SOFTHSM2_CONF'] = cls.saved_conf
+        shutil.rmtree(cls.tmp_dir)
+
+    def path(self, name):
+        return os.path.join(self.tmp_dir, name)
+
+    def test_has_key(self):
+        self.assertTrue(self.pool.has_key(LABEL))
+        self.assertFalse(self.pool.has_key('missing'))
+
+    def test_sign_digest(self):
+        for md in ('sha256', 'sha384', 'sha512'):
+            digest = hashlib.new(md, b'invocare').digest()
+            signature = self.pool.sign_digest(LABEL, digest, md)
+            size = (self.modulus.bit_length() + 7) // 8
+            message = pow(int.from_bytes(signature, 'big'), self.exponent, self.modulus)
+            self.assertTrue(
+                message.to_bytes(size, 'big').endswith(b'\x00' + DIGEST_INFO_PREFIXES[md] + digest)
+            )
+
+    def test_sessions_are_reused(self):
+        digest = bytes(32)
+        errors = []
+
+        def sign():
+            try:
+                for _ in range(20):
+                    self.pool.sign_digest(LABEL, digest, 'sha256')
+            except Exception as exc:
+                errors.append(exc)
+
+        threads = [threading.Thread(target=sign) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        self.assertLessEqual(self.pool.opened, self.pool.size)
+
+    def test_issue_from_token_key(self):
+        # A root CA with a key file certifies the token's key, which then
+        # issues a leaf certificate; `openssl verify` checks the chain.
+        subprocess.run(
+            ['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-days', '1',
+             '-subj', '/CN=Test Root', '-keyout', self.path('root.key'),
+             '-out', self.path('root.crt')],
+            check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+        )
+        subprocess.run(
+            ['openssl', 'req', '-new', '-newkey', 'rsa:2048', '-nodes', '-subj', '/CN=leaf.test',
+             '-keyout', self.path('leaf.key'), '-out', self.path('leaf.csr')],
+            check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+        )
+
+        now = datetime.datetime.utcnow().replace(microsecond=0)
+        later = now + datetime.timedelta(hours=1)
+        ca_extensions = [
+            (OID_BASIC_CONSTRAINTS, True, der_sequence(der_tlv(0x01, b'\xff'))),
+            (OID_SKI, False, None),
+            (OID_AKI, False, None),
+        ]
+
+        # The token's key as a request; only signed requests are checked.
+        rsa_key = der_sequence(der_integer(self.modulus), der_integer(self.exponent))
+        token_request = CertificateRequest.__new__(CertificateRequest)
+        token_request.subject = der_sequence(der_tlv(0x31, der_sequence(
+            der_oid('2.5.4.3'), der_tlv(0x0c, b'Token CA')
+        )))
+        token_request.public_key = rsa_key
+        token_request.public_key_info = der_sequence(
+            der_sequence(der_oid(OID_RSA_ENCRYPTION), der_tlv(0x05, b'')),
+            der_tlv(0x03, b'\x00' + rsa_key),
+        )
+        token_request.extensions = []
+
+        root = CertificateBuilder(
+            CACertificate.from_file(self.path('root.crt')), ca_extensions,
+            FileKeySigner(self.path('root.key')),
+        )
+        ca_der = root.build(token_request, 2, now, later)
+
+        with open(self.path('leaf.csr'), 'r') as fh:
+            request = CertificateRequest.from_pem(fh.read())
+        request.verify()
+        leaf_extensions = [(OID_BASIC_CONSTRAINTS, True, der_sequence())] + ca_extensions[1:]
+        token_ca = CertificateBuilder(
+            CACertificate(ca_der), leaf_extensions, HSMSigner(self.pool, LABEL),
+        )
+        leaf_der = token_ca.build(request, 3, now, later)
+
+        for name, der in (('ca', ca_der), ('leaf', leaf_der)):
+            with open(self.path('%s.der' % name), 'wb') as fh:
+                fh.write(der)
+            subprocess.run(
+                ['openssl', 'x509', '-inform', 'DER', '-in', self.path('%s.der' % name),
+                 '-out', self.path('%s.crt' % name)],
+                check=True,
+            )
+        result = subprocess.run(
+            ['openssl', 'verify', '-CAfile', self.path('root.crt'),
+             '-untrusted', self.path('ca.crt'), self.path('leaf.crt')],
+            stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True,
+        )
+        self.assertEqual(result.returncode, 0, result.stdout)
+
+
+@unittest.skipIf(shutil.which('openssl') is None, 'openssl is not installed')
+class TokenCATest(unittest.TestCase):
+    """
+    Issues and revokes with a CA configured for a token key, which never
+    runs `openssl ca`.  The token's signer is replaced by the CA's key
+    file, so no token is needed.
+    """
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.ctx = invoke.Context(invoke.Config(overrides={'run': {'in_stream': False}}))
+        self.profile = PKIProfile(
+            'acme', base_dir=self.tmp_dir, bits='2048',
+            root={'common_name': 'AcmeRoot'},
+            dn={'countryName': 'US', 'stateOrProvinceName': 'CA', 'localityName': 'Springfield',
+                'organizationName': 'Acme'},
+            intermediates={'tls': {'display_name': 'TLS', 'common_name': 'AcmeTLS'}},
+        )
+        initialize(self.ctx, self.profile)
+        root_ca(self.ctx, self.profile, batch=True)
+        inter_ca(self.ctx, self.profile, ca_name='tls', batch=True)
+
+        self.profile.cfg['tls']['pkcs11_key'] = 'tls'
+        signer = FileKeySigner(
+            os.path.join(self.profile.private, 'tls', 'ca.key'),
+            os.path.join(self.profile.private, 'tls', 'ca.pass'),
+        )
+        for name in ('invocare.pki.ca.hsm_signer', 'invocare.pki.cert.hsm_signer'):
+            patcher = mock.patch(name, lambda profile, ca_name: signer)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def path(self, *names):
+        return os.path.join(self.profile.dir, *names)
+
+    def index(self):
+        with open(self.path('tls', 'db', 'index.txt'), 'r') as fh:
+            return [row.split('\t') for row in fh.read().splitlines()]
+
+    def verify(self, cert_file):
+        result = subprocess.run(
+            ['openssl', 'verify', '-CAfile', self.path('root', 'ca.crt'),
+             '-untrusted', self.path('tls', 'ca.crt'), cert_file],
+            stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True,
+        )
+        self.assertEqual(result.returncode, 0, result.stdout)
+
+    def test_tasks(self):
+        certificate(self.ctx, self.profile, ca_name='tls', common_name='www.acme.test', batch=True)
+        cert_file = self.path('tls', 'certs', 'www.acme.test.crt')
+        self.verify(cert_file)
+        # `openssl ca` would have written the certificate's text too.
+        with open(self.path('tls', 'archive', '01.pem'), 'r') as fh:
+            self.assertTrue(fh.read().startswith('-----BEGIN CERTIFICATE-----'))
+
+        revoke(self.ctx, cert_file, self.profile, ca_name='tls', batch=True)
+        self.assertEqual([row[0] for row in self.index()], ['R'])
+        result = subprocess.run(
+            ['openssl', 'crl', '-in', self.path('tls', 'ca.crl'), '-noout', '-text'],
+            stdout=subprocess.PIPE, check=True, universal_newlines=True,
+        )
+        self.assertIn('Serial Number: 01', result.stdout)
+
+    def test_service_batches(self):
+        req_files = [
+            certificate_request(self.ctx, self.profile, 'tls', name)
+            for name in ('www.acme.test', 'api.acme.test')
+        ]
+        # The second request for a subject is refused on its own.
+        req_files.append(req_files[0])
+
+        async def run():
+            batcher = CABatcher(self.ctx, self.profile, 'tls', None)
+            try:
+                certs = batcher.sign_batch([IssueRequest(f) for f in req_files], None)
+                with open(self.path('tls', 'archive', '02.pem'), 'r') as fh:
+                    revoked = batcher.revoke_batch([
+                        RevokeRequest(fh.name, reason='superseded'),
+                        RevokeRequest(fh.name, reason='superseded'),
+                    ])
+            finally:
+                batcher.worker.cancel()
+            return certs, revoked
+
+        loop = asyncio.new_event_loop()
+        try:
+            asyncio.set_event_loop(loop)
+            certs, revoked = loop.run_until_complete(run())
+        finally:
+            asyncio.set_event_loop(None)
+            loop.close()
+
+        self.assertTrue(all(cert.startswith('-----BEGIN CERTIFICATE-----') for cert in certs[:2]))
+        self.assertIsInstance(certs[2], Exception)
+        self.assertIs(revoked[0], True)
+        self.assertIsInstance(revoked[1], Exception)
+        self.assertEqual([(row[0], row[3]) for row in self.index()], [('V', '01'), ('R', '02')])
+        self.assertTrue(self.index()[1][2].endswith(',superseded'))
@@ -0,0 +1,279 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import invoke
+
+from invocare.pki.ca import certificate, inter_ca, revoke, root_ca
+from invocare.pki.init import initialize
+from invocare.pki.profile import PKIProfile
+from invocare.pki.storage import (
+    FileSystemStorage, MemoryStorage, SQLiteStorage, open_storage,
+)
+
+
+class StorageTests:
+    """
+    Behavior every storage backend shares; mixed into a TestCase that
+    creates `self.storage`.
+    """
+
+    def test_round_trip(self):
+        self.storage.write('acme/openssl.cnf', b'[default]\n', mode=0o600)
+        self.assertTrue(self.storage.exists('acme/openssl.cnf'))
+        self.assertEqual(self.storage.read('acme/openssl.cnf'), b'[default]\n')
+        self.assertEqual(self.storage.size('acme/openssl.cnf'), 10)
+
+        self.storage.write('acme/openssl.cnf', b'')
+        self.assertEqual(self.storage.read('acme/openssl.cnf'), b'')
+
+    def test_binary_data(self):
+        data = bytes(range(256))
+        self.storage.write('acme/root/ca.der', data)
+        self.assertEqual(self.storage.read('acme/root/ca.der'), data)
+
+    def test_missing(self):
+        self.assertFalse(self.storage.exists('acme/missing'))
+        with self.assertRaises(FileNotFoundError):
+            self.storage.read('acme/missing')
+        with self.assertRaises(FileNotFoundError):
+            self.storage.size('acme/missing')
+
+    def test_append(self):
+        self.storage.write('acme/eph/db/ephemeral.log', b'')
+        self.storage.append('acme/eph/db/ephemeral.log', b'one\n')
+        self.storage.append('acme/eph/db/ephemeral.log', b'\xfftwo\n')
+        self.assertEqual(self.storage.read('acme/eph/db/ephemeral.log'), b'one\n\xfftwo\n')
+        self.assertEqual(self.storage.size('acme/eph/db/ephemeral.log'), 9)
+
+    def test_append_creates(self):
+        self.storage.append('acme/eph/db/ephemeral.log', b'one\n')
+        self.assertEqual(self.storage.read('acme/eph/db/ephemeral.log'), b'one\n')
+
+    def test_rename(self):
+        self.storage.write('acme/eph/db/ephemeral.log', b'new\n')
+        self.storage.write('acme/eph/db/ephemeral.log.1', b'old\n')
+        self.storage.rename('acme/eph/db/ephemeral.log', 'acme/eph/db/ephemeral.log.1')
+        self.assertFalse(self.storage.exists('acme/eph/db/ephemeral.log'))
+        self.assertEqual(self.storage.read('acme/eph/db/ephemeral.log.1'), b'new\n')
+
+    def test_rename_missing(self):
+        self.storage.write('acme/eph/db/ephemeral.log.1', b'old\n')
+        with self.assertRaises(FileNotFoundError):
+            self.storage.rename('acme/eph/db/ephemeral.log', 'acme/eph/db/ephemeral.log.1')
+        self.assertEqual(self.storage.read('acme/eph/db/ephemeral.log.1'), b'old\n')
+
+    def test_delete(self):
+        self.storage.write('acme/eph/db/ephemeral.log.5', b'old\n')
+        self.storage.delete('acme/eph/db/ephemeral.log.5')
+        self.assertFalse(self.storage.exists('acme/eph/db/ephemeral.log.5'))
+
+    def test_list(self):
+        for name in ('acme/root/ca.crt', 'acme/tls/ca.crt', 'other/root/ca.crt'):
+            self.storage.write(name, b'')
+        self.assertEqual(self.storage.list('acme/'), ['acme/root/ca.crt', 'acme/tls/ca.crt'])
+
+    def test_transaction_commit(self):
+        with self.storage.transaction():
+            self.storage.write('acme/tls/db/index.txt', b'')
+            self.storage.write('acme/tls/db/serial', b'01\n')
+        self.assertEqual(self.storage.read('acme/tls/db/serial'), b'01\n')
+
+    def test_transaction_rollback(self):
+        self.storage.write('acme/tls/db/serial', b'01\n')
+        with self.assertRaises(RuntimeError):
+            with self.storage.transaction():
+                self.storage.write('acme/tls/db/serial', b'02\n')
+                self.storage.append('acme/tls/db/serial', b'03\n')
+                self.storage.write('acme/tls/db/index.txt', b'V\n')
+                # Nested transactions are part of the outer one.
+                with self.storage.transaction():
+                    self.storage.delete('acme/tls/db/serial')
+                raise RuntimeError
+        self.assertEqual(self.storage.read('acme/tls/db/serial'), b'01\n')
+        self.assertFalse(self.storage.exists('acme/tls/db/index.txt'))
+
+    def test_local_path(self):
+        self.storage.write('acme/tls/ca.crt', b'cert')
+        with self.storage.local_path('acme/tls/ca.crt') as path:
+            with open(path, 'rb') as fh:
+                self.assertEqual(fh.read(), b'cert')
+
+    def test_local_path_writable(self):
+        with self.storage.local_path('acme/tls/ca.crl', writable=True) as path:
+            with open(path, 'wb') as fh:
+                fh.write(b'crl')
+        self.assertEqual(self.storage.read('acme/tls/ca.crl'), b'crl')
+
+    def test_local_tree(self):
+        self.storage.write('acme/tls/db/index.txt', b'')
+        self.storage.write('acme/tls/db/index.txt.old', b'')
+        self.storage.write('acme/tls/ca.crt', b'cert')
+        with self.storage.local_tree() as root:
+            with open(os.path.join(root, 'acme', 'tls', 'db', 'index.txt'), 'wb') as fh:
+                fh.write(b'V\n')
+            os.unlink(os.path.join(root, 'acme', 'tls', 'db', 'index.txt.old'))
+            os.makedirs(os.path.join(root, 'private', 'acme', 'tls'))
+            key_file = os.path.join(root, 'private', 'acme', 'tls', 'www.key')
+            with open(key_file, 'wb') as fh:
+                fh.write(b'key')
+            os.chmod(key_file, 0o400)
+        self.assertEqual(self.storage.read('acme/tls/db/index.txt'), b'V\n')
+        self.assertFalse(self.storage.exists('acme/tls/db/index.txt.old'))
+        self.assertEqual(self.storage.read('private/acme/tls/www.key'), b'key')
+        self.assertEqual(self.storage.read('acme/tls/ca.crt'), b'cert')
+
+    def test_local_tree_failure(self):
+        self.storage.write('acme/tls/db/index.txt', b'')
+        with self.assertRaises(RuntimeError):
+            with self.storage.local_tree() as root:
+                with open(os.path.join(root, 'acme', 'tls', 'db', 'index.txt'), 'wb') as fh:
+                    fh.write(b'V\n')
+                raise RuntimeError
+        if not isinstance(self.storage, FileSystemStorage):
+            self.assertEqual(self.storage.read('acme/tls/db/index.txt'), b'')
+
+
+class MemoryStorageTest(StorageTests, unittest.TestCase):
+
+    def setUp(self):
+        self.storage = MemoryStorage()
+
+    def test_local_path_removed(self):
+        self.storage.write('acme/private/tls/ca.pass', b'secret')
+        with self.storage.local_path('acme/private/tls/ca.pass') as path:
+            self.assertEqual(os.stat(path).st_mode & 0o777, 0o600)
+        self.assertFalse(os.path.exists(path))
+
+
+class SQLiteStorageTest(StorageTests, unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, 'pki.sqlite')
+        self.storage = SQLiteStorage(self.path)
+
+    def tearDown(self):
+        self.storage.db.close()
+        shutil.rmtree(self.tmp_dir)
+
+    def test_persists(self):
+        self.storage.append('acme/eph/db/ephemeral.log', b'one\n')
+        self.storage.rename('acme/eph/db/ephemeral.log', 'acme/eph/db/ephemeral.log.1')
+        reopened = SQLiteStorage(self.path)
+        try:
+            self.assertEqual(reopened.read('acme/eph/db/ephemeral.log.1'), b'one\n')
+        finally:
+            reopened.db.close()
+
+    def test_rollback_not_visible(self):
+        reopened = SQLiteStorage(self.path)
+        try:
+            with self.assertRaises(RuntimeError):
+                with self.storage.transaction():
+                    self.storage.write('acme/tls/db/serial', b'01\n')
+                    raise RuntimeError
+            self.assertFalse(reopened.exists('acme/tls/db/serial'))
+        finally:
+            reopened.db.close()
+
+
+class FileSystemStorageTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.storage = FileSystemStorage(self.tmp_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_write(self):
+        self.storage.write('ca.crt', b'one')
+        self.storage.write('ca.crt', b'two', mode=0o444)
+        self.assertEqual(self.storage.read('ca.crt'), b'two')
+        self.assertEqual(os.stat(self.storage.path('ca.crt')).st_mode & 0o777, 0o444)
+        self.assertEqual(os.listdir(self.tmp_dir), ['ca.crt'])
+
+
+class OpenStorageTest(unittest.TestCase):
+
+    def test_locations(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            self.assertIsInstance(open_storage(tmp_dir), FileSystemStorage)
+            self.assertEqual(open_storage('file://' + tmp_dir).root, tmp_dir)
+            location = 'sqlite://' + os.path.join(tmp_dir, 'pki.sqlite')
+            storage = open_storage(location)
+            self.assertIsInstance(storage, SQLiteStorage)
+            # Profiles on the same database share its connection.
+            self.assertIs(open_storage(location), storage)
+            storage.db.close()
+        finally:
+            shutil.rmtree(tmp_dir)
+
+        self.assertIsInstance(open_storage('memory://a'), MemoryStorage)
+        self.assertIs(open_storage('memory://a'), open_storage('memory://a'))
+        self.assertIsNot(open_storage('memory://a'), open_storage('memory://b'))
+
+
+class RequireFilesystemTest(unittest.TestCase):
+
+    def test_filesystem(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            PKIProfile('acme', base_dir=tmp_dir).require_filesystem('root_ca')
+            PKIProfile(
+                'acme', base_dir=tmp_dir, storage='file://' + tmp_dir
+            ).require_filesystem('root_ca')
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_other_storage(self):
+        for location in ('memory://require', 'file:///elsewhere'):
+            profile = PKIProfile('acme', base_dir='/srv/pki', storage=location)
+            with self.assertRaises(SystemExit) as cm:
+                profile.require_filesystem('root_ca')
+            self.assertEqual(cm.exception.code, os.EX_CONFIG)
+
+
+@unittest.skipIf(shutil.which('openssl') is None, 'openssl is not installed')
+class WorkspaceTest(unittest.TestCase):
+    """
+    Runs the CA tasks on a profile kept in memory.
+    """
+
+    def profile(self):
+        return PKIProfile(
+            'acme', base_dir='/nonexistent', storage='memory://workspace', bits='2048',
+            root={'common_name': 'AcmeRoot'},
+            dn={'stateOrProvinceName': 'CA', 'localityName': 'Springfield', 'organizationName': 'Acme'},
+            intermediates={'tls': {'display_name': 'TLS', 'common_name': 'AcmeTLS'}},
+        )
+
+    def test_tasks(self):
+        # OpenSSL never prompts in batch mode, so don't hand it stdin.
+        ctx = invoke.Context(invoke.Config(overrides={'run': {'in_stream': False}}))
+        initialize(ctx, self.profile())
+        root_ca(ctx, self.profile(), batch=True)
+        inter_ca(ctx, self.profile(), ca_name='tls', batch=True)
+        for common_name in ('www.acme.test', 'api.acme.test'):
+            certificate(ctx, self.profile(), ca_name='tls', common_name=common_name, batch=True)
+        revoke(
+            ctx, '/nonexistent/acme/tls/certs/api.acme.test.crt', self.profile(),
+            ca_name='tls', batch=True,
+        )
+
+        storage = open_storage('memory://workspace')
+        index = storage.read('acme/tls/db/index.txt').decode('ascii').splitlines()
+        self.assertEqual([row.split('\t')[0] for row in index], ['V', 'R'])
+        self.assertEqual(storage.read('acme/tls/db/crt.srl'), b'03\n')
+        self.assertTrue(storage.exists('acme/tls/ca.crl'))
+        self.assertEqual(storage.files['private/acme/tls/www.acme.test.key'][1], 0o400)
+        # The stored config keeps the profile's own paths.
+        self.assertEqual(self.profile().cfg['default']['dir'], '/nonexistent/acme')
+        self.assertFalse(os.path.exists('/nonexistent'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,63 @@
+import subprocess
+import sys
+import unittest
+
+from importlib import import_module
+
+from invoke import Collection
+
+import invocare.pki
+
+
+# The module implementing each task declared by the package.
+TASK_MODULES = {
+    'backup': 'backup',
+    'restore': 'backup',
+    'inter_ca': 'ca',
+    'root_ca': 'ca',
+    'certificate': 'ca',
+    'revoke': 'ca',
+    'export': 'export',
+    'initialize': 'init',
+    'show': 'show',
+    'serve': 'service',
+}
+
+
+def arguments(task):
+    return [
+        (arg.names, arg.kind, arg.default, arg.help, arg.positional, arg.optional)
+        for arg in task.get_arguments()
+    ]
+
+
+class PackageTasksTest(unittest.TestCase):
+
+    def test_declarations_match(self):
+        for name, module in TASK_MODULES.items():
+            declared = getattr(invocare.pki, name)
+            implemented = getattr(import_module('invocare.pki.' + module), name)
+            self.assertEqual(arguments(declared), arguments(implemented), name)
+            self.assertEqual(declared.__doc__, implemented.__doc__, name)
+
+    def test_collection(self):
+        # Importing the task modules mustn't replace the tasks.
+        for module in set(TASK_MODULES.values()):
+            import_module('invocare.pki.' + module)
+        ns = Collection.from_module(invocare.pki)
+        self.assertEqual(
+            sorted(ns.task_names), sorted(name.replace('_', '-') for name in TASK_MODULES)
+        )
+
+    def test_lazy(self):
+        # Collecting the tasks imports none of their modules.
+        code = (
+            'import sys, invoke, invocare.pki; '
+            'invoke.Collection.from_module(invocare.pki); '
+            'print(sorted(m for m in sys.modules if m.startswith("invocare.pki.")))'
+        )
+        result = subprocess.run(
+            [sys.executable, '-c', code], stdout=subprocess.PIPE, check=True,
+            universal_newlines=True,
+        )
+        self.assertEqual(result.stdout.strip(), '[]')